@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark.py
+
+measure the client against the fake nimbus.io server
+(fake_nimbusio_server.py), with no account or network:
+requests per second, MB/s, p50/p99 latency and client CPU seconds for
+each operation.
+
+By default the server runs in its own process, so the CPU reported is the
+client's alone. --in-process runs it in the same reactor (the CPU then
+includes the server).
+
+To run against the source:
+cd "${HOME}/git/twisted_client_for_nimbusio"
+PYTHONPATH="${PWD}" python2.7 tests/benchmark.py --count=200 \
+    --concurrency=20 --latency=0.005 --json-output=/tmp/benchmark.json
+"""
+import argparse
+import httplib
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from twisted.python import log
+from twisted.internet import reactor, defer
+
+from twisted_client_for_nimbusio import metrics
+from twisted_client_for_nimbusio.rest_api import compute_archive_path, \
+    compute_head_path, \
+    compute_retrieve_path, \
+    compute_range_header_tuple
+from twisted_client_for_nimbusio.requester import start_collection_request, \
+    register_collection_hostname
+from twisted_client_for_nimbusio.pass_thru_producer import PassThruProducer
+from twisted_client_for_nimbusio.buffered_consumer import BufferedConsumer
+from twisted_client_for_nimbusio.conjoined_uploader import ConjoinedUploader
+from twisted_client_for_nimbusio.listing import list_keys
+
+from fake_nimbusio_server import FakeNimbusioServer
+
+_program_description = "Benchmark twisted_client_for_nimbusio"
+_operations = ["archive",
+               "head",
+               "retrieve",
+               "retrieve-range",
+               "list-keys",
+               "conjoined-archive", ]
+_collection_name = "benchmark-collection"
+_server_start_timeout = 10.0
+
+class _Identity(object):
+    """
+    requests are signed (the cost is part of the client) but the fake
+    server does not check the signatures
+    """
+    user_name = "benchmark"
+    auth_key_id = 1
+    auth_key = "benchmark-auth-key"
+
+def _parse_commandline():
+    parser = argparse.ArgumentParser(description=_program_description)
+    parser.add_argument("--operations",
+                        dest="operations",
+                        type=str,
+                        default=",".join(_operations),
+                        help="comma separated operations to measure, " \
+                             "from %s" % (", ".join(_operations), ))
+    parser.add_argument("--count",
+                        dest="count",
+                        type=int,
+                        default=100,
+                        help="the number of requests for each operation")
+    parser.add_argument("--concurrency",
+                        dest="concurrency",
+                        type=int,
+                        default=10,
+                        help="the number of requests in progress at once")
+    parser.add_argument("--object-size",
+                        dest="object_size",
+                        type=int,
+                        default=(64 * 1024),
+                        help="size of the keys archived and retrieved")
+    parser.add_argument("--range-size",
+                        dest="range_size",
+                        type=int,
+                        default=(4 * 1024),
+                        help="size of each retrieve-range request")
+    parser.add_argument("--conjoined-size",
+                        dest="conjoined_size",
+                        type=int,
+                        default=(8 * 1024 * 1024),
+                        help="size of each conjoined archive")
+    parser.add_argument("--conjoined-part-size",
+                        dest="conjoined_part_size",
+                        type=int,
+                        default=(1024 * 1024),
+                        help="part size of conjoined archives")
+    parser.add_argument("--latency",
+                        dest="latency",
+                        type=float,
+                        default=0.0,
+                        help="server latency (secs) for each request")
+    parser.add_argument("--bytes-per-second",
+                        dest="bytes_per_second",
+                        type=int,
+                        default=None,
+                        help="server bandwidth for each response body")
+    parser.add_argument("--error-rate",
+                        dest="error_rate",
+                        type=float,
+                        default=0.0,
+                        help="fraction of requests the server fails")
+    parser.add_argument("--in-process",
+                        dest="in_process",
+                        action="store_true",
+                        default=False,
+                        help="run the server in this process")
+    parser.add_argument("--json-output",
+                        dest="json_output",
+                        type=str,
+                        default=None,
+                        help="path to write the results to, as JSON")
+    return parser.parse_args()
+
+def _free_port():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    return port
+
+def _wait_for_server(port, timeout):
+    give_up_at = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), 1.0).close()
+            return
+        except socket.error:
+            if time.time() > give_up_at:
+                raise
+            time.sleep(0.05)
+
+def _start_server_process(args):
+    port = _free_port()
+    command = [sys.executable,
+               os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "fake_nimbusio_server.py"),
+               "--port=%s" % (port, ),
+               "--latency=%s" % (args.latency, ),
+               "--error-rate=%s" % (args.error_rate, ), ]
+    if args.bytes_per_second is not None:
+        command.append("--bytes-per-second=%s" % (args.bytes_per_second, ))
+    with open(os.devnull, "w") as devnull:
+        process = subprocess.Popen(command, stderr=devnull)
+    _wait_for_server(port, _server_start_timeout)
+    return process, "127.0.0.1:%s" % (port, )
+
+def _cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def _archive(state, index):
+    key = "benchmark/key_%08d" % (index, )
+    data = state["object-data"]
+    producer = PassThruProducer(key, len(data))
+    consumer = BufferedConsumer()
+    deferred = start_collection_request(state["identity"],
+                                        "POST",
+                                        _collection_name,
+                                        compute_archive_path(key),
+                                        response_consumer=consumer,
+                                        body_producer=producer)
+    producer.feed(data)
+
+    def _archived(_result):
+        state["keys"].append(key)
+        return len(data)
+
+    deferred.addCallback(_archived)
+    return deferred
+
+def _key(state, index):
+    return state["keys"][index % len(state["keys"])]
+
+def _head(state, index):
+    deferred = start_collection_request(state["identity"],
+                                        "HEAD",
+                                        _collection_name,
+                                        compute_head_path(_key(state, index)))
+    deferred.addCallback(lambda _response: 0)
+    return deferred
+
+def _retrieve(state, index):
+    consumer = BufferedConsumer()
+    deferred = start_collection_request(
+        state["identity"],
+        "GET",
+        _collection_name,
+        compute_retrieve_path(_key(state, index)),
+        response_consumer=consumer)
+    deferred.addCallback(lambda _result: len(consumer.buffer))
+    return deferred
+
+def _retrieve_range(state, index):
+    range_size = min(state["args"].range_size, len(state["object-data"]))
+    slice_offset = \
+        (index * range_size) % (len(state["object-data"]) - range_size + 1)
+    consumer = BufferedConsumer()
+    deferred = start_collection_request(
+        state["identity"],
+        "GET",
+        _collection_name,
+        compute_retrieve_path(_key(state, index)),
+        response_consumer=consumer,
+        additional_headers=dict([compute_range_header_tuple(slice_offset,
+                                                            range_size)]),
+        valid_http_status=frozenset([httplib.PARTIAL_CONTENT, ]))
+    deferred.addCallback(lambda _result: len(consumer.buffer))
+    return deferred
+
+def _list_keys(state, _index):
+    listing = list_keys(state["identity"], _collection_name, prefix="benchmark/")
+    return listing.for_each(lambda _entry: None)
+
+def _conjoined_archive(state, index):
+    key = "benchmark/conjoined_%08d" % (index, )
+    uploader = ConjoinedUploader(state["identity"],
+                                 _collection_name,
+                                 key,
+                                 state["conjoined-path"],
+                                 part_size=state["args"].conjoined_part_size)
+    deferred = uploader.start()
+    deferred.addCallback(lambda _result: uploader.length)
+    return deferred
+
+_operation_functions = {"archive"           : _archive,
+                        "head"              : _head,
+                        "retrieve"          : _retrieve,
+                        "retrieve-range"    : _retrieve_range,
+                        "list-keys"         : _list_keys,
+                        "conjoined-archive" : _conjoined_archive, }
+
+def _timed_request(state, operation, index, registry, totals):
+    started_at = time.time()
+    deferred = _operation_functions[operation](state, index)
+
+    def _succeeded(byte_count):
+        registry.timing(operation, time.time() - started_at)
+        totals["bytes"] += byte_count
+
+    def _failed(failure):
+        totals["errors"] += 1
+        log.msg("%s %s failed: %s" % (
+                operation, index, failure.getErrorMessage(), ),
+                logLevel=logging.WARN)
+
+    deferred.addCallbacks(_succeeded, _failed)
+    return deferred
+
+@defer.inlineCallbacks
+def _run_operation(state, operation):
+    args = state["args"]
+    registry = metrics.InMemoryRegistry(max_samples=args.count)
+    totals = {"bytes" : 0, "errors" : 0}
+    semaphore = defer.DeferredSemaphore(args.concurrency)
+
+    cpu_at_start = _cpu_seconds()
+    started_at = time.time()
+    yield defer.DeferredList(
+        [semaphore.run(_timed_request, state, operation, index, registry,
+                       totals)
+         for index in range(args.count)])
+    elapsed = time.time() - started_at
+    cpu = _cpu_seconds() - cpu_at_start
+
+    completed = args.count - totals["errors"]
+    result = {"operation"           : operation,
+              "requests"            : args.count,
+              "errors"              : totals["errors"],
+              "elapsed"             : elapsed,
+              "requests-per-second" : completed / elapsed,
+              "mb-per-second"       : totals["bytes"] / elapsed / (1024 ** 2),
+              "p50-latency"         : registry.percentile(operation, 50),
+              "p99-latency"         : registry.percentile(operation, 99),
+              "cpu-seconds"         : cpu,
+              "cpu-per-request"     : cpu / args.count}
+    defer.returnValue(result)
+
+def _format_latency(value):
+    return ("-" if value is None else "%.2fms" % (value * 1000.0, ))
+
+def _report(results):
+    print "%-18s %8s %6s %10s %9s %9s %9s %10s" % (
+          "operation", "requests", "errors", "req/s", "MB/s", "p50", "p99",
+          "cpu/req", )
+    for result in results:
+        print "%-18s %8d %6d %10.1f %9.2f %9s %9s %8.0fus" % (
+              result["operation"],
+              result["requests"],
+              result["errors"],
+              result["requests-per-second"],
+              result["mb-per-second"],
+              _format_latency(result["p50-latency"]),
+              _format_latency(result["p99-latency"]),
+              result["cpu-per-request"] * 1000000.0, )
+
+@defer.inlineCallbacks
+def _run_benchmarks(state, operations):
+    results = list()
+    try:
+        for operation in operations:
+            result = yield _run_operation(state, operation)
+            results.append(result)
+    except Exception, instance:
+        log.msg("benchmark failed: %s" % (instance, ), logLevel=logging.ERROR)
+        state["failed"] = True
+    state["results"] = results
+    reactor.stop()
+
+def main():
+    args = _parse_commandline()
+    operations = args.operations.split(",")
+    for operation in operations:
+        if operation not in _operation_functions:
+            print >> sys.stderr, "unknown operation %r" % (operation, )
+            return 1
+
+    log.startLogging(sys.stderr, setStdout=False)
+
+    server_process = None
+    if args.in_process:
+        fake_server = FakeNimbusioServer(latency=args.latency,
+                                         bytes_per_second=args.bytes_per_second,
+                                         error_rate=args.error_rate)
+        hostname = fake_server.start()
+    else:
+        server_process, hostname = _start_server_process(args)
+    register_collection_hostname(_collection_name, hostname)
+
+    conjoined_file = tempfile.NamedTemporaryFile()
+    conjoined_file.write(os.urandom(args.conjoined_size))
+    conjoined_file.flush()
+
+    state = {"args"             : args,
+             "identity"         : _Identity(),
+             "object-data"      : os.urandom(args.object_size),
+             "conjoined-path"   : conjoined_file.name,
+             "keys"             : list(),
+             "results"          : list(),
+             "failed"           : False}
+
+    # the read operations need keys to read
+    if "archive" not in operations and \
+        set(operations) & set(["head", "retrieve", "retrieve-range",
+                               "list-keys", ]):
+        operations.insert(0, "archive")
+
+    reactor.callWhenRunning(_run_benchmarks, state, operations)
+    try:
+        reactor.run()
+    finally:
+        conjoined_file.close()
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+    _report(state["results"])
+    if args.json_output is not None:
+        with open(args.json_output, "w") as output_file:
+            json.dump({"arguments"  : vars(args),
+                       "results"    : state["results"]},
+                      output_file, indent=4, sort_keys=True)
+
+    return (1 if state["failed"] else 0)
+
+if __name__ == "__main__":
+    sys.exit(main())
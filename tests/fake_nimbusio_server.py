@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+"""
+fake_nimbusio_server.py
+
+an in-process stand-in for nimbus.io, for running the client (and the
+benchmarks) without an account: archive, conjoined archive, HEAD, list
+keys, list versions, retrieve and retrieve with Range.
+
+Everything is kept in memory, and requests are not authenticated.
+
+    server = FakeNimbusioServer(latency=0.01)
+    server.start()
+    server.register_collection("test-collection")
+
+registers the collection's hostname with the client, so requests for it
+come here. Behavior can be changed while running:
+
+latency
+    seconds to wait before answering each request
+
+bytes_per_second
+    pace response bodies to this rate (None for as fast as possible)
+
+error_rate
+    the fraction of requests (0.0 - 1.0) answered with error_status
+
+truncate_full_pages
+    report every full page of a listing as truncated, even the last, as a
+    server that does not look ahead would
+
+ignore_ranges
+    answer a range request with the whole key, though with status 206
+    (Partial Content), as a broken server or proxy might
+
+fail_next(count, status, match)
+    answer the next count requests with status (only those whose path
+    and query contain match, if it is given). status DROP_CONNECTION
+    closes the connection without answering, DROP_MID_BODY sends the
+    headers and half of the body first, STALL_MID_BODY sends the headers
+    and half of the body, then nothing more
+
+aborted
+    the conjoined archives aborted, with the parts received before the
+    abort
+
+Run it as a program to serve on a port in its own process:
+
+    python fake_nimbusio_server.py --port=9000
+"""
+import argparse
+import base64
+from hashlib import md5
+import httplib
+import json
+import logging
+import random
+import re
+import sys
+import time
+
+from twisted.python import log
+from twisted.internet import reactor, defer
+from twisted.web import server, resource, http
+
+from twisted_client_for_nimbusio.requester import \
+    register_collection_hostname
+
+_range_re = re.compile(r"bytes=(\d*)-(\d*)$")
+_body_interval = 0.05
+
+#: statuses for fail_next that drop the connection instead of answering
+DROP_CONNECTION = "drop-connection"
+DROP_MID_BODY = "drop-mid-body"
+STALL_MID_BODY = "stall-mid-body"
+
+def _first_args(request):
+    """
+    the query arguments of a request, one value each. The list versions
+    path is "/?versions", so its other arguments may come glued to it
+    """
+    args = dict()
+    for name, values in request.args.items():
+        if name.startswith("versions?"):
+            args["versions"] = ""
+            name = name[len("versions?"):]
+        args[name] = values[0]
+    return args
+
+class _NimbusioResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, fake_server):
+        resource.Resource.__init__(self)
+        self._server = fake_server
+
+    def render(self, request):
+        self._server.request_count += 1
+        # the state of one response, which may outlive its connection
+        response = {"request"       : request,
+                    "disconnected"  : False,
+                    "delayed-call"  : None}
+        request.notifyFinish().addErrback(self._connection_lost, response)
+        delay = self._server.latency
+        if delay:
+            response["delayed-call"] = \
+                reactor.callLater(delay, self._respond, response)
+        else:
+            self._respond(response)
+        return server.NOT_DONE_YET
+
+    def _connection_lost(self, _failure, response):
+        """
+        the client went away (it timed out, or gave up): stop answering
+        """
+        response["disconnected"] = True
+        delayed_call = response["delayed-call"]
+        if delayed_call is not None and delayed_call.active():
+            delayed_call.cancel()
+        response["delayed-call"] = None
+
+    def _respond(self, response):
+        response["delayed-call"] = None
+        if response["disconnected"]:
+            return
+        request = response["request"]
+        status = self._server.injected_error(request)
+        if status == DROP_CONNECTION:
+            request.transport.abortConnection()
+            return
+        if status in (DROP_MID_BODY, STALL_MID_BODY, ):
+            self._send_half_body(response, drop=(status == DROP_MID_BODY))
+            return
+        if status is not None:
+            request.setResponseCode(status)
+            self._send_body(response, "injected error %s" % (status, ))
+            return
+
+        try:
+            body = self._dispatch(request)
+        except KeyError, instance:
+            request.setResponseCode(httplib.NOT_FOUND)
+            body = "not found: %s" % (instance, )
+        except ValueError, instance:
+            request.setResponseCode(httplib.BAD_REQUEST)
+            body = "bad request: %s" % (instance, )
+        self._send_body(response, body)
+
+    def _send_half_body(self, response, drop):
+        request = response["request"]
+        body = self._dispatch(request)
+        request.setHeader("content-length", str(len(body)))
+        request.write(body[:len(body) // 2])
+        if drop:
+            # give the first half time to arrive before the connection goes
+            response["delayed-call"] = \
+                reactor.callLater(_body_interval, self._drop, response)
+
+    def _drop(self, response):
+        response["delayed-call"] = None
+        if not response["disconnected"]:
+            response["request"].transport.abortConnection()
+
+    def _dispatch(self, request):
+        args = _first_args(request)
+        path = request.path
+        if path.startswith("/conjoined/"):
+            return self._conjoined(request, path[len("/conjoined/"):], args)
+        if path == "/data/" or (path == "/" and "versions" in args):
+            return self._list(args, versions=("versions" in args))
+        if not path.startswith("/data/"):
+            raise KeyError(path)
+        key = path[len("/data/"):]
+        if request.method == "POST":
+            return self._archive(request, key, args)
+        return self._retrieve(request, key, args)
+
+    def _archive(self, request, key, args):
+        data = request.content.read()
+        if "conjoined_identifier" in args:
+            conjoined = self._server.conjoined[args["conjoined_identifier"]]
+            conjoined["parts"][int(args["conjoined_part"])] = data
+            return json.dumps({"version_identifier" :
+                               self._server.next_version_identifier()})
+        version = self._server.store_version(key, data)
+        return json.dumps({"version_identifier" :
+                           version["version_identifier"]})
+
+    def _conjoined(self, request, key, args):
+        action = args["action"]
+        if action == "start":
+            conjoined_identifier = self._server.next_version_identifier()
+            self._server.conjoined[conjoined_identifier] = {"key"   : key,
+                                                            "parts" : dict()}
+            return json.dumps({"conjoined_identifier" : conjoined_identifier})
+        conjoined = self._server.conjoined.pop(args["conjoined_identifier"])
+        if action == "abort":
+            self._server.aborted.append(conjoined)
+            return json.dumps({"success" : True})
+        if action != "finish":
+            raise ValueError("unknown action %r" % (action, ))
+        parts = conjoined["parts"]
+        data = "".join([parts[part] for part in sorted(parts.keys())])
+        version = self._server.store_version(key, data)
+        return json.dumps({"version_identifier" :
+                           version["version_identifier"]})
+
+    def _retrieve(self, request, key, args):
+        version = self._server.find_version(key,
+                                            args.get("version_identifier"))
+        data = version["data"]
+        request.setHeader("content-md5", base64.b64encode(version["md5"]))
+        request.setHeader("last-modified", version["last-modified"])
+        if request.method == "HEAD":
+            request.setHeader("content-length", str(len(data)))
+            return ""
+
+        range_header = request.getHeader("range")
+        if range_header is None:
+            return data
+        match = _range_re.match(range_header)
+        if match is None:
+            raise ValueError("invalid range %r" % (range_header, ))
+        start, end = match.groups()
+        if self._server.ignore_ranges:
+            start, end = "0", ""
+        if start == "":
+            start = max(0, len(data) - int(end))
+            end = len(data) - 1
+        else:
+            start = int(start)
+            end = (len(data) - 1 if end == "" else
+                   min(int(end), len(data) - 1))
+        request.setResponseCode(httplib.PARTIAL_CONTENT)
+        request.setHeader("content-range", "bytes %s-%s/%s" % (
+                          start, end, len(data), ))
+        return data[start:end + 1]
+
+    def _list(self, args, versions):
+        prefix = args.get("prefix", "")
+        max_keys = int(args.get("max_keys", "1000"))
+        delimiter = args.get("delimiter")
+        marker = args.get("key_marker" if versions else "marker")
+        version_marker = args.get("version_identifier_marker")
+
+        entries = list()
+        prefixes = list()
+        truncated = False
+        for key in sorted(self._server.keys.keys()):
+            if not key.startswith(prefix):
+                continue
+            if marker is not None and key < marker:
+                continue
+            if delimiter is not None and delimiter in key[len(prefix):]:
+                common_prefix = key[:key.index(delimiter, len(prefix)) + 1]
+                if (marker is not None and common_prefix <= marker) or \
+                    common_prefix in prefixes:
+                    continue
+                if len(entries) + len(prefixes) >= max_keys:
+                    truncated = True
+                    break
+                prefixes.append(common_prefix)
+                continue
+            key_versions = self._server.keys[key]
+            if not versions:
+                if key == marker:
+                    continue
+                key_versions = key_versions[-1:]
+            for version in key_versions:
+                if key == marker and versions and \
+                    (version_marker is None or
+                     version["version_identifier"] <= version_marker):
+                    continue
+                if len(entries) + len(prefixes) >= max_keys:
+                    truncated = True
+                    break
+                entries.append({"key"                : key,
+                                "version_identifier" :
+                                    version["version_identifier"],
+                                "size"               : len(version["data"]),
+                                "last_modified"      :
+                                    version["last-modified"]})
+            if truncated:
+                break
+
+        if self._server.truncate_full_pages and \
+            len(entries) + len(prefixes) >= max_keys:
+            truncated = True
+
+        result = {"truncated"   : truncated,
+                  ("version_data" if versions else "key_data") : entries}
+        if delimiter is not None:
+            result["prefixes"] = prefixes
+        return json.dumps(result)
+
+    def _send_body(self, response, body):
+        request = response["request"]
+        rate = self._server.bytes_per_second
+        if not rate or request.method == "HEAD":
+            request.write(body)
+            request.finish()
+            return
+        chunk_size = max(1, int(rate * _body_interval))
+        self._send_chunk(response, body, 0, chunk_size)
+
+    def _send_chunk(self, response, body, offset, chunk_size):
+        response["delayed-call"] = None
+        if response["disconnected"]:
+            return
+        request = response["request"]
+        if offset >= len(body):
+            request.finish()
+            return
+        request.write(body[offset:offset + chunk_size])
+        response["delayed-call"] = \
+            reactor.callLater(_body_interval, self._send_chunk, response,
+                              body, offset + chunk_size, chunk_size)
+
+class _TrackedChannel(http.HTTPChannel):
+    """
+    an HTTPChannel that the server knows about, so stop can close it
+    """
+    def connectionMade(self):
+        http.HTTPChannel.connectionMade(self)
+        self.site.fake_server.channel_opened(self)
+
+    def connectionLost(self, reason):
+        http.HTTPChannel.connectionLost(self, reason)
+        self.site.fake_server.channel_closed(self)
+
+class FakeNimbusioServer(object):
+    """
+    serve the nimbus.io REST API from memory
+    """
+    def __init__(self,
+                 latency=0.0,
+                 bytes_per_second=None,
+                 error_rate=0.0,
+                 error_status=httplib.SERVICE_UNAVAILABLE,
+                 seed=None):
+        self.latency = latency
+        self.bytes_per_second = bytes_per_second
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.truncate_full_pages = False
+        self.ignore_ranges = False
+        self.request_count = 0
+        # key -> list of versions, oldest first
+        self.keys = dict()
+        self.conjoined = dict()
+        self.aborted = list()
+        self._random = random.Random(seed)
+        self._version_count = 0
+        self._fail_next = list()
+        self._port = None
+        # open connection -> deferreds waiting for it to close
+        self._channels = dict()
+        self.max_open_connections = 0
+        self.hostname = None
+
+    def start(self, port=0, interface="127.0.0.1"):
+        """
+        start listening. Port 0 picks a free port
+        return the hostname:port to send requests to
+        """
+        site = server.Site(_NimbusioResource(self))
+        site.protocol = _TrackedChannel
+        site.fake_server = self
+        site.noisy = False
+        self._port = reactor.listenTCP(port, site, interface=interface)
+        self.hostname = "%s:%s" % (interface, self._port.getHost().port, )
+        return self.hostname
+
+    def stop(self):
+        """
+        stop listening and close the open connections
+        return a deferred that fires when everything is closed
+        """
+        port, self._port = self._port, None
+        deferreds = [port.stopListening(), ]
+        for channel, waiting in self._channels.items():
+            deferred = defer.Deferred()
+            waiting.append(deferred)
+            deferreds.append(deferred)
+            channel.transport.abortConnection()
+        return defer.DeferredList(deferreds)
+
+    @property
+    def open_connections(self):
+        """
+        the number of connections open now
+        """
+        return len(self._channels)
+
+    def channel_opened(self, channel):
+        self._channels[channel] = list()
+        self.max_open_connections = max(self.max_open_connections,
+                                        len(self._channels))
+
+    def channel_closed(self, channel):
+        for deferred in self._channels.pop(channel, ()):
+            deferred.callback(None)
+
+    def register_collection(self, collection_name):
+        """
+        send the client's requests for collection_name to this server
+        """
+        register_collection_hostname(collection_name, self.hostname)
+
+    def fail_next(self, count, status=httplib.SERVICE_UNAVAILABLE,
+                  match=None):
+        """
+        answer the next count requests with status. With match, only
+        the requests whose path and query contain match
+        """
+        self._fail_next.append([count, status, match])
+
+    def injected_error(self, request):
+        for rule in self._fail_next:
+            count, status, match = rule
+            if match is None or match in request.uri:
+                if count == 1:
+                    self._fail_next.remove(rule)
+                else:
+                    rule[0] = count - 1
+                return status
+        if self.error_rate and self._random.random() < self.error_rate:
+            return self.error_status
+        return None
+
+    def next_version_identifier(self):
+        self._version_count += 1
+        return "%016x" % (self._version_count, )
+
+    def store_version(self, key, data):
+        version = {"version_identifier" : self.next_version_identifier(),
+                   "data"               : data,
+                   "md5"                : md5(data).digest(),
+                   "last-modified"      : time.strftime(
+                        "%a, %d %b %Y %H:%M:%S GMT", time.gmtime())}
+        self.keys.setdefault(key, list()).append(version)
+        return version
+
+    def find_version(self, key, version_identifier=None):
+        versions = self.keys[key]
+        if version_identifier is None:
+            return versions[-1]
+        for version in versions:
+            if version["version_identifier"] == version_identifier:
+                return version
+        raise KeyError(version_identifier)
+
+def _parse_commandline():
+    parser = argparse.ArgumentParser(description="fake nimbus.io server")
+    parser.add_argument("--port",
+                        dest="port",
+                        type=int,
+                        default=9000,
+                        help="port to listen on")
+    parser.add_argument("--latency",
+                        dest="latency",
+                        type=float,
+                        default=0.0,
+                        help="seconds to wait before answering each request")
+    parser.add_argument("--bytes-per-second",
+                        dest="bytes_per_second",
+                        type=int,
+                        default=None,
+                        help="pace response bodies to this rate")
+    parser.add_argument("--error-rate",
+                        dest="error_rate",
+                        type=float,
+                        default=0.0,
+                        help="fraction of requests answered with 503")
+    return parser.parse_args()
+
+def main():
+    args = _parse_commandline()
+    log.startLogging(sys.stderr)
+    fake_server = FakeNimbusioServer(latency=args.latency,
+                                     bytes_per_second=args.bytes_per_second,
+                                     error_rate=args.error_rate)
+    hostname = fake_server.start(port=args.port)
+    log.msg("fake nimbus.io server listening on %s" % (hostname, ),
+            logLevel=logging.INFO)
+    reactor.run()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+microbenchmark.py
+
+time the per-byte and per-request costs of the client, with fake
+transports and consumers (no reactor, no sockets):
+
+ * PassThruProducer.feed / _write_to_consumer, streaming and buffered
+ * BufferedConsumer.write (and joining the buffer)
+ * ResponseProducerProtocol.dataReceived
+ * requester._compute_headers and requester._compute_uri
+
+over a range of chunk and body sizes. Each case is run --repeat times
+and the fastest run is kept. Results can be written as JSON, and compared
+with the JSON of an earlier run (of another commit):
+
+cd "${HOME}/git/twisted_client_for_nimbusio"
+PYTHONPATH="${PWD}" python2.7 tests/microbenchmark.py \
+    --json-output=/tmp/before.json
+(change things)
+PYTHONPATH="${PWD}" python2.7 tests/microbenchmark.py \
+    --compare=/tmp/before.json
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+from timeit import default_timer
+
+from twisted.python.failure import Failure
+from twisted.internet import defer
+from twisted.test.proto_helpers import StringTransport
+from twisted.web.client import ResponseDone
+
+from twisted_client_for_nimbusio import requester
+from twisted_client_for_nimbusio.pass_thru_producer import PassThruProducer
+from twisted_client_for_nimbusio.buffered_consumer import BufferedConsumer
+from twisted_client_for_nimbusio.response_producer_protocol import \
+    ResponseProducerProtocol
+from twisted_client_for_nimbusio.rest_api import compute_retrieve_path
+
+_program_description = "Microbenchmarks for twisted_client_for_nimbusio"
+_kilobyte = 1024
+_megabyte = 1024 * 1024
+_chunk_sizes = [_kilobyte, 16 * _kilobyte, 64 * _kilobyte, _megabyte, ]
+_body_sizes = [_megabyte, 16 * _megabyte, ]
+_request_count = 10000
+
+class _Identity(object):
+    user_name = "microbenchmark"
+    auth_key_id = 1
+    auth_key = "microbenchmark-auth-key"
+
+class _DiscardConsumer(object):
+    """
+    an IConsumer that only counts what it is given
+    """
+    def __init__(self):
+        self.byte_count = 0
+
+    def registerProducer(self, producer, _streaming):
+        producer.addConsumer(self)
+
+    def unregisterProducer(self):
+        pass
+
+    def write(self, data):
+        self.byte_count += len(data)
+
+def _parse_commandline():
+    parser = argparse.ArgumentParser(description=_program_description)
+    parser.add_argument("--repeat",
+                        dest="repeat",
+                        type=int,
+                        default=5,
+                        help="run each case this many times, keep the fastest")
+    parser.add_argument("--filter",
+                        dest="filter",
+                        type=str,
+                        default=None,
+                        help="only run the cases whose name contains this")
+    parser.add_argument("--json-output",
+                        dest="json_output",
+                        type=str,
+                        default=None,
+                        help="path to write the results to, as JSON")
+    parser.add_argument("--compare",
+                        dest="compare",
+                        type=str,
+                        default=None,
+                        help="path of the JSON results of an earlier run " \
+                             "to compare with")
+    parser.add_argument("--regression-threshold",
+                        dest="regression_threshold",
+                        type=float,
+                        default=1.25,
+                        help="with --compare, report cases this many times " \
+                             "slower than before, and exit with status 1")
+    return parser.parse_args()
+
+def _chunks(body_size, chunk_size):
+    chunk = "x" * chunk_size
+    count, remainder = divmod(body_size, chunk_size)
+    chunks = [chunk] * count
+    if remainder:
+        chunks.append(chunk[:remainder])
+    return chunks
+
+def _pass_thru_streaming(chunks, body_size):
+    producer = PassThruProducer("microbenchmark", body_size)
+    consumer = _DiscardConsumer()
+    producer.startProducing(consumer)
+    for chunk in chunks:
+        producer.feed(chunk)
+    assert producer.is_finished
+
+def _pass_thru_buffered(chunks, body_size):
+    # everything is fed before the connection is ready, then drained
+    producer = PassThruProducer("microbenchmark", body_size,
+                                high_watermark=body_size,
+                                low_watermark=body_size)
+    for chunk in chunks:
+        producer.feed(chunk)
+    consumer = _DiscardConsumer()
+    producer.startProducing(consumer)
+    assert producer.is_finished
+
+def _buffered_consumer_write(chunks, body_size):
+    consumer = BufferedConsumer()
+    for chunk in chunks:
+        consumer.write(chunk)
+    assert len(consumer.buffer) == body_size
+
+def _response_data_received(chunks, body_size):
+    protocol = ResponseProducerProtocol(defer.Deferred())
+    consumer = _DiscardConsumer()
+    protocol.addConsumer(consumer)
+    protocol.makeConnection(StringTransport())
+    for chunk in chunks:
+        protocol.dataReceived(chunk)
+    protocol.connectionLost(Failure(ResponseDone()))
+    assert consumer.byte_count == body_size
+
+def _compute_headers_same_path(paths, identity):
+    path = paths[0]
+    for _ in paths:
+        requester._compute_headers(identity, "GET", path)
+
+def _compute_headers_unique_paths(paths, identity):
+    for path in paths:
+        requester._compute_headers(identity, "GET", path)
+
+def _compute_uri(paths, _identity):
+    for path in paths:
+        requester._compute_uri("microbenchmark.nimbus.io", path)
+
+_byte_cases = [("pass_thru_producer.streaming", _pass_thru_streaming),
+               ("pass_thru_producer.buffered", _pass_thru_buffered),
+               ("buffered_consumer.write", _buffered_consumer_write),
+               ("response_producer_protocol.data_received",
+                _response_data_received), ]
+
+_request_cases = [("compute_headers.same_path", _compute_headers_same_path),
+                  ("compute_headers.unique_paths",
+                   _compute_headers_unique_paths),
+                  ("compute_uri", _compute_uri), ]
+
+def _best_time(repeat, function, *args):
+    best = None
+    for _ in range(repeat):
+        started_at = default_timer()
+        function(*args)
+        elapsed = default_timer() - started_at
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def _run_cases(args):
+    results = dict()
+    for case_name, function in _byte_cases:
+        for body_size in _body_sizes:
+            for chunk_size in _chunk_sizes:
+                if chunk_size > body_size:
+                    continue
+                name = "%s/body=%s/chunk=%s" % (case_name, body_size,
+                                                chunk_size, )
+                if args.filter is not None and args.filter not in name:
+                    continue
+                chunks = _chunks(body_size, chunk_size)
+                seconds = _best_time(args.repeat, function, chunks,
+                                     body_size)
+                results[name] = {"seconds"          : seconds,
+                                 "calls"            : len(chunks),
+                                 "seconds-per-call" : seconds / len(chunks),
+                                 "bytes-per-second" : body_size / seconds}
+
+    identity = _Identity()
+    paths = [compute_retrieve_path("microbenchmark/key_%08d" % (index, ))
+             for index in range(_request_count)]
+    for name, function in _request_cases:
+        if args.filter is not None and args.filter not in name:
+            continue
+        seconds = _best_time(args.repeat, function, paths, identity)
+        results[name] = {"seconds"          : seconds,
+                         "calls"            : len(paths),
+                         "seconds-per-call" : seconds / len(paths)}
+
+    return results
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _report(results):
+    print "%-66s %14s %12s" % ("case", "per call", "MB/s", )
+    for name in sorted(results.keys()):
+        result = results[name]
+        throughput = result.get("bytes-per-second")
+        print "%-66s %12.3fus %12s" % (
+              name,
+              result["seconds-per-call"] * 1000000.0,
+              ("-" if throughput is None else
+               "%.1f" % (throughput / _megabyte, )), )
+
+def _compare(results, baseline_path, threshold):
+    """
+    print the change in time per call of each case since the baseline
+    return the number of cases slower by more than threshold
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    print
+    print "compared with %s (%s)" % (baseline_path,
+                                     baseline.get("commit"), )
+    regressions = 0
+    for name in sorted(results.keys()):
+        try:
+            before = baseline["results"][name]["seconds-per-call"]
+        except KeyError:
+            continue
+        ratio = results[name]["seconds-per-call"] / before
+        marker = ""
+        if ratio > threshold:
+            marker = " REGRESSION"
+            regressions += 1
+        print "%-66s %8.2fx%s" % (name, ratio, marker, )
+    return regressions
+
+def main():
+    args = _parse_commandline()
+    results = _run_cases(args)
+    _report(results)
+
+    if args.json_output is not None:
+        with open(args.json_output, "w") as output_file:
+            json.dump({"commit"     : _git_commit(),
+                       "python"     : platform.python_version(),
+                       "platform"   : platform.platform(),
+                       "repeat"     : args.repeat,
+                       "results"    : results},
+                      output_file, indent=4, sort_keys=True)
+
+    if args.compare is not None:
+        if _compare(results, args.compare, args.regression_threshold) > 0:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+"""
+init for the offline tests: trial test cases that run against
+fake_nimbusio_server, with no nimbus.io account
+"""
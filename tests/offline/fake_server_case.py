@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+fake_server_case.py
+
+a trial TestCase with a FakeNimbusioServer serving its collection
+"""
+from twisted.internet import reactor, task
+from twisted.trial import unittest
+
+from twisted_client_for_nimbusio.requester import \
+    register_collection_hostname
+from twisted_client_for_nimbusio.connection_pool import \
+    close_connection_pools
+
+from tests.fake_nimbusio_server import FakeNimbusioServer
+
+class FakeServerTestCase(unittest.TestCase):
+    """
+    start a fake server for collection_name before each test, and close
+    it (and the client's pooled connections) after
+    """
+    collection_name = "offline-test-collection"
+
+    def setUp(self):
+        self.server = FakeNimbusioServer()
+        self.server.start()
+        self.server.register_collection(self.collection_name)
+
+    def tearDown(self):
+        register_collection_hostname(self.collection_name, None)
+        # a request that failed on the status of its response returns its
+        # connection to the pool after the test sees the failure: close
+        # the pools on the next turn
+        deferred = task.deferLater(reactor, 0, close_connection_pools)
+        deferred.addCallback(lambda _result: self.server.stop())
+        return deferred
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+test_buffered_consumer.py
+
+test BufferedConsumer
+"""
+from twisted.trial import unittest
+
+from twisted_client_for_nimbusio.buffered_consumer import BufferedConsumer
+
+class TestBufferedConsumer(unittest.TestCase):
+
+    def test_empty(self):
+        consumer = BufferedConsumer()
+        # an empty consumer is still a consumer
+        self.assertTrue(consumer)
+        self.assertEqual(consumer.length, 0)
+        self.assertEqual(consumer.buffer, "")
+
+    def test_chunks(self):
+        consumer = BufferedConsumer()
+        for data in ["abc", "de", "f", ]:
+            consumer.write(data)
+        self.assertEqual(consumer.length, 6)
+        self.assertEqual(list(consumer.iter_chunks()), ["abc", "de", "f", ])
+        self.assertEqual(consumer.buffer, "abcdef")
+        # joined once
+        self.assertEqual(list(consumer.iter_chunks()), ["abcdef", ])
+
+        consumer.write("g")
+        self.assertEqual(consumer.buffer, "abcdefg")
+        self.assertEqual(consumer.length, 7)
+
+    def test_reset(self):
+        consumer = BufferedConsumer()
+        consumer.write("abc")
+        consumer.reset()
+        consumer.write("de")
+        self.assertEqual(consumer.buffer, "de")
+        self.assertEqual(consumer.length, 2)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+test_conditional_archive.py
+
+test archive_if_changed against the fake server
+"""
+import os
+
+from twisted.internet import defer
+
+from twisted_client_for_nimbusio.conditional_archive import \
+    archive_if_changed, UPLOADED, SKIPPED
+
+from tests.offline.fake_server_case import FakeServerTestCase
+
+_key = "conditional-key"
+_megabyte = 1024 * 1024
+
+class TestConditionalArchive(FakeServerTestCase):
+
+    def _write_file(self, data):
+        path = self.mktemp()
+        with open(path, "wb") as output_file:
+            output_file.write(data)
+        return path
+
+    def _archive(self, path, **kwargs):
+        return archive_if_changed(None,
+                                  self.collection_name,
+                                  _key,
+                                  path,
+                                  **kwargs)
+
+    @defer.inlineCallbacks
+    def test_unchanged_is_skipped(self):
+        self.server.store_version(_key, "unchanged data")
+        result = yield self._archive(self._write_file("unchanged data"))
+        self.assertEqual(result["status"], SKIPPED)
+        self.assertEqual(result["result"], None)
+        # the HEAD, and no POST
+        self.assertEqual(self.server.request_count, 1)
+        self.assertEqual(len(self.server.keys[_key]), 1)
+
+    @defer.inlineCallbacks
+    def test_changed_is_archived(self):
+        self.server.store_version(_key, "old data")
+        result = yield self._archive(self._write_file("new data"))
+        self.assertEqual(result["status"], UPLOADED)
+        self.assertEqual(result["length"], len("new data"))
+        # the HEAD, and a single POST
+        self.assertEqual(self.server.request_count, 2)
+        version = self.server.find_version(_key)
+        self.assertEqual(version["data"], "new data")
+        self.assertEqual(result["result"]["version_identifier"],
+                         version["version_identifier"])
+
+    @defer.inlineCallbacks
+    def test_missing_key_is_changed(self):
+        result = yield self._archive(self._write_file("new data"))
+        self.assertEqual(result["status"], UPLOADED)
+        self.assertEqual(self.server.request_count, 2)
+        self.assertEqual(self.server.find_version(_key)["data"], "new data")
+
+    @defer.inlineCallbacks
+    def test_above_threshold_is_conjoined(self):
+        data = os.urandom(6 * _megabyte)
+        result = yield self._archive(self._write_file(data),
+                                     conjoined_threshold=_megabyte)
+        self.assertEqual(result["status"], UPLOADED)
+        # the HEAD, start, two parts and finish
+        self.assertEqual(self.server.request_count, 5)
+        self.assertEqual(self.server.conjoined, dict())
+        self.assertEqual(self.server.find_version(_key)["data"], data)
+
+    def test_unreadable_file(self):
+        deferred = self._archive(os.path.join(self.mktemp(), "missing"))
+        return self.assertFailure(deferred, IOError)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+test_conjoined_uploader.py
+
+test ConjoinedUploader against the fake server
+"""
+import os
+import tempfile
+
+from twisted_client_for_nimbusio.requester import NimbusioHTTPStatusError
+from twisted_client_for_nimbusio.conjoined_uploader import ConjoinedUploader
+
+from tests.offline.fake_server_case import FakeServerTestCase
+
+_megabyte = 1024 * 1024
+
+class TestConjoinedUploader(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self._data = os.urandom(16 * _megabyte)
+        source_file = tempfile.NamedTemporaryFile(delete=False)
+        source_file.write(self._data)
+        source_file.close()
+        self._path = source_file.name
+        self.addCleanup(os.unlink, self._path)
+
+    def _uploader(self, **kwargs):
+        return ConjoinedUploader(None,
+                                 self.collection_name,
+                                 "conjoined-key",
+                                 self._path,
+                                 part_size=(5 * _megabyte),
+                                 **kwargs)
+
+    def test_upload(self):
+        uploader = self._uploader()
+        deferred = uploader.start()
+
+        def _check(_result):
+            self.assertEqual(uploader.part_count, 4)
+            self.assertEqual(
+                self.server.find_version("conjoined-key")["data"],
+                self._data)
+
+        deferred.addCallback(_check)
+        return deferred
+
+    def test_failed_part_aborts_after_parts_settle(self):
+        """
+        the abort is sent, and the file closed, only when the parts
+        in flight have finished
+        """
+        self.server.fail_next(1, match="conjoined_part=2")
+        uploader = self._uploader(max_part_retries=0)
+        deferred = uploader.start()
+        self.assertFailure(deferred, NimbusioHTTPStatusError)
+
+        def _check(_result):
+            self.assertEqual(len(self.server.aborted), 1)
+            self.assertEqual(sorted(self.server.aborted[0]["parts"].keys()),
+                             [1, 3, 4])
+            self.assertEqual(sorted(uploader.part_results.keys()), [1, 3, 4])
+
+        deferred.addCallback(_check)
+        return deferred
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+test_connection_pool.py
+
+test the per-host connection limit of the connection pools, and
+preconnect
+"""
+from twisted.internet import defer
+
+from twisted_client_for_nimbusio import connection_pool
+from twisted_client_for_nimbusio.rest_api import compute_head_path, \
+    compute_retrieve_path
+from twisted_client_for_nimbusio import requester
+from twisted_client_for_nimbusio.requester import start_collection_request, \
+    NimbusioHTTPStatusError
+from twisted_client_for_nimbusio.buffered_consumer import BufferedConsumer
+
+from tests.fake_nimbusio_server import DROP_CONNECTION, DROP_MID_BODY
+
+from tests.offline.fake_server_case import FakeServerTestCase
+
+class TestConnectionPool(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.addCleanup(connection_pool.configure_connection_pools,
+                        max_connections_per_host=
+                            connection_pool._max_connections_per_host,
+                        max_persistent_per_host=
+                            connection_pool._max_persistent_per_host)
+        self.server.store_version("key", "data")
+        self.server.latency = 0.05
+
+    def _heads(self, count):
+        return defer.DeferredList(
+            [start_collection_request(None,
+                                      "HEAD",
+                                      self.collection_name,
+                                      compute_head_path("key"))
+             for _ in range(count)],
+            fireOnOneErrback=True)
+
+    def test_connections_limited_per_host(self):
+        connection_pool.configure_connection_pools(
+            max_connections_per_host=2, max_persistent_per_host=1)
+        deferred = self._heads(6)
+
+        def _check(results):
+            self.assertEqual(len(results), 6)
+            self.assertEqual(self.server.request_count, 6)
+            self.assertEqual(self.server.max_open_connections, 2)
+
+        deferred.addCallback(_check)
+        return deferred
+
+    def test_no_limit(self):
+        connection_pool.configure_connection_pools(
+            max_connections_per_host=0)
+        deferred = self._heads(6)
+
+        def _check(_results):
+            self.assertEqual(self.server.max_open_connections, 6)
+
+        deferred.addCallback(_check)
+        return deferred
+
+    def _settled_heads(self, count):
+        return defer.DeferredList(
+            [start_collection_request(None,
+                                      "HEAD",
+                                      self.collection_name,
+                                      compute_head_path("key"))
+             for _ in range(count)],
+            consumeErrors=True)
+
+    @defer.inlineCallbacks
+    def test_waiter_served_after_error_status(self):
+        connection_pool.configure_connection_pools(
+            max_connections_per_host=1)
+        self.server.fail_next(1)
+        results = yield self._settled_heads(3)
+        self.assertFalse(results[0][0])
+        results[0][1].trap(NimbusioHTTPStatusError)
+        self.assertEqual([success for success, _ in results[1:]],
+                         [True, True])
+        self.assertEqual(self.server.max_open_connections, 1)
+
+    @defer.inlineCallbacks
+    def test_waiter_served_after_dropped_connection(self):
+        connection_pool.configure_connection_pools(
+            max_connections_per_host=1)
+        self.server.fail_next(1, DROP_CONNECTION)
+        results = yield self._settled_heads(3)
+        self.assertFalse(results[0][0])
+        self.assertEqual([success for success, _ in results[1:]],
+                         [True, True])
+        self.assertEqual(self.server.request_count, 3)
+
+    @defer.inlineCallbacks
+    def test_limit_held_until_body_is_read(self):
+        connection_pool.configure_connection_pools(
+            max_connections_per_host=1)
+        self.server.store_version("key", "x" * (256 * 1024))
+        self.server.fail_next(1, DROP_MID_BODY)
+        consumers = [BufferedConsumer() for _ in range(3)]
+        results = yield defer.DeferredList(
+            [start_collection_request(None,
+                                      "GET",
+                                      self.collection_name,
+                                      compute_retrieve_path("key"),
+                                      response_consumer=consumer)
+             for consumer in consumers],
+            consumeErrors=True)
+        self.assertEqual([success for success, _ in results],
+                         [False, True, True])
+        self.assertEqual(self.server.max_open_connections, 1)
+        for consumer in consumers[1:]:
+            self.assertEqual(len(consumer.buffer), 256 * 1024)
+
+    @defer.inlineCallbacks
+    def test_cancel_waiting_request(self):
+        connection_pool.configure_connection_pools(
+            max_connections_per_host=1)
+        first, second, third = [start_collection_request(
+                                    None,
+                                    "HEAD",
+                                    self.collection_name,
+                                    compute_head_path("key"))
+                                for _ in range(3)]
+        second.cancel()
+        yield self.assertFailure(second, defer.CancelledError)
+        yield defer.DeferredList([first, third, ], fireOnOneErrback=True)
+        self.assertEqual(self.server.request_count, 2)
+
+    @defer.inlineCallbacks
+    def test_preconnect(self):
+        connection_pool.configure_connection_pools(
+            max_persistent_per_host=3)
+        hostname = self.server.hostname
+        opened = yield connection_pool.preconnect(
+            hostname, requester._compute_uri(hostname, "/"), count=3)
+        self.assertEqual(opened, 3)
+        self.assertEqual(self.server.open_connections, 3)
+        self.assertEqual(self.server.request_count, 0)
+
+        # the next request uses one of the idle connections
+        yield self._heads(1)
+        self.assertEqual(self.server.request_count, 1)
+        self.assertEqual(self.server.open_connections, 3)
+        self.assertEqual(self.server.max_open_connections, 3)
+
+    @defer.inlineCallbacks
+    def test_preconnect_at_most_persistent(self):
+        connection_pool.configure_connection_pools(
+            max_persistent_per_host=2)
+        hostname = self.server.hostname
+        opened = yield connection_pool.preconnect(
+            hostname, requester._compute_uri(hostname, "/"), count=5)
+        self.assertEqual(opened, 2)
+        self.assertEqual(self.server.open_connections, 2)
+
+    @defer.inlineCallbacks
+    def test_preconnect_unavailable(self):
+        self.patch(connection_pool, "_preconnect_available", False)
+        hostname = self.server.hostname
+        opened = yield connection_pool.preconnect(
+            hostname, requester._compute_uri(hostname, "/"), count=3)
+        self.assertEqual(opened, 0)
+        self.assertEqual(self.server.open_connections, 0)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+test_disk_cache.py
+
+test DiskObjectCache against the fake server
+"""
+import httplib
+import os
+
+from twisted.internet import defer
+
+from twisted_client_for_nimbusio.disk_cache import DiskObjectCache
+from twisted_client_for_nimbusio.buffered_consumer import BufferedConsumer
+
+from tests.offline.fake_server_case import FakeServerTestCase
+
+class TestDiskObjectCache(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self._directory = self.mktemp()
+        self._data = dict()
+        for index in range(4):
+            self._store("key-%s" % (index, ), os.urandom(1000))
+
+    def _store(self, key, data):
+        self._data[key] = data
+        return self.server.store_version(key, data)
+
+    @defer.inlineCallbacks
+    def _retrieve(self, cache, key, **kwargs):
+        consumer = BufferedConsumer()
+        yield cache.retrieve(None, self.collection_name, key, consumer,
+                             **kwargs)
+        defer.returnValue(consumer.buffer)
+
+    @defer.inlineCallbacks
+    def test_miss_then_hit(self):
+        cache = DiskObjectCache(self._directory)
+        data = yield self._retrieve(cache, "key-0")
+        self.assertEqual(data, self._data["key-0"])
+        self.assertEqual((cache.hits, cache.misses, ), (0, 1, ))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.total_bytes, 1000)
+        # HEAD and GET
+        self.assertEqual(self.server.request_count, 2)
+
+        data = yield self._retrieve(cache, "key-0")
+        self.assertEqual(data, self._data["key-0"])
+        self.assertEqual((cache.hits, cache.misses, ), (1, 1, ))
+        # HEAD only
+        self.assertEqual(self.server.request_count, 3)
+
+    @defer.inlineCallbacks
+    def test_slice_from_whole_key(self):
+        cache = DiskObjectCache(self._directory)
+        yield self._retrieve(cache, "key-0")
+        data = yield self._retrieve(cache, "key-0", slice_offset=100,
+                                    slice_size=50)
+        self.assertEqual(data, self._data["key-0"][100:150])
+        self.assertEqual(cache.hits, 1)
+
+    @defer.inlineCallbacks
+    def test_slice_with_request_arguments(self):
+        """
+        the GET-only arguments of a retrieve are not passed to the HEAD
+        """
+        cache = DiskObjectCache(self._directory)
+        arguments = {"additional_headers" : {"x-test-header" : "1"},
+                     "valid_http_status"  : frozenset(
+                        [httplib.PARTIAL_CONTENT, ])}
+        for _ in range(2):
+            data = yield self._retrieve(cache, "key-0", slice_offset=100,
+                                        slice_size=50, **arguments)
+            self.assertEqual(data, self._data["key-0"][100:150])
+        self.assertEqual((cache.hits, cache.misses, ), (1, 1, ))
+        self.assertEqual(arguments["additional_headers"],
+                         {"x-test-header" : "1"})
+
+        # the slice is replaced when the key changes
+        self._store("key-0", os.urandom(1000))
+        data = yield self._retrieve(cache, "key-0", slice_offset=100,
+                                    slice_size=50, **arguments)
+        self.assertEqual(data, self._data["key-0"][100:150])
+        self.assertEqual((cache.hits, cache.misses, ), (1, 2, ))
+
+    @defer.inlineCallbacks
+    def test_changed_key_is_retrieved_again(self):
+        """
+        cached data that no longer matches the HEAD of the key is replaced
+        """
+        cache = DiskObjectCache(self._directory)
+        yield self._retrieve(cache, "key-0")
+        self._store("key-0", os.urandom(1000))
+
+        data = yield self._retrieve(cache, "key-0")
+        self.assertEqual(data, self._data["key-0"])
+        self.assertEqual((cache.hits, cache.misses, ), (0, 2, ))
+        self.assertEqual(len(cache), 1)
+
+        data = yield self._retrieve(cache, "key-0")
+        self.assertEqual(data, self._data["key-0"])
+        self.assertEqual(cache.hits, 1)
+
+    @defer.inlineCallbacks
+    def test_version_needs_no_head(self):
+        cache = DiskObjectCache(self._directory)
+        version_id = \
+            self.server.find_version("key-1")["version_identifier"]
+        yield self._retrieve(cache, "key-1", version_id=version_id)
+        data = yield self._retrieve(cache, "key-1", version_id=version_id)
+        self.assertEqual(data, self._data["key-1"])
+        self.assertEqual(cache.hits, 1)
+        # the first GET only
+        self.assertEqual(self.server.request_count, 1)
+
+    @defer.inlineCallbacks
+    def test_least_recently_used_evicted(self):
+        cache = DiskObjectCache(self._directory, max_bytes=2500)
+        yield self._retrieve(cache, "key-0")
+        yield self._retrieve(cache, "key-1")
+        # key-0 is now used more recently than key-1
+        yield self._retrieve(cache, "key-0")
+        yield self._retrieve(cache, "key-2")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.total_bytes, 2000)
+
+        misses = cache.misses
+        yield self._retrieve(cache, "key-0")
+        self.assertEqual(cache.misses, misses)
+        yield self._retrieve(cache, "key-1")
+        self.assertEqual(cache.misses, misses + 1)
+
+    @defer.inlineCallbacks
+    def test_too_large_not_cached(self):
+        cache = DiskObjectCache(self._directory, max_bytes=500)
+        data = yield self._retrieve(cache, "key-0")
+        self.assertEqual(data, self._data["key-0"])
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.total_bytes, 0)
+
+    @defer.inlineCallbacks
+    def test_invalidate(self):
+        cache = DiskObjectCache(self._directory)
+        yield self._retrieve(cache, "key-0")
+        yield self._retrieve(cache, "key-0", slice_offset=0, slice_size=10)
+        yield self._retrieve(cache, "key-1")
+        cache.invalidate(self.collection_name, "key-0")
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.total_bytes, 1000)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(os.listdir(self._directory), [])
+
+    @defer.inlineCallbacks
+    def test_survives_restart(self):
+        cache = DiskObjectCache(self._directory)
+        yield self._retrieve(cache, "key-0")
+
+        cache = DiskObjectCache(self._directory)
+        self.assertEqual(len(cache), 1)
+        data = yield self._retrieve(cache, "key-0")
+        self.assertEqual(data, self._data["key-0"])
+        self.assertEqual(cache.hits, 1)
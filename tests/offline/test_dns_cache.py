@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+test_dns_cache.py
+
+test CachingResolver with a task.Clock and a resolver that answers on demand
+"""
+from twisted.internet import defer, task
+from twisted.internet.error import DNSLookupError
+from twisted.trial import unittest
+
+from twisted_client_for_nimbusio import dns_cache
+from twisted_client_for_nimbusio.dns_cache import CachingResolver
+
+_name = "collection.example.com"
+_address = "10.0.0.1"
+
+class _FakeResolver(object):
+    """
+    hold each lookup until the test answers it
+    """
+    def __init__(self):
+        self.lookups = list()
+
+    def getHostByName(self, name, timeout=(1, 3, 11, 45)):
+        deferred = defer.Deferred()
+        self.lookups.append((name, deferred, ))
+        return deferred
+
+    def answer(self, address):
+        _name, deferred = self.lookups[-1]
+        deferred.callback(address)
+
+    def fail(self):
+        name, deferred = self.lookups[-1]
+        deferred.errback(DNSLookupError(name))
+
+class TestCachingResolver(unittest.TestCase):
+
+    def setUp(self):
+        # the cache reads the time from the reactor
+        self.clock = task.Clock()
+        self.patch(dns_cache, "reactor", self.clock)
+        self.fake_resolver = _FakeResolver()
+        self.resolver = CachingResolver(self.fake_resolver,
+                                        ttl=60.0,
+                                        negative_ttl=5.0)
+
+    def _lookup(self):
+        results = list()
+        deferred = self.resolver.getHostByName(_name)
+        deferred.addBoth(results.append)
+        return results
+
+    def test_ttl_expiry(self):
+        results = self._lookup()
+        self.fake_resolver.answer(_address)
+        self.assertEqual(results, [_address, ])
+
+        self.clock.advance(59.0)
+        self.assertEqual(self._lookup(), [_address, ])
+        self.assertEqual(len(self.fake_resolver.lookups), 1)
+
+        self.clock.advance(1.0)
+        results = self._lookup()
+        self.assertEqual(results, [])
+        self.assertEqual(len(self.fake_resolver.lookups), 2)
+        self.fake_resolver.answer("10.0.0.2")
+        self.assertEqual(results, ["10.0.0.2", ])
+
+    def test_failure(self):
+        results = self._lookup()
+        self.fake_resolver.fail()
+        self.assertEqual(len(results), 1)
+        results[0].trap(DNSLookupError)
+
+    def test_negative_caching(self):
+        self._lookup()
+        self.fake_resolver.fail()
+
+        self.clock.advance(4.0)
+        results = self._lookup()
+        results[0].trap(DNSLookupError)
+        self.assertEqual(len(self.fake_resolver.lookups), 1)
+
+        self.clock.advance(1.0)
+        results = self._lookup()
+        self.assertEqual(len(self.fake_resolver.lookups), 2)
+        self.fake_resolver.answer(_address)
+        self.assertEqual(results, [_address, ])
+
+    def test_no_negative_caching(self):
+        self.resolver.configure(negative_ttl=0)
+        self._lookup()
+        self.fake_resolver.fail()
+        self._lookup()
+        self.assertEqual(len(self.fake_resolver.lookups), 2)
+        self.fake_resolver.answer(_address)
+
+    def test_shared_lookup(self):
+        first = self._lookup()
+        second = self._lookup()
+        self.assertEqual(len(self.fake_resolver.lookups), 1)
+        self.fake_resolver.answer(_address)
+        self.assertEqual(first, [_address, ])
+        self.assertEqual(second, [_address, ])
+
+    def test_shared_lookup_failure(self):
+        first = self._lookup()
+        second = self._lookup()
+        self.assertEqual(len(self.fake_resolver.lookups), 1)
+        self.fake_resolver.fail()
+        first[0].trap(DNSLookupError)
+        second[0].trap(DNSLookupError)
+
+    def test_configure(self):
+        self.resolver.configure(ttl=10.0)
+        self._lookup()
+        self.fake_resolver.answer(_address)
+        self.clock.advance(10.0)
+        self._lookup()
+        self.assertEqual(len(self.fake_resolver.lookups), 2)
+        self.fake_resolver.answer(_address)
+
+    def test_prefetch(self):
+        results = list()
+        self.resolver.prefetch([_name, "other", _name]).addCallback(
+            results.append)
+        self.assertEqual(len(self.fake_resolver.lookups), 2)
+        for name, deferred in self.fake_resolver.lookups:
+            if name == _name:
+                deferred.callback(_address)
+            else:
+                deferred.errback(DNSLookupError(name))
+        self.assertEqual(results, [{_name : _address, "other" : None}, ])
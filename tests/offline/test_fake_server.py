@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+test_fake_server.py
+
+test that the fake server copes with clients that go away
+"""
+from twisted.internet import reactor, error, task
+
+from twisted_client_for_nimbusio.rest_api import compute_head_path, \
+    compute_retrieve_path
+from twisted_client_for_nimbusio.requester import start_collection_request
+
+from tests.offline.fake_server_case import FakeServerTestCase
+
+class _StoppingConsumer(object):
+    """
+    an IConsumer that gives up on the response at the first data
+    """
+    def __init__(self):
+        self._producer = None
+        self.bytes_read = 0
+
+    def registerProducer(self, producer, _streaming):
+        self._producer = producer
+        producer.addConsumer(self)
+
+    def unregisterProducer(self):
+        pass
+
+    def write(self, data):
+        self.bytes_read += len(data)
+        self._producer.stopProducing()
+
+class TestFakeServer(FakeServerTestCase):
+
+    def test_client_timeout_during_latency(self):
+        """
+        the delayed answer to a client that timed out is not sent
+        """
+        self.server.store_version("key", "data")
+        self.server.latency = 0.3
+        deferred = start_collection_request(None,
+                                            "HEAD",
+                                            self.collection_name,
+                                            compute_head_path("key"),
+                                            first_byte_timeout=0.05)
+        self.assertFailure(deferred, error.TimeoutError)
+
+        def _wait_past_latency(_result):
+            return task.deferLater(reactor, 0.4, lambda: None)
+
+        def _server_still_answers(_result):
+            self.server.latency = 0.0
+            return start_collection_request(None,
+                                            "HEAD",
+                                            self.collection_name,
+                                            compute_head_path("key"))
+
+        deferred.addCallback(_wait_past_latency)
+        deferred.addCallback(_server_still_answers)
+        return deferred
+
+    def test_client_stops_paced_body(self):
+        """
+        the paced writer stops when the client closes the connection
+        """
+        self.server.store_version("key", "x" * 100000)
+        self.server.bytes_per_second = 20000
+        consumer = _StoppingConsumer()
+        deferred = start_collection_request(None,
+                                            "GET",
+                                            self.collection_name,
+                                            compute_retrieve_path("key"),
+                                            response_consumer=consumer)
+
+        def _stopped(_failure):
+            self.assertTrue(consumer.bytes_read < 100000)
+            return task.deferLater(reactor, 0.2, lambda: None)
+
+        deferred.addCallbacks(lambda _result: self.fail("not stopped"),
+                              _stopped)
+        return deferred
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+test_file_range_producer.py
+
+test FileRangeProducer reading ranges of a file, with and without mmap
+"""
+from hashlib import md5
+import mmap
+import os
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from twisted_client_for_nimbusio.file_range_producer import FileRangeProducer
+
+_granularity = mmap.ALLOCATIONGRANULARITY
+_chunk_size = 4096
+
+class _Consumer(object):
+    def __init__(self):
+        self.chunks = list()
+
+    @property
+    def data(self):
+        return "".join(self.chunks)
+
+    def write(self, data):
+        self.chunks.append(data)
+
+class TestFileRangeProducer(unittest.TestCase):
+
+    def setUp(self):
+        self._data = os.urandom(3 * _granularity + 100)
+        self._path = self.mktemp()
+        with open(self._path, "wb") as output_file:
+            output_file.write(self._data)
+
+    @defer.inlineCallbacks
+    def _produce(self, producer, expected):
+        consumer = _Consumer()
+        yield producer.startProducing(consumer)
+        self.assertEqual(consumer.data, expected)
+        self.assertTrue(max([len(chunk) for chunk in consumer.chunks] + [0])
+                        <= _chunk_size)
+        self.assertTrue(producer.is_finished)
+        self.assertEqual(producer.bytes_written, len(expected))
+        self.assertEqual(producer.md5_digest, md5(expected).digest())
+
+    def _producer(self, **kwargs):
+        return FileRangeProducer(self._path,
+                                 chunk_size=_chunk_size,
+                                 hash_in_thread=False,
+                                 **kwargs)
+
+    @defer.inlineCallbacks
+    def test_mid_file_range(self):
+        # an offset that is not a multiple of the mmap granularity
+        offset = _granularity + 17
+        length = _granularity + 50
+        for use_mmap in [False, True, ]:
+            producer = self._producer(offset=offset,
+                                      length=length,
+                                      use_mmap=use_mmap)
+            self.assertEqual(producer.length, length)
+            yield self._produce(producer, self._data[offset:offset + length])
+
+    @defer.inlineCallbacks
+    def test_slicing(self):
+        for use_mmap in [False, True, ]:
+            yield self._produce(self._producer(use_mmap=use_mmap),
+                                self._data)
+            yield self._produce(self._producer(offset=100, use_mmap=use_mmap),
+                                self._data[100:])
+            yield self._produce(self._producer(length=10, use_mmap=use_mmap),
+                                self._data[:10])
+            yield self._produce(self._producer(offset=len(self._data),
+                                               use_mmap=use_mmap),
+                                "")
+
+    def test_range_beyond_end_of_file(self):
+        self.assertRaises(AssertionError, self._producer,
+                          offset=len(self._data) - 10, length=11)
+
+    @defer.inlineCallbacks
+    def test_reset(self):
+        offset = 1000
+        length = 2 * _granularity
+        expected = self._data[offset:offset + length]
+        for use_mmap in [False, True, ]:
+            producer = self._producer(offset=offset,
+                                      length=length,
+                                      use_mmap=use_mmap)
+            yield self._produce(producer, expected)
+            # the file was closed when the range was finished
+            producer.reset()
+            self.assertFalse(producer.is_finished)
+            self.assertEqual(producer.bytes_written, 0)
+            yield self._produce(producer, expected)
+
+    @defer.inlineCallbacks
+    def test_open_file_source(self):
+        with open(self._path, "rb") as source_file:
+            producer = FileRangeProducer(source_file,
+                                         offset=10,
+                                         length=100,
+                                         hash_in_thread=False)
+            yield self._produce(producer, self._data[10:110])
+            # a file object is left open for the caller
+            self.assertFalse(source_file.closed)
+
+    @defer.inlineCallbacks
+    def test_hash_in_thread(self):
+        producer = FileRangeProducer(self._path, hash_in_thread=True)
+        consumer = _Consumer()
+        yield producer.startProducing(consumer)
+        digest = yield producer.wait_for_digest()
+        self.assertEqual(digest, md5(self._data).digest())
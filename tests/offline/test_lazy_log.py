@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+test_lazy_log.py
+
+test that log_debug logs by default, and only suppresses on request
+"""
+import logging
+
+from twisted.python import log
+from twisted.trial import unittest
+
+from twisted_client_for_nimbusio import lazy_log
+
+class _Formatted(object):
+    """
+    count the times it is formatted into a message
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __str__(self):
+        self.count += 1
+        return "formatted"
+
+class TestLazyLog(unittest.TestCase):
+
+    def setUp(self):
+        self.events = list()
+        log.addObserver(self.events.append)
+        self.addCleanup(log.removeObserver, self.events.append)
+        self.addCleanup(lazy_log.set_log_level, lazy_log._log_level)
+        self.addCleanup(lazy_log.set_trace_sample_rate,
+                        lazy_log._trace_sample_rate)
+
+    def _messages(self):
+        return ["".join(event["message"]) for event in self.events]
+
+    def test_logged_by_default(self):
+        lazy_log.set_log_level(None)
+        lazy_log.log_debug("debug %s", "message")
+        self.assertEqual(self._messages(), ["debug message", ])
+        self.assertEqual(self.events[0]["logLevel"], logging.DEBUG)
+
+    def test_suppressed_below_level(self):
+        lazy_log.set_log_level(logging.INFO)
+        formatted = _Formatted()
+        lazy_log.log_debug("debug %s", formatted)
+        self.assertEqual(self._messages(), [])
+        # not even formatted
+        self.assertEqual(formatted.count, 0)
+
+        lazy_log.set_log_level(logging.DEBUG)
+        lazy_log.log_debug("debug %s", formatted)
+        self.assertEqual(self._messages(), ["debug formatted", ])
+
+    def test_parse_level(self):
+        self.assertEqual(lazy_log._parse_level(None), None)
+        self.assertEqual(lazy_log._parse_level(""), None)
+        self.assertEqual(lazy_log._parse_level("info"), logging.INFO)
+        self.assertEqual(lazy_log._parse_level("10"), logging.DEBUG)
+
+    def test_trace_sampled(self):
+        lazy_log.set_log_level(None)
+        lazy_log.trace("chunk %s", 0)
+        self.assertEqual(self._messages(), [])
+
+        lazy_log.set_trace_sample_rate(3)
+        for index in range(7):
+            lazy_log.trace("chunk %s", index)
+        self.assertEqual(self._messages(), ["chunk 2", "chunk 5", ])
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+test_listing.py
+
+test Listing and ShardedListing against the fake server
+"""
+from twisted.internet import defer
+
+from twisted_client_for_nimbusio.listing import list_keys, list_versions, \
+    list_keys_sharded, \
+    compute_shard_boundaries
+
+from tests.offline.fake_server_case import FakeServerTestCase
+
+class TestListing(FakeServerTestCase):
+
+    def _store_keys(self, count, versions=1):
+        keys = ["key-%05d" % (index, ) for index in range(count)]
+        for key in keys:
+            for _ in range(versions):
+                self.server.store_version(key, "data")
+        return keys
+
+    @defer.inlineCallbacks
+    def _pages(self, listing):
+        pages = list()
+        while True:
+            entries = yield listing.next_page()
+            if entries is None:
+                break
+            pages.append(entries)
+        defer.returnValue(pages)
+
+    @defer.inlineCallbacks
+    def test_keys_in_pages(self):
+        keys = self._store_keys(25)
+        listing = list_keys(None, self.collection_name, page_size=10)
+        pages = yield self._pages(listing)
+
+        self.assertEqual([len(entries) for entries in pages], [10, 10, 5, ])
+        self.assertEqual([entry["key"] for entries in pages
+                          for entry in entries], keys)
+        self.assertEqual(listing.page_count, 3)
+        self.assertEqual(listing.entry_count, 25)
+        self.assertTrue(listing.is_finished)
+        self.assertEqual(self.server.request_count, 3)
+
+    @defer.inlineCallbacks
+    def test_versions_in_pages(self):
+        """
+        pages of versions may end between two versions of a key
+        """
+        keys = self._store_keys(7, versions=3)
+        listing = list_versions(None, self.collection_name, page_size=4)
+        entries = list()
+        count = yield listing.for_each(entries.append)
+
+        self.assertEqual(count, 21)
+        self.assertEqual(listing.page_count, 6)
+        expected = [(key, version["version_identifier"], )
+                    for key in keys for version in self.server.keys[key]]
+        self.assertEqual([(entry["key"], entry["version_identifier"], )
+                          for entry in entries], expected)
+
+    @defer.inlineCallbacks
+    def test_prefix(self):
+        self._store_keys(5)
+        self.server.store_version("other-key", "data")
+        listing = list_keys(None, self.collection_name, prefix="other",
+                            page_size=2)
+        pages = yield self._pages(listing)
+        self.assertEqual(len(pages), 1)
+        self.assertEqual([entry["key"] for entry in pages[0]],
+                         ["other-key", ])
+
+    @defer.inlineCallbacks
+    def test_exact_page_boundary(self):
+        """
+        a listing that fills its last page exactly ends there, without
+        asking for another page
+        """
+        keys = self._store_keys(20)
+        listing = list_keys(None, self.collection_name, page_size=10)
+        pages = yield self._pages(listing)
+
+        self.assertEqual([len(entries) for entries in pages], [10, 10, ])
+        self.assertEqual([entry["key"] for entries in pages
+                          for entry in entries], keys)
+        self.assertEqual(self.server.request_count, 2)
+
+    @defer.inlineCallbacks
+    def test_truncated_at_exact_page_boundary(self):
+        """
+        a server that reports the last full page as truncated is asked for
+        one more, empty, page, and the listing ends there
+        """
+        self.server.truncate_full_pages = True
+        keys = self._store_keys(20)
+        listing = list_keys(None, self.collection_name, page_size=10)
+        entries = list()
+        count = yield listing.for_each(entries.append)
+
+        self.assertEqual(count, 20)
+        self.assertEqual([entry["key"] for entry in entries], keys)
+        self.assertEqual(listing.page_count, 3)
+        self.assertTrue(listing.is_finished)
+        self.assertEqual(self.server.request_count, 3)
+
+    @defer.inlineCallbacks
+    def test_empty_collection(self):
+        listing = list_keys(None, self.collection_name, page_size=10)
+        pages = yield self._pages(listing)
+        self.assertEqual(pages, [[], ])
+        self.assertTrue(listing.is_finished)
+
+class TestShardedListing(FakeServerTestCase):
+
+    def _store_keys(self, count):
+        # spread the keys over every shard
+        boundaries = compute_shard_boundaries(4)
+        first_characters = ["0", ] + boundaries
+        keys = list()
+        for index in range(count):
+            key = "%s-%05d" % (first_characters[index % 4], index, )
+            self.server.store_version(key, "data")
+            keys.append(key)
+        return sorted(keys)
+
+    def test_sharded_listing_in_order(self):
+        keys = self._store_keys(310)
+        listing = list_keys_sharded(None,
+                                    self.collection_name,
+                                    shard_count=4,
+                                    page_size=10)
+        entries = list()
+        deferred = listing.for_each(entries.append)
+
+        def _check(count):
+            self.assertEqual(count, len(keys))
+            self.assertEqual([entry["key"] for entry in entries], keys)
+            self.assertEqual(listing.shard_count, 4)
+
+        deferred.addCallback(_check)
+        return deferred
+
+    def test_bounded_shards_do_not_prefetch(self):
+        """
+        a shard stops at its upper bound without asking for a page past it
+        """
+        self._store_keys(310)
+        listing = list_keys_sharded(None,
+                                    self.collection_name,
+                                    shard_count=4,
+                                    page_size=10)
+        deferred = listing.for_each(lambda _entry: None)
+
+        def _check(_count):
+            # the 31 pages of keys, plus at most one page for each of the
+            # 3 bounded shards that runs into the next shard
+            self.assertTrue(self.server.request_count <= 31 + 3,
+                            self.server.request_count)
+
+        deferred.addCallback(_check)
+        return deferred
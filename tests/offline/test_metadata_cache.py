@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+test_metadata_cache.py
+
+test MetadataCache, and reading HEAD results
+"""
+import base64
+from hashlib import md5
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from twisted_client_for_nimbusio import metadata_cache
+from twisted_client_for_nimbusio.metadata_cache import MetadataCache, \
+    md5_digest_from_headers, \
+    content_length_from_headers
+
+from tests.offline.fake_server_case import FakeServerTestCase
+
+_collection_name = "test-collection"
+_headers = {"Content-Length" : ["4", ]}
+
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        # the cache reads the time from the reactor
+        self.clock = task.Clock()
+        self.patch(metadata_cache, "reactor", self.clock)
+
+    def test_get_put(self):
+        cache = MetadataCache()
+        self.assertEqual(cache.get(_collection_name, "key"), None)
+        cache.put(_collection_name, "key", _headers)
+        self.assertEqual(cache.get(_collection_name, "key"), _headers)
+        self.assertEqual(cache.get(_collection_name, "key", "version"), None)
+        self.assertEqual((cache.hits, cache.misses, ), (1, 2, ))
+
+        # the caller gets a copy
+        cache.get(_collection_name, "key")["Content-Length"] = ["5", ]
+        self.assertEqual(cache.get(_collection_name, "key"), _headers)
+
+    def test_ttl(self):
+        cache = MetadataCache(ttl=10.0)
+        cache.put(_collection_name, "key", _headers)
+        self.clock.advance(9.9)
+        self.assertEqual(cache.get(_collection_name, "key"), _headers)
+        self.clock.advance(0.1)
+        self.assertEqual(cache.get(_collection_name, "key"), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_no_ttl(self):
+        cache = MetadataCache(ttl=None)
+        cache.put(_collection_name, "key", _headers)
+        self.clock.advance(365 * 24 * 3600.0)
+        self.assertEqual(cache.get(_collection_name, "key"), _headers)
+
+    def test_put_restarts_ttl(self):
+        cache = MetadataCache(ttl=10.0)
+        cache.put(_collection_name, "key", _headers)
+        self.clock.advance(6.0)
+        cache.put(_collection_name, "key", _headers)
+        self.clock.advance(6.0)
+        self.assertEqual(cache.get(_collection_name, "key"), _headers)
+
+    def test_least_recently_used_evicted(self):
+        cache = MetadataCache(max_entries=2)
+        cache.put(_collection_name, "key-a", _headers)
+        cache.put(_collection_name, "key-b", _headers)
+        cache.get(_collection_name, "key-a")
+        cache.put(_collection_name, "key-c", _headers)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(_collection_name, "key-b"), None)
+        self.assertEqual(cache.get(_collection_name, "key-a"), _headers)
+        self.assertEqual(cache.get(_collection_name, "key-c"), _headers)
+
+    def test_invalidate(self):
+        cache = MetadataCache()
+        cache.put(_collection_name, "key", _headers)
+        cache.put(_collection_name, "key", _headers, version_id="v1")
+        cache.put(_collection_name, "other-key", _headers)
+        cache.put("other-collection", "key", _headers)
+
+        cache.invalidate(_collection_name, "key")
+        self.assertEqual(cache.get(_collection_name, "key"), None)
+        self.assertEqual(cache.get(_collection_name, "key", "v1"), None)
+        self.assertEqual(cache.get(_collection_name, "other-key"), _headers)
+        self.assertEqual(cache.get("other-collection", "key"), _headers)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_record_archive(self):
+        cache = MetadataCache()
+        cache.put(_collection_name, "key", {"Content-Length" : ["1", ]},
+                  version_id="v1")
+        digest = md5("data").digest()
+        cache.record_archive(_collection_name, "key",
+                             {"version_identifier" : "v2"},
+                             length=4, md5_digest=digest, latest=True)
+
+        self.assertEqual(cache.get(_collection_name, "key", "v1"), None)
+        for version_id in ["v2", None, ]:
+            headers = cache.get(_collection_name, "key", version_id)
+            self.assertEqual(content_length_from_headers(headers), 4)
+            self.assertEqual(md5_digest_from_headers(headers), digest)
+
+    def test_record_archive_without_length(self):
+        """
+        an archive of unknown length only drops the cached versions
+        """
+        cache = MetadataCache()
+        cache.put(_collection_name, "key", _headers)
+        cache.record_archive(_collection_name, "key",
+                             {"version_identifier" : "v2"}, latest=True)
+        self.assertEqual(len(cache), 0)
+
+class TestMetadataCacheHead(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.clock = task.Clock()
+        self.patch(metadata_cache, "reactor", self.clock)
+        self.server.store_version("key", "data")
+
+    @defer.inlineCallbacks
+    def test_head(self):
+        cache = MetadataCache(ttl=10.0)
+        headers = yield cache.head(None, self.collection_name, "key")
+        self.assertEqual(content_length_from_headers(headers), 4)
+        self.assertEqual(self.server.request_count, 1)
+
+        yield cache.head(None, self.collection_name, "key")
+        self.assertEqual(self.server.request_count, 1)
+
+        self.clock.advance(10.0)
+        yield cache.head(None, self.collection_name, "key")
+        self.assertEqual(self.server.request_count, 2)
+
+class TestHeaders(unittest.TestCase):
+
+    def test_content_length(self):
+        self.assertEqual(
+            content_length_from_headers({"Content-Length" : ["1234", ]}),
+            1234)
+        self.assertEqual(
+            content_length_from_headers({"content-length" : ["0", ]}), 0)
+        self.assertEqual(content_length_from_headers({}), None)
+
+    def test_md5_digest(self):
+        digest = md5("data").digest()
+        self.assertEqual(md5_digest_from_headers(
+            {"Content-MD5" : [base64.b64encode(digest), ]}), digest)
+        self.assertEqual(md5_digest_from_headers(
+            {"content-md5" : [digest.encode("hex"), ]}), digest)
+        self.assertEqual(md5_digest_from_headers({}), None)
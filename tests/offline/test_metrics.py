@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+test_metrics.py
+
+test the metrics sinks, and the measurements the requester makes
+"""
+import socket
+
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.web.client import ResponseNeverReceived
+
+from twisted_client_for_nimbusio import metrics
+from twisted_client_for_nimbusio.metrics import InMemoryRegistry, \
+    StatsdSink, \
+    CallbackSink
+from twisted_client_for_nimbusio.rest_api import compute_head_path
+from twisted_client_for_nimbusio.requester import start_collection_request, \
+    NimbusioHTTPStatusError
+from twisted_client_for_nimbusio.retry_policy import RetryPolicy
+
+from tests.fake_nimbusio_server import DROP_CONNECTION
+from tests.offline.fake_server_case import FakeServerTestCase
+
+class _FakeSocket(object):
+    """
+    keep what is sent, instead of sending it
+    """
+    def __init__(self, error=None):
+        self.sent = list()
+        self._error = error
+
+    def sendto(self, line, address):
+        if self._error is not None:
+            raise self._error
+        self.sent.append((line, address, ))
+
+    def close(self):
+        pass
+
+class TestInMemoryRegistry(unittest.TestCase):
+
+    def test_counters_and_gauges(self):
+        registry = InMemoryRegistry()
+        registry.increment("requests", tags={"method" : "GET"})
+        registry.increment("requests", 2, tags={"method" : "GET"})
+        registry.increment("requests", tags={"method" : "HEAD"})
+        registry.gauge("requests_in_flight", 3)
+        registry.gauge("requests_in_flight", 1)
+        self.assertEqual(registry.counter("requests",
+                                          tags={"method" : "GET"}), 3)
+        self.assertEqual(registry.counter("requests",
+                                          tags={"method" : "HEAD"}), 1)
+        self.assertEqual(registry.counter("requests"), 0)
+        self.assertEqual(registry.gauge_value("requests_in_flight"), 1)
+
+        registry.clear()
+        self.assertEqual(registry.counter("requests",
+                                          tags={"method" : "GET"}), 0)
+        self.assertEqual(registry.gauge_value("requests_in_flight"), None)
+
+    def test_percentiles(self):
+        registry = InMemoryRegistry()
+        self.assertEqual(registry.percentile("request.total", 50), None)
+        for value in reversed(range(101)):
+            registry.timing("request.total", float(value))
+        self.assertEqual(registry.percentile("request.total", 0), 0.0)
+        self.assertEqual(registry.percentile("request.total", 50), 50.0)
+        self.assertEqual(registry.percentile("request.total", 99), 99.0)
+        self.assertEqual(registry.percentile("request.total", 100), 100.0)
+
+        timing = registry.snapshot()["timings"]["request.total"]
+        self.assertEqual(timing["count"], 101)
+        self.assertEqual(timing["min"], 0.0)
+        self.assertEqual(timing["max"], 100.0)
+        self.assertEqual(timing["mean"], 50.0)
+        self.assertEqual((timing["p50"], timing["p99"], ), (50.0, 99.0, ))
+
+    def test_percentiles_of_recent_samples(self):
+        registry = InMemoryRegistry(max_samples=10)
+        for value in range(20):
+            registry.timing("request.total", float(value))
+        self.assertEqual(registry.percentile("request.total", 0), 10.0)
+        self.assertEqual(registry.percentile("request.total", 100), 19.0)
+        # the totals cover every sample
+        timing = registry.snapshot()["timings"]["request.total"]
+        self.assertEqual((timing["count"], timing["min"], ), (20, 0.0, ))
+
+class TestStatsdSink(unittest.TestCase):
+
+    def _sink(self, **kwargs):
+        sink = StatsdSink(**kwargs)
+        sink.close()
+        sink._socket = _FakeSocket()
+        return sink
+
+    def test_line_format(self):
+        sink = self._sink(host="10.0.0.1", port=8125)
+        sink.increment("requests", tags={"status" : 200, "method" : "GET"})
+        sink.gauge("requests_in_flight", 4)
+        sink.timing("request.total", 0.25)
+        self.assertEqual(sink._socket.sent,
+                         [("nimbusio.requests.GET.200:1|c",
+                           ("10.0.0.1", 8125, ), ),
+                          ("nimbusio.requests_in_flight:4|g",
+                           ("10.0.0.1", 8125, ), ),
+                          ("nimbusio.request.total:250.000|ms",
+                           ("10.0.0.1", 8125, ), ), ])
+
+    def test_no_prefix(self):
+        sink = self._sink(prefix="")
+        sink.increment("bytes_sent", 10)
+        self.assertEqual(sink._socket.sent[0][0], "bytes_sent:10|c")
+
+    def test_send_errors_ignored(self):
+        sink = self._sink()
+        sink._socket = _FakeSocket(error=socket.error("unreachable"))
+        sink.increment("requests")
+
+class TestCallbackSink(unittest.TestCase):
+
+    def test_callback(self):
+        measurements = list()
+        sink = CallbackSink(lambda *args: measurements.append(args))
+        sink.increment("requests", tags={"method" : "GET"})
+        sink.gauge("requests_in_flight", 2)
+        sink.timing("request.total", 0.5)
+        self.assertEqual(measurements,
+                         [("counter", "requests", 1, {"method" : "GET"}, ),
+                          ("gauge", "requests_in_flight", 2, None, ),
+                          ("timing", "request.total", 0.5, None, ), ])
+
+class TestRequestMetrics(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.server.store_version("key", "data")
+        self.registry = InMemoryRegistry()
+        metrics.set_metrics_sink(self.registry)
+        self.addCleanup(metrics.set_metrics_sink, None)
+
+    def _head(self, retry_policy=None):
+        return start_collection_request(None,
+                                        "HEAD",
+                                        self.collection_name,
+                                        compute_head_path("key"),
+                                        retry_policy=retry_policy)
+
+    def _requests(self, status):
+        return self.registry.counter("requests",
+                                     tags={"method" : "HEAD",
+                                           "status" : status})
+
+    def _timing_count(self, name):
+        return self.registry.snapshot()["timings"][name]["count"]
+
+    @defer.inlineCallbacks
+    def test_request(self):
+        yield self._head()
+        self.assertEqual(self._requests(200), 1)
+        self.assertEqual(self._timing_count("request.first_byte"), 1)
+        self.assertEqual(self._timing_count("request.total"), 1)
+        self.assertEqual(self.registry.gauge_value("requests_in_flight"), 0)
+
+    @defer.inlineCallbacks
+    def test_retried_request(self):
+        self.server.fail_next(2)
+        yield self._head(RetryPolicy(initial_delay=0.01, jitter=0.0,
+                                     max_retries=3))
+        # one request, with a response to each of its three attempts
+        self.assertEqual(self._requests(200), 1)
+        self.assertEqual(self._requests(503), 0)
+        self.assertEqual(self._timing_count("request.first_byte"), 3)
+        self.assertEqual(self._timing_count("request.total"), 1)
+        self.assertEqual(self.registry.gauge_value("requests_in_flight"), 0)
+
+    @defer.inlineCallbacks
+    def test_error_status(self):
+        self.server.fail_next(1)
+        yield self.assertFailure(self._head(), NimbusioHTTPStatusError)
+        self.assertEqual(self._requests(503), 1)
+        self.assertEqual(self.registry.gauge_value("requests_in_flight"), 0)
+
+    @defer.inlineCallbacks
+    def test_dropped_connection(self):
+        self.server.fail_next(1, DROP_CONNECTION)
+        yield self.assertFailure(self._head(), ResponseNeverReceived)
+        self.assertEqual(self._requests("error"), 1)
+        self.assertEqual(self._timing_count("request.total"), 1)
+        self.assertNotIn("request.first_byte",
+                         self.registry.snapshot()["timings"])
+        self.assertEqual(self.registry.gauge_value("requests_in_flight"), 0)
+
+    @defer.inlineCallbacks
+    def test_in_flight(self):
+        self.server.latency = 0.05
+        deferreds = [self._head() for _ in range(3)]
+        self.assertEqual(self.registry.gauge_value("requests_in_flight"), 3)
+        yield defer.DeferredList(deferreds, fireOnOneErrback=True)
+        self.assertEqual(self.registry.gauge_value("requests_in_flight"), 0)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+test_range_downloader.py
+
+test RangeDownloader against the fake server
+"""
+import os
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from twisted_client_for_nimbusio import range_downloader
+from twisted_client_for_nimbusio.range_downloader import RangeDownloader, \
+    RangeOverrunError, \
+    _OffsetConsumer
+from twisted_client_for_nimbusio.metadata_cache import MetadataCache
+
+from tests.fake_nimbusio_server import DROP_MID_BODY
+from tests.offline.fake_server_case import FakeServerTestCase
+
+_key = "range-key"
+_segment_size = 64 * 1024
+
+class _Producer(object):
+    def __init__(self):
+        self.stopped = False
+
+    def addConsumer(self, _consumer):
+        pass
+
+    def stopProducing(self):
+        self.stopped = True
+
+class TestOffsetConsumer(unittest.TestCase):
+
+    def test_overrun(self):
+        destination = open(self.mktemp(), "w+b")
+        self.addCleanup(destination.close)
+        producer = _Producer()
+        consumer = _OffsetConsumer(destination, 2, 4)
+        consumer.registerProducer(producer, True)
+
+        consumer.write("ab")
+        consumer.write("cde")
+        self.assertTrue(producer.stopped)
+        self.assertEqual(consumer.overrun, 1)
+        consumer.write("f")
+        self.assertEqual(consumer.overrun, 2)
+
+        # nothing beyond the range is written
+        self.assertEqual(consumer.bytes_written, 2)
+        destination.seek(0)
+        self.assertEqual(destination.read(), "\0\0ab")
+
+class TestRangeDownloader(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.patch(range_downloader, "_range_retry_delay", 0.01)
+        self._data = os.urandom(5 * _segment_size + 1000)
+        self.server.store_version(_key, self._data)
+        self._path = self.mktemp()
+
+    def _downloader(self, **kwargs):
+        return RangeDownloader(None,
+                               self.collection_name,
+                               _key,
+                               self._path,
+                               segment_size=_segment_size,
+                               concurrency=2,
+                               **kwargs)
+
+    def _downloaded(self):
+        with open(self._path, "rb") as input_file:
+            return input_file.read()
+
+    @defer.inlineCallbacks
+    def test_download(self):
+        downloader = self._downloader()
+        yield downloader.start()
+        self.assertEqual(downloader.length, len(self._data))
+        self.assertEqual(self._downloaded(), self._data)
+        # the HEAD, and six ranges
+        self.assertEqual(self.server.request_count, 7)
+
+    @defer.inlineCallbacks
+    def test_download_mmap(self):
+        yield self._downloader(use_mmap=True).start()
+        self.assertEqual(self._downloaded(), self._data)
+
+    @defer.inlineCallbacks
+    def test_resume_after_dropped_connection(self):
+        # the size comes from the cache, so the first request is a range
+        metadata_cache = MetadataCache()
+        metadata_cache.put(self.collection_name, _key,
+                           {"Content-Length" : [str(len(self._data)), ]})
+        self.server.fail_next(1, DROP_MID_BODY)
+        yield self._downloader(metadata_cache=metadata_cache).start()
+        self.assertEqual(self._downloaded(), self._data)
+        # six ranges, one of them resumed
+        self.assertEqual(self.server.request_count, 7)
+
+    @defer.inlineCallbacks
+    def test_overrun_fails_without_retry(self):
+        self.server.ignore_ranges = True
+        downloader = RangeDownloader(None,
+                                     self.collection_name,
+                                     _key,
+                                     self._path,
+                                     segment_size=_segment_size,
+                                     concurrency=1)
+        yield self.assertFailure(downloader.start(), RangeOverrunError)
+        # the HEAD, and the first range; the rest are skipped
+        self.assertEqual(self.server.request_count, 2)
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+test_rate_limit.py
+
+test the token buckets and the throttled producers, with a task.Clock
+for the reactor
+"""
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twisted.web.client import ResponseDone
+
+from twisted_client_for_nimbusio import rate_limit
+from twisted_client_for_nimbusio import response_producer_protocol
+from twisted_client_for_nimbusio.rate_limit import TokenBucket, Throttle, \
+    ThrottledBodyProducer, \
+    get_throttle, \
+    set_rate_limit, \
+    get_rate_limit, \
+    UPLOAD, \
+    DOWNLOAD
+from twisted_client_for_nimbusio.requester import \
+    register_collection_hostname
+from twisted_client_for_nimbusio.response_producer_protocol import \
+    ResponseProducerProtocol
+
+_collection_name = "rate-limit-test-collection"
+
+class _BodyProducer(object):
+    """
+    a body producer that writes what it is told to, and records whether
+    it is paused
+    """
+    length = 1000
+
+    def __init__(self):
+        self.consumer = None
+        self.paused = False
+        self.pause_count = 0
+        self.finished = defer.Deferred()
+
+    def startProducing(self, consumer):
+        self.consumer = consumer
+        return self.finished
+
+    def pauseProducing(self):
+        self.paused = True
+        self.pause_count += 1
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def stopProducing(self):
+        pass
+
+class _Consumer(object):
+
+    def __init__(self):
+        self.data = list()
+
+    def registerProducer(self, producer, _streaming):
+        producer.addConsumer(self)
+
+    def unregisterProducer(self):
+        pass
+
+    def write(self, data):
+        self.data.append(data)
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(rate_limit, "reactor", self.clock)
+
+    def test_no_limit(self):
+        bucket = TokenBucket()
+        self.assertEqual(bucket.consume(10 ** 9), 0.0)
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(1000.0)
+        # a new bucket is full: one second's worth
+        self.assertEqual(bucket.consume(1000), 0.0)
+        self.assertEqual(bucket.consume(500), 0.5)
+        self.clock.advance(0.5)
+        self.assertEqual(bucket.consume(0), 0.0)
+        self.clock.advance(1.0)
+        self.assertEqual(bucket.consume(1000), 0.0)
+
+    def test_refill_is_capped(self):
+        bucket = TokenBucket(1000.0, burst=2000)
+        bucket.consume(2000)
+        self.clock.advance(60.0)
+        self.assertEqual(bucket.consume(2000), 0.0)
+        self.assertEqual(bucket.consume(1000), 1.0)
+
+    def test_pacing(self):
+        """
+        a sender that waits as told sends at the rate
+        """
+        bucket = TokenBucket(10000.0, burst=1000)
+        sent = 0
+        while self.clock.seconds() < 10.0:
+            delay = bucket.consume(1000)
+            sent += 1000
+            self.clock.advance(delay)
+        self.assertApproximates(sent / self.clock.seconds(), 10000.0, 200.0)
+
+    def test_set_rate(self):
+        bucket = TokenBucket(1000.0)
+        bucket.consume(1000)
+        bucket.set_rate(100.0)
+        self.assertEqual(bucket.consume(100), 1.0)
+        bucket.set_rate(None)
+        self.assertEqual(bucket.rate, None)
+        self.assertEqual(bucket.consume(10 ** 6), 0.0)
+
+    def test_throttle_waits_for_slowest_bucket(self):
+        throttle = Throttle([TokenBucket(1000.0), TokenBucket(100.0), ])
+        self.assertEqual(throttle.consume(200), 1.0)
+
+class TestThrottles(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(rate_limit, "reactor", self.clock)
+        self.patch(rate_limit, "_host_buckets", dict())
+        register_collection_hostname(_collection_name, "127.0.0.1:1")
+        self.addCleanup(register_collection_hostname, _collection_name, None)
+
+    def test_no_throttle(self):
+        self.assertEqual(get_throttle(UPLOAD, "127.0.0.1:1"), None)
+
+    def test_request_rate(self):
+        throttle = get_throttle(UPLOAD, "127.0.0.1:1", 1000)
+        throttle.consume(1000)
+        self.assertEqual(throttle.consume(500), 0.5)
+
+    def test_collection_rate(self):
+        set_rate_limit(DOWNLOAD, 2000, collection_name=_collection_name)
+        self.assertEqual(get_rate_limit(DOWNLOAD, _collection_name), 2000)
+        self.assertEqual(get_rate_limit(UPLOAD, _collection_name), None)
+        throttle = get_throttle(DOWNLOAD, "127.0.0.1:1")
+        throttle.consume(2000)
+        self.assertEqual(throttle.consume(1000), 0.5)
+
+        # a change applies to the transfers already throttled: the 1000
+        # bytes owed take longer to pay back
+        set_rate_limit(DOWNLOAD, 1000, collection_name=_collection_name)
+        self.assertEqual(throttle.consume(0), 1.0)
+
+class TestThrottledBodyProducer(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(rate_limit, "reactor", self.clock)
+        self.body_producer = _BodyProducer()
+        self.consumer = _Consumer()
+        self.producer = ThrottledBodyProducer(
+            self.body_producer, Throttle([TokenBucket(1000.0), ]))
+        self.producer.startProducing(self.consumer)
+
+    def test_paused_until_refilled(self):
+        self.body_producer.consumer.write("x" * 1500)
+        self.assertEqual(self.consumer.data, ["x" * 1500, ])
+        self.assertTrue(self.body_producer.paused)
+        self.clock.advance(0.4)
+        self.assertTrue(self.body_producer.paused)
+        self.clock.advance(0.1)
+        self.assertFalse(self.body_producer.paused)
+
+    def test_connection_pause_while_throttled(self):
+        """
+        a producer paused by the connection while throttled stays paused
+        until the connection resumes it
+        """
+        self.body_producer.consumer.write("x" * 1500)
+        self.producer.pauseProducing()
+        self.clock.advance(1.0)
+        self.assertTrue(self.body_producer.paused)
+        self.producer.resumeProducing()
+        self.assertFalse(self.body_producer.paused)
+        self.assertEqual(self.body_producer.pause_count, 1)
+
+    def test_resumed_by_connection_while_throttled(self):
+        """
+        the connection resuming the producer does not end the throttle
+        """
+        self.body_producer.consumer.write("x" * 1500)
+        self.producer.pauseProducing()
+        self.producer.resumeProducing()
+        self.assertTrue(self.body_producer.paused)
+        self.clock.advance(0.5)
+        self.assertFalse(self.body_producer.paused)
+
+    def test_finish_cancels_throttle(self):
+        self.body_producer.consumer.write("x" * 1500)
+        self.body_producer.finished.callback(None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+class TestThrottledResponse(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(rate_limit, "reactor", self.clock)
+        self.patch(response_producer_protocol, "reactor", self.clock)
+        self.deferred = defer.Deferred()
+        self.protocol = ResponseProducerProtocol(
+            self.deferred,
+            idle_timeout=5.0,
+            throttle=Throttle([TokenBucket(1000.0), ]))
+        self.consumer = _Consumer()
+        self.consumer.registerProducer(self.protocol, True)
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def test_paused_until_refilled(self):
+        self.protocol.dataReceived("x" * 2000)
+        self.assertEqual(self.transport.producerState, "paused")
+        self.clock.advance(0.9)
+        self.assertEqual(self.transport.producerState, "paused")
+        self.clock.advance(0.1)
+        self.assertEqual(self.transport.producerState, "producing")
+
+        self.protocol.connectionLost(Failure(ResponseDone()))
+        self.assertEqual(self.consumer.data, ["x" * 2000, ])
+        self.assertTrue(self.deferred.called)
+
+    def test_no_idle_timeout_while_throttled(self):
+        self.protocol.dataReceived("x" * 7000)
+        # throttled for 6s, longer than the idle timeout
+        self.clock.advance(5.5)
+        self.assertEqual(self.transport.producerState, "paused")
+        self.assertFalse(self.deferred.called)
+        self.clock.advance(0.5)
+        self.assertEqual(self.transport.producerState, "producing")
+
+    def test_consumer_pause_while_throttled(self):
+        self.protocol.dataReceived("x" * 2000)
+        self.protocol.pauseProducing()
+        self.clock.advance(1.0)
+        self.assertEqual(self.transport.producerState, "paused")
+        self.protocol.resumeProducing()
+        self.assertEqual(self.transport.producerState, "producing")
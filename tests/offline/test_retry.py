@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+test_retry.py
+
+test retrying requests, with errors and dropped connections injected by
+the fake server
+"""
+from cStringIO import StringIO
+import os
+import tempfile
+
+from twisted.internet import reactor, defer, task
+from twisted.web.client import FileBodyProducer, ResponseFailed
+
+from twisted_client_for_nimbusio.rest_api import compute_archive_path, \
+    compute_head_path, \
+    compute_retrieve_path
+from twisted_client_for_nimbusio.requester import start_collection_request, \
+    NimbusioHTTPStatusError
+from twisted_client_for_nimbusio.retry_policy import RetryPolicy
+from twisted_client_for_nimbusio.buffered_consumer import BufferedConsumer
+from twisted_client_for_nimbusio.file_range_producer import FileRangeProducer
+
+from tests.fake_nimbusio_server import DROP_CONNECTION, DROP_MID_BODY
+from tests.offline.fake_server_case import FakeServerTestCase
+
+class _RecordingConsumer(object):
+    """
+    an IConsumer that keeps what it is given, and counts resets. Without
+    resettable, it has no reset method, so it cannot be retried.
+    """
+    def __init__(self, resettable=True):
+        self.chunks = list()
+        self.reset_count = 0
+        if resettable:
+            self.reset = self._reset
+
+    @property
+    def data(self):
+        return "".join(self.chunks)
+
+    def _reset(self):
+        self.chunks = list()
+        self.reset_count += 1
+
+    def registerProducer(self, producer, _streaming):
+        producer.addConsumer(self)
+
+    def unregisterProducer(self):
+        pass
+
+    def write(self, data):
+        self.chunks.append(data)
+
+class TestRetry(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self._data = os.urandom(256 * 1024)
+        self.server.store_version("key", self._data)
+
+    def _policy(self, **kwargs):
+        return RetryPolicy(initial_delay=0.01, jitter=0.0, **kwargs)
+
+    def _head(self, retry_policy):
+        return start_collection_request(None,
+                                        "HEAD",
+                                        self.collection_name,
+                                        compute_head_path("key"),
+                                        retry_policy=retry_policy)
+
+    def _retrieve(self, consumer, retry_policy):
+        return start_collection_request(None,
+                                        "GET",
+                                        self.collection_name,
+                                        compute_retrieve_path("key"),
+                                        response_consumer=consumer,
+                                        retry_policy=retry_policy)
+
+    def _archive(self, body_producer, retry_policy):
+        return start_collection_request(None,
+                                        "POST",
+                                        self.collection_name,
+                                        compute_archive_path("new-key"),
+                                        response_consumer=BufferedConsumer(),
+                                        body_producer=body_producer,
+                                        retry_policy=retry_policy)
+
+    def test_retries_service_unavailable(self):
+        self.server.fail_next(2)
+        retry_policy = self._policy(max_retries=3)
+        deferred = self._head(retry_policy)
+
+        def _check(_headers):
+            self.assertEqual(self.server.request_count, 3)
+            self.assertEqual(retry_policy.retry_count, 2)
+
+        deferred.addCallback(_check)
+        return deferred
+
+    def test_gives_up_after_max_retries(self):
+        self.server.fail_next(5)
+        retry_policy = self._policy(max_retries=2)
+        deferred = self.assertFailure(self._head(retry_policy),
+                                      NimbusioHTTPStatusError)
+
+        def _check(instance):
+            self.assertEqual(instance.status, 503)
+            self.assertEqual(self.server.request_count, 3)
+            self.assertEqual(retry_policy.retry_count, 2)
+
+        deferred.addCallback(_check)
+        return deferred
+
+    def test_no_retry_policy(self):
+        self.server.fail_next(1)
+        deferred = self.assertFailure(self._head(None),
+                                      NimbusioHTTPStatusError)
+        deferred.addCallback(
+            lambda _: self.assertEqual(self.server.request_count, 1))
+        return deferred
+
+    def test_retries_dropped_connection(self):
+        self.server.fail_next(1, DROP_CONNECTION)
+        retry_policy = self._policy()
+        consumer = _RecordingConsumer()
+        deferred = self._retrieve(consumer, retry_policy)
+
+        def _check(_result):
+            self.assertEqual(self.server.request_count, 2)
+            self.assertEqual(retry_policy.retry_count, 1)
+            self.assertEqual(consumer.data, self._data)
+
+        deferred.addCallback(_check)
+        return deferred
+
+    def test_reset_consumer_sees_data_once(self):
+        """
+        a consumer that saw part of the body before the connection dropped
+        is reset, and ends up with the body exactly once
+        """
+        self.server.fail_next(1, DROP_MID_BODY)
+        retry_policy = self._policy()
+        consumer = _RecordingConsumer()
+        deferred = self._retrieve(consumer, retry_policy)
+
+        def _check(_result):
+            self.assertEqual(self.server.request_count, 2)
+            self.assertEqual(retry_policy.retry_count, 1)
+            self.assertEqual(consumer.reset_count, 1)
+            self.assertEqual(consumer.data, self._data)
+
+        deferred.addCallback(_check)
+        return deferred
+
+    def test_consumer_without_reset_not_retried(self):
+        self.server.fail_next(1, DROP_MID_BODY)
+        retry_policy = self._policy()
+        consumer = _RecordingConsumer(resettable=False)
+        deferred = self.assertFailure(self._retrieve(consumer, retry_policy),
+                                      ResponseFailed)
+
+        def _check(_result):
+            self.assertEqual(self.server.request_count, 1)
+            self.assertEqual(retry_policy.retry_count, 0)
+            self.assertTrue(0 < len(consumer.data) < len(self._data))
+
+        deferred.addCallback(_check)
+        return deferred
+
+    def test_body_without_reset_not_retried(self):
+        self.server.fail_next(1)
+        retry_policy = self._policy(retry_non_idempotent=True)
+        body_producer = FileBodyProducer(StringIO(self._data))
+        deferred = self.assertFailure(self._archive(body_producer,
+                                                    retry_policy),
+                                      NimbusioHTTPStatusError)
+
+        def _check(_instance):
+            self.assertEqual(self.server.request_count, 1)
+            self.assertEqual(retry_policy.retry_count, 0)
+            self.assertNotIn("new-key", self.server.keys)
+
+        deferred.addCallback(_check)
+        return deferred
+
+    def test_body_with_reset_retried(self):
+        self.server.fail_next(1)
+        retry_policy = self._policy(retry_non_idempotent=True)
+        source_file = tempfile.TemporaryFile()
+        self.addCleanup(source_file.close)
+        source_file.write(self._data)
+        source_file.flush()
+        deferred = self._archive(FileRangeProducer(source_file),
+                                 retry_policy)
+
+        def _check(_result):
+            self.assertEqual(self.server.request_count, 2)
+            self.assertEqual(retry_policy.retry_count, 1)
+            self.assertEqual(self.server.find_version("new-key")["data"],
+                             self._data)
+
+        deferred.addCallback(_check)
+        return deferred
+
+    @defer.inlineCallbacks
+    def test_cancel_during_retry_delay(self):
+        self.server.fail_next(1)
+        retry_policy = RetryPolicy(initial_delay=0.2, jitter=0.0)
+        deferred = self._head(retry_policy)
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual(retry_policy.retry_count, 1)
+
+        deferred.cancel()
+        yield self.assertFailure(deferred, defer.CancelledError)
+        # the retry never starts
+        yield task.deferLater(reactor, 0.2, lambda: None)
+        self.assertEqual(self.server.request_count, 1)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+test_scheduler.py
+
+test RequestScheduler's limits, priorities and cancellation against the
+fake server
+"""
+from twisted.internet import reactor, defer, task
+
+from twisted_client_for_nimbusio.rest_api import compute_head_path, \
+    compute_retrieve_path
+from twisted_client_for_nimbusio.requester import \
+    register_collection_hostname
+from twisted_client_for_nimbusio.scheduler import RequestScheduler, \
+    collection_request_function, \
+    PRIORITY_BULK
+from twisted_client_for_nimbusio.buffered_consumer import BufferedConsumer
+from twisted_client_for_nimbusio import requester
+
+from tests.fake_nimbusio_server import FakeNimbusioServer
+from tests.offline.fake_server_case import FakeServerTestCase
+
+_other_collection_name = "offline-test-other-collection"
+
+class TestScheduler(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.server.store_version("key", "data")
+        self.server.latency = 0.05
+
+    def _head(self, scheduler, collection_name=None, **kwargs):
+        return scheduler.start_collection_request(
+            None,
+            "HEAD",
+            (collection_name or self.collection_name),
+            compute_head_path("key"),
+            **kwargs)
+
+    def _start_other_server(self):
+        other_server = FakeNimbusioServer(latency=0.05)
+        other_server.start()
+        other_server.register_collection(_other_collection_name)
+        other_server.store_version("key", "data")
+        self.addCleanup(other_server.stop)
+        self.addCleanup(register_collection_hostname,
+                        _other_collection_name, None)
+        return other_server
+
+    def test_per_host_limit(self):
+        scheduler = RequestScheduler(max_in_flight=10,
+                                     max_in_flight_per_host=2)
+        deferreds = [self._head(scheduler) for _ in range(6)]
+        self.assertEqual(scheduler.in_flight, 2)
+        self.assertEqual(scheduler.queue_depth, 4)
+
+        def _check(_results):
+            stats = scheduler.stats()
+            self.assertEqual(stats["in-flight"], 0)
+            self.assertEqual(stats["queue-depth"], 0)
+            self.assertEqual(stats["started"], 6)
+            self.assertTrue(stats["max-wait-time"] > 0.0)
+            self.assertEqual(self.server.request_count, 6)
+
+        deferred = defer.DeferredList(deferreds, fireOnOneErrback=True)
+        deferred.addCallback(_check)
+        return deferred
+
+    def test_global_limit(self):
+        other_server = self._start_other_server()
+        scheduler = RequestScheduler(max_in_flight=3,
+                                     max_in_flight_per_host=2)
+        deferreds = list()
+        for _ in range(3):
+            deferreds.append(self._head(scheduler))
+            deferreds.append(self._head(scheduler, _other_collection_name))
+        self.assertEqual(scheduler.in_flight, 3)
+        self.assertEqual(scheduler.queue_depth, 3)
+        for collection_name in [self.collection_name,
+                                _other_collection_name, ]:
+            hostname = requester.collection_hostname(collection_name)
+            self.assertTrue(scheduler.in_flight_for_host(hostname) <= 2)
+
+        def _check(_results):
+            self.assertEqual(scheduler.in_flight, 0)
+            self.assertEqual(self.server.request_count, 3)
+            self.assertEqual(other_server.request_count, 3)
+
+        deferred = defer.DeferredList(deferreds, fireOnOneErrback=True)
+        deferred.addCallback(_check)
+        return deferred
+
+    def test_priority(self):
+        """
+        queued HEAD requests start before queued retrieves
+        """
+        scheduler = RequestScheduler(max_in_flight=1)
+        started = list()
+        deferreds = list()
+        for method, path in [("GET", compute_retrieve_path("key"), ),
+                             ("GET", compute_retrieve_path("key"), ),
+                             ("HEAD", compute_head_path("key"), ), ]:
+            deferred = scheduler.start_collection_request(
+                None, method, self.collection_name, path)
+            deferred.addCallback(lambda _result, method=method:
+                                 started.append(method))
+            deferreds.append(deferred)
+
+        deferred = defer.DeferredList(deferreds, fireOnOneErrback=True)
+        deferred.addCallback(lambda _results:
+            self.assertEqual(started, ["GET", "HEAD", "GET", ]))
+        return deferred
+
+    def test_cancel_queued_request(self):
+        scheduler = RequestScheduler(max_in_flight=1)
+        first = self._head(scheduler)
+        second = self._head(scheduler)
+        third = self._head(scheduler)
+        self.assertEqual(scheduler.queue_depth, 2)
+
+        second.cancel()
+        self.assertEqual(scheduler.queue_depth, 1)
+        self.assertFailure(second, defer.CancelledError)
+
+        def _check(_results):
+            self.assertEqual(scheduler.queue_depth, 0)
+            self.assertEqual(scheduler.stats()["started"], 2)
+            self.assertEqual(self.server.request_count, 2)
+
+        deferred = defer.DeferredList([first, second, third, ],
+                                      fireOnOneErrback=True)
+        deferred.addCallback(_check)
+        return deferred
+
+    def test_cancel_started_request(self):
+        """
+        cancelling a request already started cancels the request itself,
+        and frees its slot
+        """
+        scheduler = RequestScheduler(max_in_flight=1)
+        first = self._head(scheduler)
+        second = self._head(scheduler)
+        first.cancel()
+        self.assertFailure(first, defer.CancelledError)
+        self.assertEqual(scheduler.in_flight, 1)
+        self.assertEqual(scheduler.queue_depth, 0)
+
+        def _check(_results):
+            self.assertEqual(scheduler.in_flight, 0)
+            self.assertEqual(scheduler.stats()["started"], 2)
+            self.assertEqual(self.server.request_count, 1)
+
+        deferred = defer.DeferredList([first, second, ],
+                                      fireOnOneErrback=True)
+        deferred.addCallback(_check)
+        return deferred
+
+    @defer.inlineCallbacks
+    def test_cancel_response_in_progress(self):
+        """
+        cancelling a request whose response is arriving closes its
+        connection
+        """
+        self.server.latency = 0.0
+        self.server.store_version("key", "x" * (64 * 1024))
+        self.server.bytes_per_second = 64 * 1024
+        scheduler = RequestScheduler()
+        consumer = BufferedConsumer()
+        deferred = scheduler.start_collection_request(
+            None, "GET", self.collection_name, compute_retrieve_path("key"),
+            response_consumer=consumer)
+        yield task.deferLater(reactor, 0.2, lambda: None)
+        self.assertTrue(0 < len(consumer.buffer) < 64 * 1024)
+
+        deferred.cancel()
+        yield self.assertFailure(deferred, defer.CancelledError)
+        self.assertEqual(scheduler.in_flight, 0)
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual(self.server.open_connections, 0)
+
+    def test_positional_arguments(self):
+        """
+        positional arguments after path are passed on in the order of
+        requester.start_request, and priority is keyword only
+        """
+        scheduler = RequestScheduler()
+        consumer = BufferedConsumer()
+        deferred = scheduler.start_collection_request(
+            None, "GET", self.collection_name, compute_retrieve_path("key"),
+            consumer, priority=PRIORITY_BULK)
+        deferred.addCallback(
+            lambda _result: self.assertEqual(consumer.buffer, "data"))
+        return deferred
+
+    def test_collection_request_function(self):
+        scheduler = RequestScheduler()
+        self.assertEqual(collection_request_function(scheduler),
+                         scheduler.start_collection_request)
+        self.assertIdentical(collection_request_function(None),
+                             requester.start_collection_request)
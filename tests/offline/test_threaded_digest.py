@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+test_threaded_digest.py
+
+test ThreadedDigest
+"""
+from hashlib import md5
+
+from twisted.trial import unittest
+
+from twisted_client_for_nimbusio.threaded_digest import ThreadedDigest, \
+    DigestPendingError
+
+class TestThreadedDigest(unittest.TestCase):
+
+    def test_digest(self):
+        chunks = ["a" * 1024 * 1024, "b" * 1024, "c", ]
+        digest = ThreadedDigest()
+        for data in chunks:
+            digest.update(data)
+        self.assertRaises(DigestPendingError, digest.digest)
+        self.assertRaises(DigestPendingError, digest.hexdigest)
+
+        expected = md5("".join(chunks))
+        deferred = digest.wait_for_digest()
+
+        def _check(result):
+            self.assertEqual(result, expected.digest())
+            self.assertEqual(digest.digest(), expected.digest())
+            self.assertEqual(digest.hexdigest(), expected.hexdigest())
+
+        deferred.addCallback(_check)
+        return deferred
+
+    def test_failure_is_kept(self):
+        digest = ThreadedDigest()
+        # hashlib will not hash None
+        digest.update(None)
+        deferred = self.assertFailure(digest.wait_for_digest(), TypeError)
+
+        def _check(_result):
+            digest.update("more")
+            self.assertTrue(digest.is_idle)
+            self.assertRaises(TypeError, digest.digest)
+            return self.assertFailure(digest.wait_for_digest(), TypeError)
+
+        deferred.addCallback(_check)
+        return deferred
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+test_timeouts.py
+
+test the first byte and idle timeouts of requests against a slow, or
+stalled, fake server
+"""
+from cStringIO import StringIO
+import os
+
+from twisted.internet import reactor, error
+from twisted.web.client import FileBodyProducer
+
+from twisted_client_for_nimbusio.rest_api import compute_archive_path, \
+    compute_retrieve_path
+from twisted_client_for_nimbusio.requester import start_collection_request
+from twisted_client_for_nimbusio.buffered_consumer import BufferedConsumer
+
+from tests.fake_nimbusio_server import STALL_MID_BODY
+from tests.offline.fake_server_case import FakeServerTestCase
+
+class _PausingConsumer(BufferedConsumer):
+    """
+    a BufferedConsumer that pauses its producer at the first write, and
+    resumes it after pause_time
+    """
+    def __init__(self, pause_time):
+        BufferedConsumer.__init__(self)
+        self._pause_time = pause_time
+        self._producer = None
+        self.pause_count = 0
+
+    def registerProducer(self, producer, streaming):
+        self._producer = producer
+        BufferedConsumer.registerProducer(self, producer, streaming)
+
+    def write(self, data):
+        BufferedConsumer.write(self, data)
+        if self.pause_count == 0:
+            self.pause_count += 1
+            self._producer.pauseProducing()
+            reactor.callLater(self._pause_time,
+                              self._producer.resumeProducing)
+
+class TestTimeouts(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self._data = os.urandom(1024 * 1024)
+        self.server.store_version("key", self._data)
+
+    def _retrieve(self, consumer, **kwargs):
+        return start_collection_request(None,
+                                        "GET",
+                                        self.collection_name,
+                                        compute_retrieve_path("key"),
+                                        response_consumer=consumer,
+                                        **kwargs)
+
+    def test_first_byte_timeout(self):
+        self.server.latency = 0.3
+        consumer = BufferedConsumer()
+        deferred = self.assertFailure(
+            self._retrieve(consumer, first_byte_timeout=0.05),
+            error.TimeoutError)
+        deferred.addCallback(lambda _: self.assertEqual(consumer.length, 0))
+        return deferred
+
+    def test_first_byte_timeout_after_upload(self):
+        """
+        the first byte timer starts when the body has been sent
+        """
+        self.server.latency = 0.3
+        body_producer = FileBodyProducer(StringIO(self._data))
+        deferred = start_collection_request(None,
+                                            "POST",
+                                            self.collection_name,
+                                            compute_archive_path("new-key"),
+                                            response_consumer=
+                                                BufferedConsumer(),
+                                            body_producer=body_producer,
+                                            first_byte_timeout=0.05)
+        return self.assertFailure(deferred, error.TimeoutError)
+
+    def test_idle_timeout(self):
+        self.server.fail_next(1, STALL_MID_BODY)
+        consumer = BufferedConsumer()
+        deferred = self.assertFailure(
+            self._retrieve(consumer, idle_timeout=0.1),
+            error.TimeoutError)
+
+        def _check(_instance):
+            self.assertEqual(consumer.buffer,
+                             self._data[:len(self._data) // 2])
+
+        deferred.addCallback(_check)
+        return deferred
+
+    def test_no_idle_timeout_while_paused(self):
+        """
+        a consumer may pause the response for longer than the idle timeout
+        """
+        consumer = _PausingConsumer(pause_time=0.3)
+        deferred = self._retrieve(consumer, idle_timeout=0.1)
+
+        def _check(_result):
+            self.assertEqual(consumer.pause_count, 1)
+            self.assertEqual(consumer.buffer, self._data)
+
+        deferred.addCallback(_check)
+        return deferred
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+test_verifying_consumer.py
+
+test VerifyingConsumer and retrieve_verified against the fake server
+"""
+from hashlib import md5
+import os
+
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.web.client import ResponseFailed
+
+from twisted_client_for_nimbusio.buffered_consumer import BufferedConsumer
+from twisted_client_for_nimbusio.retry_policy import RetryPolicy
+from twisted_client_for_nimbusio.verifying_consumer import \
+    VerifyingConsumer, VerificationError, retrieve_verified
+
+from tests.fake_nimbusio_server import DROP_MID_BODY
+from tests.offline.fake_server_case import FakeServerTestCase
+
+class _Consumer(object):
+    """
+    an IConsumer without a reset method
+    """
+    def registerProducer(self, producer, _streaming):
+        producer.addConsumer(self)
+
+    def unregisterProducer(self):
+        pass
+
+    def write(self, _data):
+        pass
+
+class TestVerifyingConsumer(unittest.TestCase):
+
+    def test_can_reset(self):
+        self.assertTrue(VerifyingConsumer().can_reset)
+        self.assertTrue(VerifyingConsumer(BufferedConsumer()).can_reset)
+        self.assertFalse(VerifyingConsumer(_Consumer()).can_reset)
+        self.assertFalse(
+            VerifyingConsumer(VerifyingConsumer(_Consumer())).can_reset)
+
+    def test_reset(self):
+        consumer = VerifyingConsumer(expected_length=4,
+                                     expected_md5=md5("data").digest())
+        consumer.write("junk")
+        consumer.reset()
+        consumer.write("data")
+        self.assertEqual(consumer.verify("result"), "result")
+
+    def test_reset_not_possible(self):
+        consumer = VerifyingConsumer(_Consumer())
+        self.assertRaises(NotImplementedError, consumer.reset)
+
+class TestRetrieveVerified(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self._data = os.urandom(256 * 1024)
+        self._version = self.server.store_version("key", self._data)
+
+    def _retrieve(self, **kwargs):
+        return retrieve_verified(None, self.collection_name, "key", **kwargs)
+
+    @defer.inlineCallbacks
+    def test_verified(self):
+        consumer = BufferedConsumer()
+        verifying_consumer = yield self._retrieve(consumer=consumer)
+        self.assertEqual(verifying_consumer.md5_digest,
+                         self._version["md5"])
+        self.assertEqual(consumer.buffer, self._data)
+
+    @defer.inlineCallbacks
+    def test_wrong_content_md5(self):
+        self._version["md5"] = md5("other data").digest()
+        instance = yield self.assertFailure(self._retrieve(),
+                                            VerificationError)
+        self.assertIn("md5 mismatch", str(instance))
+
+    @defer.inlineCallbacks
+    def test_corrupted_data(self):
+        data = self._version["data"]
+        self._version["data"] = "x" + data[1:]
+        instance = yield self.assertFailure(self._retrieve(),
+                                            VerificationError)
+        self.assertIn("md5 mismatch", str(instance))
+
+    @defer.inlineCallbacks
+    def test_wrong_length(self):
+        instance = yield self.assertFailure(
+            self._retrieve(expected_length=len(self._data) + 1),
+            VerificationError)
+        self.assertIn("length mismatch", str(instance))
+
+    @defer.inlineCallbacks
+    def test_retried_after_reset(self):
+        # with the digest given, the GET is the only request
+        self.server.fail_next(1, DROP_MID_BODY)
+        consumer = BufferedConsumer()
+        retry_policy = RetryPolicy(initial_delay=0.01, jitter=0.0)
+        yield self._retrieve(consumer=consumer,
+                             expected_md5=self._version["md5"],
+                             retry_policy=retry_policy)
+        self.assertEqual(retry_policy.retry_count, 1)
+        self.assertEqual(consumer.buffer, self._data)
+
+    def test_not_retried_without_reset(self):
+        self.server.fail_next(1, DROP_MID_BODY)
+        retry_policy = RetryPolicy(initial_delay=0.01, jitter=0.0)
+        deferred = self._retrieve(consumer=_Consumer(),
+                                  expected_md5=self._version["md5"],
+                                  retry_policy=retry_policy)
+        deferred = self.assertFailure(deferred, ResponseFailed)
+        deferred.addCallback(
+            lambda _: self.assertEqual(retry_policy.retry_count, 0))
+        return deferred
@@ -0,0 +1,9 @@
+#!/bin/bash
+
+set -e
+set -x
+export PYTHONPATH="${HOME}/git/twisted_client_for_nimbusio"
+
+PYTHON="python2.7"
+
+"${PYTHON}" -m twisted.trial tests.offline $@
@@ -30,6 +30,8 @@ from test_single_part_archive import single_part_archive_complete_deferred, \
     start_single_part_archives
 from test_conjoined_archive import conjoined_archive_complete_deferred, \
     start_conjoined_archives
+from test_conjoined_uploader import conjoined_uploader_complete_deferred, \
+    start_conjoined_uploader_tests
 from test_head import head_test_complete_deferred, start_head_tests
 from test_list_keys import list_keys_test_complete_deferred, \
     start_list_keys_tests
@@ -40,6 +42,8 @@ from test_retrieve_slice import retrieve_slice_test_complete_deferred, \
     start_retrieve_slice_tests
 from test_retrieve_stream import retrieve_stream_test_complete_deferred, \
     start_retrieve_stream_tests
+from test_range_download import range_download_test_complete_deferred, \
+    start_range_download_tests
 
 class SetupError(Exception):
     pass
@@ -80,14 +84,14 @@ def _setup_test(args):
 
     return identity, bucket.name
 
-def _retrieve_stream_test_complete(result, state):
+def _range_download_test_complete(result, state):
     """
-    callback for successful completion of all retrieve stream tests
+    callback for successful completion of all range download tests
     """
     global _total_errors, _total_failures
 
     error_count, failure_count = result
-    log.msg("all stream retrieves complete. %d errors %d failures" % (
+    log.msg("all range downloads complete. %d errors %d failures" % (
             error_count, failure_count,),
             logLevel=logging.INFO)
 
@@ -98,13 +102,13 @@ def _retrieve_stream_test_complete(result, state):
                                                            _total_failures))
     reactor.stop() 
 
-def _retrieve_stream_test_failure(failure, _state):
+def _range_download_test_failure(failure, _state):
     """
-    errback for failure of the retrieve stream test
+    errback for failure of the range download test
     """
     global _total_failures
 
-    log.msg("retrieve_stream test failed: Failure %s" % (
+    log.msg("range download test failed: Failure %s" % (
             failure.getErrorMessage(), ), 
             logLevel=logging.ERROR)
 
@@ -114,6 +118,38 @@ def _retrieve_stream_test_failure(failure, _state):
                                                            _total_failures))
     reactor.stop() 
 
+def _retrieve_stream_test_complete(result, state):
+    """
+    callback for successful completion of all retrieve stream tests
+    """
+    global _total_errors, _total_failures
+
+    error_count, failure_count = result
+    log.msg("all stream retrieves complete. %d errors %d failures" % (
+            error_count, failure_count,),
+            logLevel=logging.INFO)
+
+    _total_errors += error_count
+    _total_failures += failure_count
+
+    # now we can start the next phase of the test
+    reactor.callLater(0, start_range_download_tests, state)
+
+def _retrieve_stream_test_failure(failure, state):
+    """
+    errback for failure of the retrieve stream test
+    """
+    global _total_failures
+
+    log.msg("retrieve_stream test failed: Failure %s" % (
+            failure.getErrorMessage(), ), 
+            logLevel=logging.ERROR)
+
+    _total_failures += 1
+
+    # now we can start the next phase of the test
+    reactor.callLater(0, start_range_download_tests, state)
+
 def _retrieve_slice_test_complete(result, state):
     """
     callback for successful completion of all retrieve slice tests
@@ -288,7 +324,7 @@ def _conjoined_archive_complete(result, state):
     _total_failures += failure_count
 
     # now we can start the next phase of the test
-    reactor.callLater(0, start_head_tests, state)
+    reactor.callLater(0, start_conjoined_uploader_tests, state)
 
 def _conjoined_archive_failure(failure):
     """
@@ -302,6 +338,38 @@ def _conjoined_archive_failure(failure):
 
     _total_failures += 1
 
+    # now we can start the next phase of the test
+    reactor.callLater(0, start_conjoined_uploader_tests, state)
+
+def _conjoined_uploader_complete(result, state):
+    """
+    callback for completion of all conjoined uploader tests
+    """
+    global _total_errors, _total_failures
+
+    error_count, failure_count = result
+    log.msg("all conjoined uploads complete. %d errors, %d failures" % (
+            error_count, failure_count, ),
+            logLevel=logging.INFO)
+
+    _total_errors += error_count
+    _total_failures += failure_count
+
+    # now we can start the next phase of the test
+    reactor.callLater(0, start_head_tests, state)
+
+def _conjoined_uploader_failure(failure, state):
+    """
+    errback for failure of conjoined uploader tests
+    """
+    global _total_failures
+
+    log.msg("conjoined uploads failed: Failure %s" % (
+            failure.getErrorMessage(), ),
+            logLevel=logging.ERROR)
+
+    _total_failures += 1
+
     # now we can start the next phase of the test
     reactor.callLater(0, start_head_tests, state)
 
@@ -361,6 +429,10 @@ if __name__ == "__main__":
         _conjoined_archive_complete, state) 
     conjoined_archive_complete_deferred.addErrback(
         _conjoined_archive_failure, state)
+    conjoined_uploader_complete_deferred.addCallback(
+        _conjoined_uploader_complete, state)
+    conjoined_uploader_complete_deferred.addErrback(
+        _conjoined_uploader_failure, state)
     head_test_complete_deferred.addCallback(_head_test_complete, state) 
     head_test_complete_deferred.addErrback(_head_test_failure, state)
     list_keys_test_complete_deferred.addCallback(_list_keys_test_complete, 
@@ -380,6 +452,10 @@ if __name__ == "__main__":
         _retrieve_stream_test_complete, state) 
     retrieve_stream_test_complete_deferred.addErrback(
         _retrieve_stream_test_failure, state)
+    range_download_test_complete_deferred.addCallback(
+        _range_download_test_complete, state) 
+    range_download_test_complete_deferred.addErrback(
+        _range_download_test_failure, state)
 
     reactor.callLater(0, start_single_part_archives, state)
 
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+test_conjoined_uploader.py
+
+test archiving conjoined (multiple files) with ConjoinedUploader
+"""
+from hashlib import md5
+import logging
+import os
+import random
+import tempfile
+
+from twisted.python import log
+from twisted.internet import defer
+
+from twisted_client_for_nimbusio.conjoined_uploader import ConjoinedUploader
+
+conjoined_uploader_complete_deferred = defer.Deferred()
+_pending_upload_count = 0
+_error_count = 0
+_failure_count = 0
+
+def _upload_result(result, state, key, path):
+    """
+    callback for successful completion of an individual conjoined upload
+    """
+    global _pending_upload_count
+    _pending_upload_count -= 1
+    os.unlink(path)
+
+    log.msg("conjoined upload %s successful: %s %d pending" % (
+            key,
+            result,
+            _pending_upload_count, ),
+            logLevel=logging.INFO)
+
+    if _pending_upload_count == 0:
+        conjoined_uploader_complete_deferred.callback((_error_count,
+                                                       _failure_count, ))
+
+def _upload_error(failure, state, key, path):
+    """
+    errback for failure of an individual conjoined upload
+    """
+    global _failure_count, _pending_upload_count
+    _failure_count += 1
+    _pending_upload_count -= 1
+    os.unlink(path)
+
+    log.msg("conjoined upload: key %s Failure %s" % (
+            key, failure.getErrorMessage(), ),
+            logLevel=logging.ERROR)
+
+    del state["key-data"][key]
+
+    if _pending_upload_count == 0:
+        conjoined_uploader_complete_deferred.callback((_error_count,
+                                                       _failure_count, ))
+
+def start_conjoined_uploader_tests(state):
+    """
+    start a group of conjoined uploads from temporary files
+    """
+    global _pending_upload_count
+
+    for i in range(state["args"].number_of_conjoined_keys):
+        prefix = random.choice(state["prefixes"])
+        key = "".join([prefix, state["separator"],
+                       "conjoined_uploader_key_%05d" % (i+1, )])
+        log.msg("starting conjoined upload for %r" % (key, ),
+                logLevel=logging.DEBUG)
+
+        length = random.randint(state["args"].min_conjoined_file_size,
+                                state["args"].max_conjoined_file_size)
+        data = os.urandom(length)
+        file_descriptor, path = tempfile.mkstemp()
+        os.write(file_descriptor, data)
+        os.close(file_descriptor)
+
+        state["key-data"][key] = {"length"              : length,
+                                  "md5"                 : md5(data),
+                                  "version-identifier"  : None}
+
+        uploader = ConjoinedUploader(
+            state["identity"],
+            state["collection-name"],
+            key,
+            path,
+            part_size=state["args"].max_conjoined_part_size)
+        deferred = uploader.start()
+        deferred.addCallback(_upload_result, state, key, path)
+        deferred.addErrback(_upload_error, state, key, path)
+
+        _pending_upload_count += 1
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+test_range_download.py
+
+test retrieving keys to local files with parallel range requests
+"""
+from hashlib import md5
+import logging
+import os
+import tempfile
+
+from twisted.python import log
+from twisted.internet import defer
+
+from twisted_client_for_nimbusio.range_downloader import RangeDownloader
+
+range_download_test_complete_deferred = defer.Deferred()
+_pending_range_download_test_count = 0
+_error_count = 0
+_failure_count = 0
+
+def _file_md5(path):
+    file_md5 = md5()
+    with open(path, "rb") as input_file:
+        while True:
+            data = input_file.read(1024 * 1024)
+            if len(data) == 0:
+                break
+            file_md5.update(data)
+    return file_md5
+
+def _range_download_result(_result, state, key, path):
+    """
+    callback for successful completion of an individual range download
+    """
+    global _pending_range_download_test_count, _error_count
+    _pending_range_download_test_count -= 1
+
+    length = os.path.getsize(path)
+    if length != state["key-data"][key]["length"]:
+        log.err("range download %s size mismatch %s != %s" % (
+                key, length, state["key-data"][key]["length"], ),
+                logLevel=logging.ERROR)
+        _error_count += 1
+    elif _file_md5(path).digest() != state["key-data"][key]["md5"].digest():
+        log.err("range download %s md5 mismatch" % (key, ),
+                logLevel=logging.ERROR)
+        _error_count += 1
+    else:
+        log.msg("range download %s successful" % (key, ))
+
+    os.unlink(path)
+
+    if _pending_range_download_test_count == 0:
+        range_download_test_complete_deferred.callback((_error_count,
+                                                        _failure_count))
+
+def _range_download_error(failure, _state, key, path):
+    """
+    errback for failure of an individual range download
+    """
+    global _pending_range_download_test_count, _failure_count
+    _pending_range_download_test_count -= 1
+
+    log.msg("range download %s Failure %s" % (
+            key, failure.getErrorMessage(), ),
+            logLevel=logging.ERROR)
+
+    _failure_count += 1
+    if os.path.exists(path):
+        os.unlink(path)
+
+    if _pending_range_download_test_count == 0:
+        range_download_test_complete_deferred.callback((_error_count,
+                                                        _failure_count))
+
+def start_range_download_tests(state):
+    """
+    start a range download of every key
+    """
+    global _pending_range_download_test_count
+
+    for key in state["key-data"].keys():
+        log.msg("range downloading key '%s'" % (key, ),
+                logLevel=logging.DEBUG)
+
+        file_descriptor, path = tempfile.mkstemp()
+        os.close(file_descriptor)
+
+        downloader = RangeDownloader(state["identity"],
+                                     state["collection-name"],
+                                     key,
+                                     path,
+                                     segment_size=1024 * 1024)
+        deferred = downloader.start()
+        deferred.addCallback(_range_download_result, state, key, path)
+        deferred.addErrback(_range_download_error, state, key, path)
+
+        _pending_range_download_test_count += 1
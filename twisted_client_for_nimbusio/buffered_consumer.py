@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """
-buffered_consumer.py 
+buffered_consumer.py
 
 An IConsumer that accumulates data in a buffer
 """
@@ -14,15 +14,43 @@ from twisted.internet.interfaces import IConsumer
 class BufferedConsumer(object):
     """
     An IConsumer that accumulates data in a buffer
+
+    Incoming data is kept as a list of chunks. The chunks are joined
+    (once) the first time the buffer property is accessed.
     """
     implements(IConsumer)
 
     def __init__(self):
-        self._buffer = ""
+        self._chunks = list()
+        self._length = 0
+
+    @property
+    def length(self):
+        """
+        the number of bytes received, without joining the chunks
+        """
+        return self._length
 
-    @property 
+    @property
     def buffer(self):
-        return self._buffer
+        if len(self._chunks) == 0:
+            return ""
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks), ]
+        return self._chunks[0]
+
+    def iter_chunks(self):
+        """
+        iterate over the data as received, without joining it
+        """
+        return iter(self._chunks)
+
+    def reset(self):
+        """
+        discard the data received so far, so a request can be retried
+        """
+        self._chunks = list()
+        self._length = 0
 
     def registerProducer(self, producer, _streaming):
         producer.addConsumer(self)
@@ -32,4 +60,5 @@ class BufferedConsumer(object):
                 logLevel=logging.ERROR)
 
     def write(self, data):
-        self._buffer = "".join([self._buffer, data, ])
+        self._chunks.append(data)
+        self._length += len(data)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+conditional_archive.py
+
+archive a local file only if it differs from what nimbus.io already has.
+
+archive_if_changed computes the MD5 digest and length of the file (read
+and hashed in a worker thread, off the reactor) while it asks for the
+remote Content-MD5 and Content-Length: from a MetadataCache if one is
+given, otherwise with a HEAD of the key. If they match, nothing is
+uploaded. Otherwise the file is archived, as a single request, or as a
+conjoined archive if it is larger than conjoined_threshold.
+
+Either way the deferred fires with a dict:
+
+    {"status"       : UPLOADED or SKIPPED,
+     "key"          : key,
+     "length"       : length of the file,
+     "md5-digest"   : binary MD5 digest of the file,
+     "result"       : the parsed archive result, None if SKIPPED}
+"""
+from hashlib import md5
+import httplib
+import json
+import os
+
+from twisted.internet import defer
+from twisted.internet.threads import deferToThread
+
+from twisted_client_for_nimbusio.rest_api import compute_archive_path, \
+    compute_head_path
+from twisted_client_for_nimbusio.requester import NimbusioHTTPStatusError
+from twisted_client_for_nimbusio.scheduler import \
+    collection_request_function
+from twisted_client_for_nimbusio.buffered_consumer import BufferedConsumer
+from twisted_client_for_nimbusio.file_range_producer import FileRangeProducer
+from twisted_client_for_nimbusio.conjoined_uploader import ConjoinedUploader
+from twisted_client_for_nimbusio.metadata_cache import \
+    md5_digest_from_headers, \
+    content_length_from_headers
+from twisted_client_for_nimbusio.lazy_log import log_debug
+
+UPLOADED = "uploaded"
+SKIPPED = "skipped"
+
+_read_size = int(
+    os.environ.get("NIMBUSIO_FILE_CHUNK_SIZE", str(1024 * 1024)))
+
+def _file_length_and_md5(source, read_size=_read_size):
+    """
+    return the length and binary MD5 digest of a path or a seekable file.
+    This blocks: run it in a thread
+    """
+    if isinstance(source, basestring):
+        source_file = open(source, "rb")
+    else:
+        source_file = source
+        source_file.seek(0)
+    try:
+        md5_hash = md5()
+        length = 0
+        while True:
+            data = source_file.read(read_size)
+            if len(data) == 0:
+                break
+            md5_hash.update(data)
+            length += len(data)
+    finally:
+        if source_file is not source:
+            source_file.close()
+    return length, md5_hash.digest()
+
+def _remote_length_and_md5(headers):
+    return (content_length_from_headers(headers),
+            md5_digest_from_headers(headers), )
+
+def _missing_key(failure):
+    failure.trap(NimbusioHTTPStatusError)
+    if failure.value.status != httplib.NOT_FOUND:
+        return failure
+    return None
+
+@defer.inlineCallbacks
+def archive_if_changed(identity,
+                       collection_name,
+                       key,
+                       source,
+                       metadata_cache=None,
+                       conjoined_threshold=None,
+                       scheduler=None,
+                       **kwargs):
+    """
+    archive source (a path, or a seekable file object) as key, unless the
+    current version of key has the same length and MD5 digest
+
+    metadata_cache
+        a MetadataCache to take the remote digest from, if it is cached,
+        and to record the new version in
+
+    conjoined_threshold
+        archive files larger than this many bytes with ConjoinedUploader.
+        None archives everything in a single request
+
+    scheduler
+        a RequestScheduler to queue the requests through. If None, requests
+        start immediately
+
+    Extra keyword arguments are passed to the requests.
+    return a deferred that fires with the result dict described above
+    """
+    request = collection_request_function(scheduler)
+
+    local_deferred = deferToThread(_file_length_and_md5, source)
+
+    if metadata_cache is not None:
+        head_deferred = metadata_cache.head(identity,
+                                            collection_name,
+                                            key,
+                                            scheduler=scheduler,
+                                            **kwargs)
+    else:
+        head_deferred = request(identity,
+                                "HEAD",
+                                collection_name,
+                                compute_head_path(key),
+                                **kwargs)
+    head_deferred.addErrback(_missing_key)
+
+    # wait for both, so neither failure is left unhandled; a failure to
+    # read the file is reported before a failure of the HEAD
+    results = yield defer.DeferredList([local_deferred, head_deferred, ],
+                                       fireOnOneErrback=False,
+                                       consumeErrors=True)
+    (local_success, local_result), (head_success, headers) = results
+    if not local_success:
+        local_result.raiseException()
+    if not head_success:
+        headers.raiseException()
+    length, md5_digest = local_result
+
+    archive_result = {"status"      : SKIPPED,
+                      "key"         : key,
+                      "length"      : length,
+                      "md5-digest"  : md5_digest,
+                      "result"      : None}
+
+    if headers is not None and \
+        _remote_length_and_md5(headers) == (length, md5_digest, ):
+        log_debug("archive_if_changed %r unchanged, skipped", key)
+        defer.returnValue(archive_result)
+
+    log_debug("archive_if_changed %r changed, uploading %s bytes",
+              key, length)
+    if conjoined_threshold is not None and length > conjoined_threshold:
+        uploader = ConjoinedUploader(identity,
+                                     collection_name,
+                                     key,
+                                     source,
+                                     length=length,
+                                     scheduler=scheduler,
+                                     metadata_cache=metadata_cache)
+        result = yield uploader.start()
+    else:
+        consumer = BufferedConsumer()
+        producer = FileRangeProducer(source, length=length)
+        yield request(identity,
+                      "POST",
+                      collection_name,
+                      compute_archive_path(key),
+                      response_consumer=consumer,
+                      body_producer=producer,
+                      **kwargs)
+        result = json.loads(consumer.buffer)
+        if metadata_cache is not None:
+            metadata_cache.record_archive(collection_name, key, result,
+                                          length, md5_digest, latest=True)
+
+    archive_result["status"] = UPLOADED
+    archive_result["result"] = result
+    defer.returnValue(archive_result)
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+conjoined_uploader.py
+
+upload a large file, or stream, to nimbus.io as a conjoined (multipart)
+archive: start the conjoined archive, upload the parts several at a time,
+retrying failed parts individually, then finish the conjoined archive
+once every part has succeeded.
+"""
+import json
+import logging
+import os
+
+from twisted.python import log
+
+from twisted.internet import reactor, defer
+
+from twisted_client_for_nimbusio.rest_api import \
+    compute_start_conjoined_path, \
+    compute_archive_path, \
+    compute_finish_conjoined_path, \
+    compute_abort_conjoined_path
+
+from twisted_client_for_nimbusio.scheduler import \
+    collection_request_function
+from twisted_client_for_nimbusio.buffered_consumer import BufferedConsumer
+from twisted_client_for_nimbusio.pass_thru_producer import PassThruProducer
+from twisted_client_for_nimbusio.file_range_producer import FileRangeProducer
+from twisted_client_for_nimbusio.lazy_log import log_debug
+
+_min_part_size = 5 * 1024 * 1024
+_max_part_size = 1024 * 1024 * 1024
+_part_size_unit = 1024 * 1024
+_target_part_count = 100
+_default_concurrency = int(
+    os.environ.get("NIMBUSIO_CONJOINED_CONCURRENCY", "4"))
+_default_max_part_retries = 3
+_part_retry_delay = 1.0
+
+class ConjoinedUploadError(Exception):
+    pass
+
+def compute_part_size(total_size):
+    """
+    choose a part size for a conjoined archive of total_size bytes:
+    about _target_part_count parts, rounded up to a whole MiB, and never
+    smaller than _min_part_size or larger than _max_part_size
+    """
+    part_size = -(-total_size // _target_part_count)
+    part_size = -(-part_size // _part_size_unit) * _part_size_unit
+    return max(_min_part_size, min(_max_part_size, part_size))
+
+def _is_seekable_file(source):
+    try:
+        source.fileno()
+        source.seek(0, os.SEEK_CUR)
+    except (AttributeError, IOError, OSError):
+        return False
+    return True
+
+class ConjoinedUploader(object):
+    """
+    upload a conjoined archive
+
+    source
+        a path, a seekable file object, or a stream object with a
+        read method. Parts of a path or file are read by FileRangeProducer
+        as they are sent; parts of a stream are read into memory in order,
+        at most concurrency parts at a time.
+
+    length
+        the total number of bytes. Required for a stream, otherwise
+        defaults to the size of the file
+
+    part_size
+        the size of each part (but the last). Computed from length by
+        compute_part_size if not given
+
+    concurrency
+        the number of parts uploading at once
+
+    max_part_retries
+        the number of times a failed part is retried before the whole
+        upload fails (and the conjoined archive is aborted)
+
+    scheduler
+        a RequestScheduler to queue the requests through. If None, requests
+        start immediately
+
+    metadata_cache
+        a MetadataCache to drop the cached versions of key from when the
+        conjoined archive is finished
+    """
+    def __init__(self,
+                 identity,
+                 collection_name,
+                 key,
+                 source,
+                 length=None,
+                 part_size=None,
+                 concurrency=_default_concurrency,
+                 max_part_retries=_default_max_part_retries,
+                 use_mmap=False,
+                 scheduler=None,
+                 metadata_cache=None):
+        self._identity = identity
+        self._collection_name = collection_name
+        self._key = key
+        self._use_mmap = use_mmap
+        self._metadata_cache = metadata_cache
+        self._start_collection_request = \
+            collection_request_function(scheduler)
+
+        if isinstance(source, basestring):
+            self._file = open(source, "rb")
+            self._close_file = True
+            self._seekable = True
+        else:
+            self._file = source
+            self._close_file = False
+            self._seekable = _is_seekable_file(source)
+
+        if length is None:
+            assert self._seekable, "length is required for a stream"
+            length = os.fstat(self._file.fileno()).st_size
+        self._length = length
+
+        if part_size is None:
+            part_size = compute_part_size(length)
+        self._part_size = part_size
+        self._semaphore = defer.DeferredSemaphore(concurrency)
+        self._max_part_retries = max_part_retries
+
+        self._conjoined_identifier = None
+        self._part_results = dict()
+        self._failed = False
+        self._first_failure = None
+
+    @property
+    def key(self):
+        return self._key
+
+    @property
+    def length(self):
+        return self._length
+
+    @property
+    def part_size(self):
+        return self._part_size
+
+    @property
+    def part_count(self):
+        return max(1, -(-self._length // self._part_size))
+
+    @property
+    def conjoined_identifier(self):
+        return self._conjoined_identifier
+
+    @property
+    def part_results(self):
+        """
+        a dict of the parsed archive result for each part, by part number
+        """
+        return self._part_results
+
+    def start(self):
+        """
+        start the upload
+        return a deferred that fires with the parsed result of
+        'finish conjoined' when all the parts are uploaded
+        """
+        log_debug("conjoined upload %r %s bytes %s parts of %s",
+                  self._key, self._length, self.part_count, self._part_size)
+
+        deferred = self._post(compute_start_conjoined_path(self._key))
+        deferred.addCallback(self._start_conjoined_result)
+        deferred.addCallback(self._finish_conjoined)
+        deferred.addErrback(self._abort_conjoined)
+        deferred.addBoth(self._close)
+        return deferred
+
+    def _post(self, path, body_producer=None):
+        consumer = BufferedConsumer()
+        deferred = self._start_collection_request(
+            self._identity,
+            "POST",
+            self._collection_name,
+            path,
+            response_consumer=consumer,
+            body_producer=body_producer)
+
+        def _parse_result(_result):
+            return json.loads(consumer.buffer)
+
+        deferred.addCallback(_parse_result)
+        return deferred
+
+    def _start_conjoined_result(self, result):
+        self._conjoined_identifier = result["conjoined_identifier"]
+        log_debug("conjoined upload %r identifier = %s",
+                  self._key, self._conjoined_identifier)
+
+        deferreds = list()
+        for conjoined_part in range(1, self.part_count + 1):
+            deferred = self._semaphore.run(self._archive_part, conjoined_part)
+            deferred.addErrback(self._part_failed)
+            deferreds.append(deferred)
+
+        # wait for every part to settle before aborting or closing the file,
+        # parts not yet started are skipped once one has failed
+        deferred_list = defer.DeferredList(deferreds, consumeErrors=True)
+
+        def _complete(_results):
+            if self._first_failure is not None:
+                return self._first_failure
+            return None
+
+        deferred_list.addCallback(_complete)
+        return deferred_list
+
+    def _part_failed(self, failure):
+        if not self._failed:
+            self._failed = True
+            self._first_failure = failure
+        return failure
+
+    def _archive_part(self, conjoined_part):
+        if self._failed:
+            raise ConjoinedUploadError("%r part %s: upload already failed" % (
+                                       self._key, conjoined_part, ))
+
+        offset = (conjoined_part - 1) * self._part_size
+        size = min(self._part_size, self._length - offset)
+
+        if self._seekable:
+            data = None
+        else:
+            data = self._file.read(size)
+            if len(data) != size:
+                raise ConjoinedUploadError(
+                    "%r part %s: stream ended %s bytes short" % (
+                    self._key, conjoined_part, size - len(data), ))
+
+        return self._archive_part_attempt(conjoined_part, offset, size, data, 1)
+
+    def _archive_part_attempt(self, conjoined_part, offset, size, data,
+                              attempt):
+        name = "%s_%03d" % (self._key, conjoined_part, )
+        if data is None:
+            producer = FileRangeProducer(self._file,
+                                         offset,
+                                         size,
+                                         use_mmap=self._use_mmap,
+                                         name=name)
+        else:
+            producer = PassThruProducer(name, size)
+            producer.feed(data)
+
+        path = compute_archive_path(
+            self._key,
+            conjoined_identifier=self._conjoined_identifier,
+            conjoined_part=conjoined_part)
+
+        deferred = self._post(path, body_producer=producer)
+        deferred.addCallback(self._archive_part_result, conjoined_part)
+        deferred.addErrback(self._archive_part_error,
+                            conjoined_part,
+                            offset,
+                            size,
+                            data,
+                            attempt)
+        return deferred
+
+    def _archive_part_result(self, result, conjoined_part):
+        log_debug("conjoined upload %r part %s: version = %s",
+                  self._key, conjoined_part, result["version_identifier"])
+        self._part_results[conjoined_part] = result
+        return result
+
+    def _archive_part_error(self, failure, conjoined_part, offset, size,
+                            data, attempt):
+        log.msg("conjoined upload %r part %s attempt %s failed: %s" % (
+                self._key, conjoined_part, attempt,
+                failure.getErrorMessage(), ),
+                logLevel=logging.WARN)
+
+        if self._failed or attempt > self._max_part_retries:
+            return failure
+
+        deferred = defer.Deferred()
+        deferred.addCallback(self._retry_part,
+                             conjoined_part,
+                             offset,
+                             size,
+                             data,
+                             attempt + 1)
+        reactor.callLater(_part_retry_delay * attempt, deferred.callback, None)
+        return deferred
+
+    def _retry_part(self, _result, conjoined_part, offset, size, data,
+                    attempt):
+        if self._failed:
+            raise ConjoinedUploadError("%r part %s: upload already failed" % (
+                                       self._key, conjoined_part, ))
+        return self._archive_part_attempt(conjoined_part, offset, size, data,
+                                          attempt)
+
+    def _finish_conjoined(self, _result):
+        log_debug("conjoined upload %r finishing %s",
+                  self._key, self._conjoined_identifier)
+        deferred = self._post(compute_finish_conjoined_path(
+                              self._key, self._conjoined_identifier))
+        if self._metadata_cache is not None:
+            deferred.addCallback(self._invalidate_metadata)
+        return deferred
+
+    def _invalidate_metadata(self, result):
+        self._metadata_cache.invalidate(self._collection_name, self._key)
+        return result
+
+    def _abort_conjoined(self, failure):
+        log.msg("conjoined upload %r failed: %s" % (
+                self._key, failure.getErrorMessage(), ),
+                logLevel=logging.ERROR)
+        if self._conjoined_identifier is None:
+            return failure
+
+        deferred = self._post(compute_abort_conjoined_path(
+                              self._conjoined_identifier, self._key))
+
+        def _aborted(_result):
+            return failure
+
+        def _abort_error(abort_failure):
+            log.msg("conjoined upload %r abort failed: %s" % (
+                    self._key, abort_failure.getErrorMessage(), ),
+                    logLevel=logging.ERROR)
+            return failure
+
+        deferred.addCallbacks(_aborted, _abort_error)
+        return deferred
+
+    def _close(self, result):
+        if self._close_file:
+            self._file.close()
+        return result
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+connection_pool.py
+
+shared keep-alive connection pools, one per collection hostname,
+so that successive requests reuse TCP (and TLS) connections
+instead of connecting for every request.
+
+At most max_connections_per_host requests to a host are in progress at
+once, each on its own connection: the others wait, in order, on a
+DeferredSemaphore for the host. Of the connections that are left idle,
+at most max_persistent_per_host are kept open.
+
+Persistent connections need twisted.web.client.HTTPConnectionPool.
+With a version of twisted that is too old to have it, every request
+gets a fresh non-persistent Agent, as before.
+"""
+import os
+
+from twisted.internet import reactor, defer
+
+from twisted.web.client import Agent, URI
+
+try:
+    from twisted.web.client import HTTPConnectionPool
+except ImportError:
+    HTTPConnectionPool = None
+
+from twisted_client_for_nimbusio import metrics
+from twisted_client_for_nimbusio.lazy_log import log_debug
+
+_max_persistent_per_host = int(
+    os.environ.get("NIMBUSIO_MAX_PERSISTENT_PER_HOST", "4"))
+_max_connections_per_host = int(
+    os.environ.get("NIMBUSIO_MAX_CONNECTIONS_PER_HOST", "16"))
+_cached_connection_timeout = float(
+    os.environ.get("NIMBUSIO_CACHED_CONNECTION_TIMEOUT", "240.0"))
+_retry_automatically = \
+    os.environ.get("NIMBUSIO_POOL_RETRY_AUTOMATICALLY", "1") != "0"
+
+# preconnect fills a pool through private methods of Agent and
+# HTTPConnectionPool: without them it opens nothing
+_preconnect_available = HTTPConnectionPool is not None and \
+    hasattr(Agent, "_getEndpoint") and \
+    hasattr(HTTPConnectionPool, "_newConnection") and \
+    hasattr(HTTPConnectionPool, "_putConnection")
+
+_pools = dict()
+_agents = dict()
+_semaphores = dict()
+
+def pooling_available():
+    """
+    return True if this version of twisted supports persistent connections
+    """
+    return HTTPConnectionPool is not None
+
+def configure_connection_pools(max_persistent_per_host=None,
+                               cached_connection_timeout=None,
+                               retry_automatically=None,
+                               max_connections_per_host=None):
+    """
+    change the settings used for connection pools
+
+    max_persistent_per_host
+        the maximum number of idle connections kept open to one host
+
+    max_connections_per_host
+        the maximum number of requests in progress to one host, each with
+        a connection of its own. The rest wait for one to finish. 0 for no
+        limit. To order or cancel the waiting requests, use a
+        RequestScheduler
+
+    cached_connection_timeout
+        seconds an idle connection stays open before it is closed
+
+    retry_automatically
+        let twisted retry an idempotent request once if a cached connection
+        turns out to have been closed by the server
+
+    The settings apply to pools created after this call. Call
+    close_connection_pools first to apply them to every host.
+    """
+    global _max_persistent_per_host, _cached_connection_timeout, \
+        _retry_automatically, _max_connections_per_host
+
+    if max_persistent_per_host is not None:
+        _max_persistent_per_host = max_persistent_per_host
+    if max_connections_per_host is not None:
+        _max_connections_per_host = max_connections_per_host
+    if cached_connection_timeout is not None:
+        _cached_connection_timeout = cached_connection_timeout
+    if retry_automatically is not None:
+        _retry_automatically = retry_automatically
+
+if HTTPConnectionPool is not None:
+    class _TimedConnectionPool(HTTPConnectionPool):
+        """
+        an HTTPConnectionPool that reports how long new connections take
+        """
+        def _newConnection(self, key, endpoint):
+            started_at = reactor.seconds()
+            deferred = HTTPConnectionPool._newConnection(self, key, endpoint)
+
+            def _connected(protocol):
+                metrics.timing("request.connect",
+                               reactor.seconds() - started_at)
+                return protocol
+
+            deferred.addCallback(_connected)
+            return deferred
+
+def _create_pool():
+    pool = _TimedConnectionPool(reactor, persistent=True)
+    pool.maxPersistentPerHost = _max_persistent_per_host
+    pool.cachedConnectionTimeout = _cached_connection_timeout
+    pool.retryAutomatically = _retry_automatically
+    return pool
+
+def get_connection_pool(hostname):
+    """
+    return the shared connection pool for hostname, creating it if needed
+    return None if persistent connections are not available
+    """
+    if not pooling_available():
+        return None
+
+    try:
+        return _pools[hostname]
+    except KeyError:
+        log_debug("creating connection pool for %s max_connections = %s "
+                  "max_persistent = %s", hostname,
+                  _max_connections_per_host, _max_persistent_per_host)
+        pool = _create_pool()
+        _pools[hostname] = pool
+        return pool
+
+def get_connection_semaphore(hostname):
+    """
+    return the DeferredSemaphore limiting the requests in progress to
+    hostname (and so the connections they use) to max_connections_per_host
+    return None if there is no limit
+    """
+    if _max_connections_per_host <= 0:
+        return None
+
+    try:
+        return _semaphores[hostname]
+    except KeyError:
+        semaphore = defer.DeferredSemaphore(_max_connections_per_host)
+        _semaphores[hostname] = semaphore
+        return semaphore
+
+def get_agent(hostname, persistent=True, connect_timeout=None):
+    """
+    return an Agent for requests to hostname
+
+    if persistent is True (and twisted supports it) the Agent uses the
+    shared connection pool for hostname, otherwise every call returns a new
+    Agent which opens a new connection for each request
+
+    connect_timeout is the number of seconds to wait for a new connection.
+    It is ignored by versions of twisted too old to support it.
+    """
+    if not pooling_available():
+        return Agent(reactor)
+
+    # twisted times out the connection attempt with reactor.callLater
+    connect_timeout = connect_timeout or None
+    if not persistent:
+        return Agent(reactor, connectTimeout=connect_timeout)
+
+    try:
+        return _agents[(hostname, connect_timeout, )]
+    except KeyError:
+        agent = Agent(reactor,
+                      connectTimeout=connect_timeout,
+                      pool=get_connection_pool(hostname))
+        _agents[(hostname, connect_timeout, )] = agent
+        return agent
+
+def preconnect(hostname, uri, count=1, connect_timeout=None):
+    """
+    open count new connections to hostname (for requests to uri) and leave
+    them idle in its pool, so the next requests need not wait to connect
+
+    return a deferred that fires with the number of connections opened.
+    Nothing is opened if persistent connections are not available, or
+    this version of twisted does not let connections be added to a pool.
+    """
+    if not _preconnect_available:
+        log_debug("preconnect %s unavailable", hostname)
+        return defer.succeed(0)
+
+    pool = get_connection_pool(hostname)
+    agent = get_agent(hostname, True, connect_timeout)
+    count = min(count, pool.maxPersistentPerHost)
+
+    # the pool has no public way to add connections: use the key and
+    # endpoint the Agent would use
+    parsed_uri = URI.fromBytes(uri)
+    key = (parsed_uri.scheme, parsed_uri.host, parsed_uri.port, )
+    try:
+        endpoint = agent._getEndpoint(parsed_uri)
+    except TypeError, instance:
+        log_debug("preconnect %s unavailable: %s", hostname, instance)
+        return defer.succeed(0)
+
+    def _connected(protocol):
+        pool._putConnection(key, protocol)
+        return True
+
+    def _connect_failed(failure):
+        log_debug("preconnect %s failed: %s",
+                  hostname, failure.getErrorMessage())
+        return False
+
+    deferreds = list()
+    for _ in range(count):
+        deferred = pool._newConnection(key, endpoint)
+        deferred.addCallbacks(_connected, _connect_failed)
+        deferreds.append(deferred)
+
+    deferred_list = defer.DeferredList(deferreds)
+    deferred_list.addCallback(
+        lambda results: len([True for _, opened in results if opened]))
+    return deferred_list
+
+def close_connection_pools():
+    """
+    close all the cached connections in all the pools
+    return a deferred that fires when every connection is closed
+    """
+    deferreds = [pool.closeCachedConnections() for pool in _pools.values()]
+    _pools.clear()
+    _agents.clear()
+    _semaphores.clear()
+    return defer.DeferredList(deferreds)
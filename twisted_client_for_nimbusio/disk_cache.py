@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+"""
+disk_cache.py
+
+a read-through cache of retrieved keys in a local directory.
+
+DiskObjectCache.retrieve takes the place of a GET through
+compute_retrieve_path and start_collection_request: a hit streams the
+cached file to the consumer, a miss retrieves the key, passing the data
+on to the consumer and writing it to the cache as it arrives.
+
+A retrieve of a specific version is cached as is, versions do not change.
+Without a version, the cached data is checked against a HEAD of the key
+(Content-Length and Content-MD5, or Last-Modified) before it is used.
+Slices are served from the cached whole key if there is one, otherwise
+each slice is cached on its own.
+
+The cache is kept under max_bytes by evicting the least recently used
+files. Each cached file has a .meta file beside it, so the cache
+survives a restart.
+"""
+from hashlib import md5, sha1
+import httplib
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+
+from twisted.python import log
+
+from twisted.internet import defer
+
+from zope.interface import implements
+from twisted.internet.interfaces import IConsumer, IPushProducer
+
+from twisted_client_for_nimbusio import metrics
+from twisted_client_for_nimbusio.rest_api import compute_head_path, \
+    compute_retrieve_path, \
+    compute_range_header_tuple
+from twisted_client_for_nimbusio.scheduler import \
+    collection_request_function
+from twisted_client_for_nimbusio.file_range_producer import FileRangeProducer
+from twisted_client_for_nimbusio.metadata_cache import \
+    md5_digest_from_headers, \
+    content_length_from_headers
+from twisted_client_for_nimbusio.lazy_log import log_debug
+
+_default_max_bytes = int(
+    os.environ.get("NIMBUSIO_DISK_CACHE_MAX_BYTES", str(1024 ** 3)))
+_data_suffix = ".data"
+_meta_suffix = ".meta"
+# request arguments that describe the GET, not the HEAD that checks
+# the freshness of cached data
+_get_only_arguments = ["additional_headers", "valid_http_status", ]
+
+def _header_value(headers, name):
+    for header_name, values in headers.items():
+        if header_name.lower() == name:
+            return values[0]
+    return None
+
+def _validators_from_headers(headers):
+    """
+    the values from HEAD that tell whether cached data is still current
+    """
+    md5_digest = md5_digest_from_headers(headers)
+    return {"length"        : content_length_from_headers(headers),
+            "md5"           : (None if md5_digest is None
+                               else md5_digest.encode("hex")),
+            "last-modified" : _header_value(headers, "last-modified")}
+
+def _is_current(validators, headers):
+    """
+    return True if data cached with validators matches the HEAD headers
+    """
+    current = _validators_from_headers(headers)
+    if validators.get("length") != current["length"]:
+        return False
+    if validators.get("md5") is not None and current["md5"] is not None:
+        return validators["md5"] == current["md5"]
+    if validators.get("last-modified") is not None and \
+        current["last-modified"] is not None:
+        return validators["last-modified"] == current["last-modified"]
+    return False
+
+class _CacheFillConsumer(object):
+    """
+    An IConsumer that passes data on to another consumer, and writes it
+    to a cache file as well. Filling is abandoned if the data grows past
+    max_bytes.
+
+    It registers itself with the other consumer as the producer, passing
+    pause, resume and stop on to the real producer.
+    """
+    implements(IConsumer, IPushProducer)
+
+    def __init__(self, consumer, cache_file, max_bytes):
+        self._consumer = consumer
+        self._producer = None
+        self._file = cache_file
+        self._max_bytes = max_bytes
+        self._md5 = md5()
+        self._bytes_written = 0
+
+    @property
+    def abandoned(self):
+        return self._file is None
+
+    @property
+    def bytes_written(self):
+        return self._bytes_written
+
+    @property
+    def md5_digest(self):
+        return self._md5.digest()
+
+    def registerProducer(self, producer, streaming):
+        self._producer = producer
+        producer.addConsumer(self)
+        self._consumer.registerProducer(self, streaming)
+
+    def unregisterProducer(self):
+        self._producer = None
+        self._consumer.unregisterProducer()
+
+    def addConsumer(self, _consumer):
+        pass
+
+    def pauseProducing(self):
+        self._producer.pauseProducing()
+
+    def resumeProducing(self):
+        self._producer.resumeProducing()
+
+    def stopProducing(self):
+        self._producer.stopProducing()
+
+    def write(self, data):
+        if self._file is not None:
+            if self._bytes_written + len(data) > self._max_bytes:
+                self._file = None
+            else:
+                self._file.write(data)
+                self._md5.update(data)
+                self._bytes_written += len(data)
+        self._consumer.write(data)
+
+class DiskObjectCache(object):
+    """
+    cache retrieved keys in directory
+
+    max_bytes
+        the most data kept in the cache. Keys larger than this are
+        passed through without being cached
+
+    metadata_cache
+        a MetadataCache for the HEAD requests that check the freshness of
+        cached data
+
+    scheduler
+        a RequestScheduler to queue the requests through. If None, requests
+        start immediately
+    """
+    def __init__(self,
+                 directory,
+                 max_bytes=_default_max_bytes,
+                 metadata_cache=None,
+                 scheduler=None):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._metadata_cache = metadata_cache
+        self._scheduler = scheduler
+        self._start_collection_request = \
+            collection_request_function(scheduler)
+
+        # name -> entry, least recently used first
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._hits = 0
+        self._misses = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._load_entries()
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    def __len__(self):
+        return len(self._entries)
+
+    def retrieve(self,
+                 identity,
+                 collection_name,
+                 key,
+                 consumer,
+                 version_id=None,
+                 slice_offset=None,
+                 slice_size=None,
+                 **kwargs):
+        """
+        retrieve key (or a slice of it) to consumer, from the cache if the
+        cached data is current, otherwise from nimbus.io
+        return a deferred that fires with True when all the data has been
+        written to consumer. Extra keyword arguments are passed to the
+        requests; additional_headers and valid_http_status only to the GET.
+        """
+        kwargs = dict(kwargs)
+        if version_id is not None:
+            deferred = defer.succeed(None)
+        else:
+            head_kwargs = dict(kwargs)
+            for name in _get_only_arguments:
+                head_kwargs.pop(name, None)
+            deferred = self._head(identity, collection_name, key, head_kwargs)
+
+        deferred.addCallback(self._retrieve_after_head,
+                             identity,
+                             collection_name,
+                             key,
+                             consumer,
+                             version_id,
+                             slice_offset,
+                             slice_size,
+                             kwargs)
+        return deferred
+
+    def invalidate(self, collection_name, key):
+        """
+        remove every cached version and slice of key
+        """
+        for name, entry in self._entries.items():
+            if entry["key"][0] == collection_name and entry["key"][1] == key:
+                self._remove_entry(name)
+
+    def clear(self):
+        for name in self._entries.keys():
+            self._remove_entry(name)
+
+    def _head(self, identity, collection_name, key, kwargs):
+        if self._metadata_cache is not None:
+            return self._metadata_cache.head(identity,
+                                             collection_name,
+                                             key,
+                                             scheduler=self._scheduler,
+                                             **kwargs)
+        return self._start_collection_request(identity,
+                                              "HEAD",
+                                              collection_name,
+                                              compute_head_path(key),
+                                              **kwargs)
+
+    def _retrieve_after_head(self,
+                             headers,
+                             identity,
+                             collection_name,
+                             key,
+                             consumer,
+                             version_id,
+                             slice_offset,
+                             slice_size,
+                             kwargs):
+        whole_name = self._entry_name(collection_name, key, version_id,
+                                      None, None)
+        whole_entry = self._current_entry(whole_name, headers)
+        if whole_entry is not None:
+            offset = min(slice_offset or 0, whole_entry["size"])
+            size = whole_entry["size"] - offset
+            if slice_size is not None:
+                size = min(slice_size, size)
+            return self._serve(whole_name, consumer, offset, size)
+
+        if slice_offset is not None or slice_size is not None:
+            slice_name = self._entry_name(collection_name, key, version_id,
+                                          slice_offset, slice_size)
+            slice_entry = self._current_entry(slice_name, headers)
+            if slice_entry is not None:
+                return self._serve(slice_name, consumer, 0, slice_entry["size"])
+        else:
+            slice_name = None
+
+        self._misses += 1
+        metrics.increment("disk_cache.miss")
+        return self._fill(identity,
+                          collection_name,
+                          key,
+                          consumer,
+                          version_id,
+                          slice_offset,
+                          slice_size,
+                          headers,
+                          (whole_name if slice_name is None else slice_name),
+                          kwargs)
+
+    def _current_entry(self, name, headers):
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+        # versioned entries are fetched without a HEAD and never change
+        if headers is not None and not _is_current(entry["validators"],
+                                                   headers):
+            log_debug("disk cache %s is out of date", entry["key"])
+            self._remove_entry(name)
+            return None
+        return entry
+
+    def _serve(self, name, consumer, offset, size):
+        self._hits += 1
+        metrics.increment("disk_cache.hit")
+        entry = self._entries.pop(name)
+        self._entries[name] = entry
+        data_path = self._data_path(name)
+        os.utime(data_path, None)
+
+        producer = FileRangeProducer(data_path, offset, size,
+                                     name="disk cache %s" % (entry["key"], ))
+        consumer.registerProducer(producer, True)
+        deferred = producer.startProducing(consumer)
+
+        def _served(_result):
+            return True
+
+        deferred.addCallback(_served)
+        return deferred
+
+    def _fill(self,
+              identity,
+              collection_name,
+              key,
+              consumer,
+              version_id,
+              slice_offset,
+              slice_size,
+              headers,
+              name,
+              kwargs):
+        additional_headers = dict(kwargs.pop("additional_headers", None) or {})
+        if slice_offset is not None or slice_size is not None:
+            range_header_tuple = compute_range_header_tuple(slice_offset,
+                                                            slice_size)
+            additional_headers[range_header_tuple[0]] = range_header_tuple[1]
+            kwargs.setdefault("valid_http_status",
+                              frozenset([httplib.PARTIAL_CONTENT, ]))
+
+        cache_fd, temp_path = tempfile.mkstemp(dir=self._directory,
+                                               suffix=".tmp")
+        cache_file = os.fdopen(cache_fd, "wb")
+        fill_consumer = _CacheFillConsumer(consumer, cache_file,
+                                           self._max_bytes)
+
+        path = compute_retrieve_path(key, version_id)
+        deferred = self._start_collection_request(
+            identity,
+            "GET",
+            collection_name,
+            path,
+            response_consumer=fill_consumer,
+            additional_headers=additional_headers,
+            **kwargs)
+
+        def _filled(result):
+            cache_file.close()
+            self._add_entry(name,
+                            (collection_name, key, version_id,
+                             slice_offset, slice_size, ),
+                            temp_path,
+                            fill_consumer,
+                            headers,
+                            slice_offset is None and slice_size is None)
+            return result
+
+        def _fill_failed(failure):
+            cache_file.close()
+            os.unlink(temp_path)
+            return failure
+
+        deferred.addCallbacks(_filled, _fill_failed)
+        return deferred
+
+    def _add_entry(self, name, cache_key, temp_path, fill_consumer, headers,
+                   is_whole):
+        if headers is None:
+            validators = dict()
+        else:
+            validators = _validators_from_headers(headers)
+
+        usable = not fill_consumer.abandoned
+        if usable and is_whole and headers is not None:
+            # the key may have changed between the HEAD and the GET
+            if fill_consumer.bytes_written != validators["length"]:
+                usable = False
+            elif validators["md5"] is not None and \
+                fill_consumer.md5_digest.encode("hex") != validators["md5"]:
+                usable = False
+
+        if not usable:
+            log_debug("disk cache not caching %s", cache_key)
+            os.unlink(temp_path)
+            return
+
+        if name in self._entries:
+            self._remove_entry(name)
+
+        entry = {"key"          : cache_key,
+                 "size"         : fill_consumer.bytes_written,
+                 "validators"   : validators}
+        os.rename(temp_path, self._data_path(name))
+        with open(self._meta_path(name), "w") as meta_file:
+            json.dump(entry, meta_file)
+
+        self._entries[name] = entry
+        self._total_bytes += entry["size"]
+        log_debug("disk cache added %s %s bytes total %s",
+                  cache_key, entry["size"], self._total_bytes)
+        self._evict()
+
+    def _evict(self):
+        while self._total_bytes > self._max_bytes and len(self._entries) > 0:
+            name = next(iter(self._entries))
+            log_debug("disk cache evicting %s", self._entries[name]["key"])
+            self._remove_entry(name)
+
+    def _remove_entry(self, name):
+        entry = self._entries.pop(name)
+        self._total_bytes -= entry["size"]
+        for path in (self._data_path(name), self._meta_path(name), ):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def _load_entries(self):
+        """
+        index the files left in the directory by an earlier cache,
+        least recently used first
+        """
+        loaded = list()
+        for file_name in os.listdir(self._directory):
+            path = os.path.join(self._directory, file_name)
+            if file_name.endswith(".tmp"):
+                os.unlink(path)
+                continue
+            if not file_name.endswith(_meta_suffix):
+                continue
+            name = file_name[:-len(_meta_suffix)]
+            data_path = self._data_path(name)
+            try:
+                with open(path) as meta_file:
+                    entry = json.load(meta_file)
+                entry["key"] = tuple(entry["key"])
+                if os.path.getsize(data_path) != entry["size"]:
+                    raise ValueError("size mismatch")
+            except (IOError, OSError, ValueError, KeyError), instance:
+                log.msg("disk cache discarding %s: %s" % (name, instance, ),
+                        logLevel=logging.WARN)
+                for stale_path in (path, data_path, ):
+                    if os.path.exists(stale_path):
+                        os.unlink(stale_path)
+                continue
+            loaded.append((os.path.getmtime(data_path), name, entry, ))
+
+        loaded.sort()
+        for _, name, entry in loaded:
+            self._entries[name] = entry
+            self._total_bytes += entry["size"]
+        self._evict()
+
+    def _entry_name(self, collection_name, key, version_id, slice_offset,
+                    slice_size):
+        return sha1(json.dumps([collection_name, key, version_id,
+                                slice_offset, slice_size, ])).hexdigest()
+
+    def _data_path(self, name):
+        return os.path.join(self._directory, name + _data_suffix)
+
+    def _meta_path(self, name):
+        return os.path.join(self._directory, name + _meta_suffix)
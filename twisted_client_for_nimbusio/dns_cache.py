@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+dns_cache.py
+
+cache DNS lookups for the hostnames of collections, and warm up ahead of
+a batch of requests.
+
+install_dns_cache puts a CachingResolver in front of the reactor's
+resolver, so a new connection to a host looked up in the last ttl seconds
+does not wait for DNS. Lookups of the same name in progress at the same
+time are shared.
+
+warm_up_collections looks up the hostnames of a list of collections, and
+optionally opens idle connections to them, so the first requests of a
+burst do not pay for the lookup or the connection.
+"""
+import logging
+import os
+import socket
+
+from twisted.python import log
+
+from twisted.internet import reactor, defer
+from zope.interface import implements
+from twisted.internet.interfaces import IResolverSimple
+
+from twisted_client_for_nimbusio import metrics
+from twisted_client_for_nimbusio import requester
+from twisted_client_for_nimbusio.connection_pool import preconnect
+from twisted_client_for_nimbusio.lazy_log import log_debug
+
+_default_ttl = float(os.environ.get("NIMBUSIO_DNS_CACHE_TTL", "300.0"))
+_default_negative_ttl = float(
+    os.environ.get("NIMBUSIO_DNS_CACHE_NEGATIVE_TTL", "5.0"))
+
+class CachingResolver(object):
+    """
+    an IResolverSimple that remembers the addresses another resolver
+    returns for ttl seconds, and failures for negative_ttl seconds
+    """
+    implements(IResolverSimple)
+
+    def __init__(self,
+                 resolver,
+                 ttl=_default_ttl,
+                 negative_ttl=_default_negative_ttl):
+        self._resolver = resolver
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        # name -> (expires_at, address or failure)
+        self._cache = dict()
+        # name -> deferreds waiting for a lookup in progress
+        self._pending = dict()
+
+    @property
+    def resolver(self):
+        """
+        the resolver that does the lookups
+        """
+        return self._resolver
+
+    def configure(self, ttl=None, negative_ttl=None):
+        """
+        change the ttls; None leaves a ttl as it is. Entries already
+        cached keep the expiry they were given.
+        """
+        if ttl is not None:
+            self._ttl = ttl
+        if negative_ttl is not None:
+            self._negative_ttl = negative_ttl
+
+    def getHostByName(self, name, timeout=(1, 3, 11, 45)):
+        try:
+            expires_at, result = self._cache[name]
+        except KeyError:
+            pass
+        else:
+            if reactor.seconds() < expires_at:
+                metrics.increment("dns_cache.hit")
+                if isinstance(result, Exception):
+                    return defer.fail(result)
+                return defer.succeed(result)
+            del self._cache[name]
+
+        metrics.increment("dns_cache.miss")
+        deferred = defer.Deferred()
+        if name in self._pending:
+            self._pending[name].append(deferred)
+            return deferred
+
+        self._pending[name] = [deferred, ]
+        lookup_deferred = self._resolver.getHostByName(name, timeout)
+        lookup_deferred.addCallbacks(self._resolved, self._failed,
+                                     callbackArgs=(name, ),
+                                     errbackArgs=(name, ))
+        return deferred
+
+    def _resolved(self, address, name):
+        log_debug("dns cache %s = %s", name, address)
+        self._cache[name] = (reactor.seconds() + self._ttl, address, )
+        for deferred in self._pending.pop(name):
+            deferred.callback(address)
+
+    def _failed(self, failure, name):
+        log.msg("dns cache lookup of %s failed: %s" % (
+                name, failure.getErrorMessage(), ),
+                logLevel=logging.WARN)
+        if self._negative_ttl:
+            self._cache[name] = (reactor.seconds() + self._negative_ttl,
+                                 failure.value, )
+        for deferred in self._pending.pop(name):
+            deferred.errback(failure)
+
+    def prefetch(self, names):
+        """
+        look up names now, so later lookups come from the cache
+        return a deferred that fires with a dict of name to address,
+        (None for names that could not be resolved)
+        """
+        names = list(set(names))
+        deferreds = [self.getHostByName(name) for name in names]
+        deferred_list = defer.DeferredList(deferreds, consumeErrors=True)
+        deferred_list.addCallback(
+            lambda results: dict(
+                (name, (address if success else None))
+                for name, (success, address) in zip(names, results)))
+        return deferred_list
+
+    def forget(self, name):
+        self._cache.pop(name, None)
+
+    def clear(self):
+        self._cache.clear()
+
+def install_dns_cache(ttl=None, negative_ttl=None):
+    """
+    install a CachingResolver in front of the reactor's resolver,
+    or change the ttls of the one installed
+    return the CachingResolver
+    """
+    resolver = reactor.resolver
+    if not isinstance(resolver, CachingResolver):
+        resolver = CachingResolver(resolver)
+        reactor.installResolver(resolver)
+    resolver.configure(ttl, negative_ttl)
+    return resolver
+
+def _dns_name(hostname):
+    # the hostname of a collection may include a port
+    return hostname.rsplit(":", 1)[0] if ":" in hostname else hostname
+
+def _is_address(name):
+    try:
+        socket.inet_aton(name)
+    except socket.error:
+        return False
+    return True
+
+def warm_up_collections(collection_names,
+                        connections_per_host=0,
+                        connect_timeout=None):
+    """
+    look up the hostnames of collection_names (through the CachingResolver,
+    if one is installed) and open connections_per_host idle connections to
+    each
+
+    return a deferred that fires with a dict of hostname to the number of
+    connections opened, once everything has been tried. Failures are
+    logged, not raised: the requests that follow will report them.
+    """
+    hostnames = list(set([requester.collection_hostname(collection_name)
+                          for collection_name in collection_names]))
+    names = [_dns_name(hostname) for hostname in hostnames]
+    names = [name for name in names if not _is_address(name)]
+
+    if isinstance(reactor.resolver, CachingResolver):
+        deferred = reactor.resolver.prefetch(names)
+    else:
+        deferred = defer.DeferredList(
+            [reactor.resolver.getHostByName(name) for name in names],
+            consumeErrors=True)
+
+    def _preconnect(_result):
+        if not connections_per_host:
+            return dict((hostname, 0) for hostname in hostnames)
+        deferreds = [preconnect(hostname,
+                                requester._compute_uri(hostname, "/"),
+                                connections_per_host,
+                                connect_timeout)
+                     for hostname in hostnames]
+        deferred_list = defer.DeferredList(deferreds, consumeErrors=True)
+        deferred_list.addCallback(
+            lambda results: dict(
+                (hostname, (count if success else 0))
+                for hostname, (success, count) in zip(hostnames, results)))
+        return deferred_list
+
+    deferred.addCallback(_preconnect)
+    return deferred
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+file_range_producer.py
+
+an IBodyProducer that streams a local file, or a byte range of one,
+to the consumer in large chunks, computing the MD5 digest as it goes.
+
+Memory is bounded by chunk_size, whatever the size of the file. It is
+not zero-copy: each chunk is copied once, from the file (or an mmap of
+it) into the string handed to the consumer, and that string is hashed.
+
+With hash_in_thread, the hashing is done in a worker thread
+(threaded_digest.ThreadedDigest); use wait_for_digest to get the digest
+once it has caught up.
+"""
+from hashlib import md5
+import logging
+import mmap
+import os
+
+from zope.interface import implements
+
+from twisted.python import log
+
+from twisted.internet import defer, task
+from twisted.web.iweb import IBodyProducer
+
+from twisted_client_for_nimbusio import metrics
+from twisted_client_for_nimbusio.lazy_log import log_debug
+from twisted_client_for_nimbusio.threaded_digest import ThreadedDigest, \
+    default_hash_in_thread
+
+_default_chunk_size = int(
+    os.environ.get("NIMBUSIO_FILE_CHUNK_SIZE", str(1024 * 1024)))
+
+class FileRangeProducer(object):
+    """
+    an IBodyProducer for a file, or a byte range of a file
+
+    source
+        a path, or a file object opened in binary mode. A file object
+        is not closed by the producer.
+
+    offset
+        the offset of the first byte to send
+
+    length
+        the number of bytes to send. None means to the end of the file
+
+    use_mmap
+        read the file through an mmap instead of read() calls
+
+    hash_in_thread
+        update the MD5 digest in a worker thread
+    """
+    implements(IBodyProducer)
+
+    def __init__(self,
+                 source,
+                 offset=0,
+                 length=None,
+                 chunk_size=_default_chunk_size,
+                 use_mmap=False,
+                 name=None,
+                 hash_in_thread=default_hash_in_thread):
+        if isinstance(source, basestring):
+            self._path = source
+            self._file = open(source, "rb")
+            self._close_file = True
+        else:
+            self._path = None
+            self._file = source
+            self._close_file = False
+
+        file_size = os.fstat(self._file.fileno()).st_size
+        if length is None:
+            length = file_size - offset
+        assert offset >= 0 and length >= 0
+        assert offset + length <= file_size, \
+            "range %s+%s beyond end of file (%s)" % (offset, length, file_size)
+
+        self._name = (name if name is not None else self._file.name)
+        self._offset = offset
+        self._length = length
+        self._chunk_size = chunk_size
+        self._use_mmap = use_mmap and length > 0
+        self._hash_in_thread = hash_in_thread
+        self._md5 = self._new_digest()
+        self._digest_deferreds = list()
+        self._bytes_written = 0
+        self._task = None
+        self._finished = False
+        self._stopped = False
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def length(self):
+        return self._length
+
+    @property
+    def bytes_written(self):
+        return self._bytes_written
+
+    @property
+    def is_finished(self):
+        return self._finished
+
+    @property
+    def md5_digest(self):
+        """
+        the MD5 digest of the data. If it is hashed in a thread, this raises
+        DigestPendingError until the hashing has caught up: use
+        wait_for_digest
+        """
+        assert self.is_finished
+        return self._md5.digest()
+
+    def _new_digest(self):
+        return (ThreadedDigest() if self._hash_in_thread else md5())
+
+    def wait_for_digest(self):
+        """
+        return a deferred that fires with the MD5 digest of the data,
+        once it has all been sent and hashed
+        """
+        deferred = defer.Deferred()
+        if self._finished:
+            self._fire_digest(deferred)
+        else:
+            self._digest_deferreds.append(deferred)
+        return deferred
+
+    def _fire_digest(self, deferred):
+        if isinstance(self._md5, ThreadedDigest):
+            self._md5.wait_for_digest().chainDeferred(deferred)
+        else:
+            deferred.callback(self._md5.digest())
+
+    def reset(self):
+        """
+        prepare to produce the same data again, so a request can be retried
+        """
+        if self._task is not None and not (self._finished or self._stopped):
+            self._stopped = True
+            self._task.stop()
+        if self._path is not None and self._file.closed:
+            self._file = open(self._path, "rb")
+        self._md5 = self._new_digest()
+        self._bytes_written = 0
+        self._task = None
+        self._finished = False
+        self._stopped = False
+
+    def _read_chunks(self):
+        # seek before every read: several producers may share one file
+        position = self._offset
+        bytes_remaining = self._length
+        while bytes_remaining > 0:
+            self._file.seek(position)
+            data = self._file.read(min(self._chunk_size, bytes_remaining))
+            if len(data) == 0:
+                raise IOError("%s: unexpected end of file %s bytes short" % (
+                              self._name, bytes_remaining, ))
+            position += len(data)
+            bytes_remaining -= len(data)
+            yield data
+
+    def _mmap_chunks(self):
+        # mmap offsets must be a multiple of the allocation granularity
+        map_offset = self._offset - (self._offset % mmap.ALLOCATIONGRANULARITY)
+        skip = self._offset - map_offset
+        file_map = mmap.mmap(self._file.fileno(),
+                             skip + self._length,
+                             access=mmap.ACCESS_READ,
+                             offset=map_offset)
+        try:
+            start = skip
+            end = skip + self._length
+            while start < end:
+                data = file_map[start:min(start + self._chunk_size, end)]
+                start += len(data)
+                yield data
+        finally:
+            file_map.close()
+
+    def _produce(self, consumer):
+        chunks = (self._mmap_chunks() if self._use_mmap
+                  else self._read_chunks())
+        for data in chunks:
+            consumer.write(data)
+            self._md5.update(data)
+            self._bytes_written += len(data)
+            metrics.increment("bytes_sent", len(data))
+            yield None
+
+        log_debug("%s finished %s bytes", self._name, self._bytes_written)
+        self._finished = True
+        self._close()
+        digest_deferreds, self._digest_deferreds = \
+            self._digest_deferreds, list()
+        for deferred in digest_deferreds:
+            self._fire_digest(deferred)
+
+    def _close(self):
+        if self._close_file:
+            self._file.close()
+
+    def addConsumer(self, _consumer):
+        """
+        consumers in this package call addConsumer from registerProducer.
+        The data goes to the consumer passed to startProducing
+        """
+        pass
+
+    def startProducing(self, consumer):
+        log_debug("%s startProducing", self._name)
+        assert self._task is None
+        self._task = task.cooperate(self._produce(consumer))
+        deferred = self._task.whenDone()
+
+        def _done(_result):
+            return None
+
+        def _stopped(failure):
+            # the consumer has given up on us, nobody is listening
+            failure.trap(task.TaskStopped)
+            return defer.Deferred()
+
+        def _failed(failure):
+            self._close()
+            return failure
+
+        deferred.addCallback(_done)
+        deferred.addErrback(_stopped)
+        deferred.addErrback(_failed)
+        return deferred
+
+    def pauseProducing(self):
+        log_debug("%s pauseProducing", self._name)
+        if not (self._finished or self._stopped):
+            self._task.pause()
+
+    def resumeProducing(self):
+        log_debug("%s resumeProducing", self._name)
+        if not (self._finished or self._stopped):
+            self._task.resume()
+
+    def stopProducing(self):
+        log.msg("%s stopProducing" % (self._name, ), logLevel=logging.WARN)
+        if self._task is not None and not (self._finished or self._stopped):
+            self._stopped = True
+            self._task.stop()
+            self._close()
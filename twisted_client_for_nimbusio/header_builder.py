@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+header_builder.py
+
+build the headers every nimbus.io request carries: the timestamp, the
+agent, and the Authorization signature, with as little work per request
+as possible.
+
+ * the HMAC of each identity is keyed once, and copied for each signature
+ * unquoted paths are remembered
+
+The first signature for each identity is checked against
+lumberyard.http_util.compute_authentication_string; if they differ,
+that identity is always signed by lumberyard.
+"""
+import hashlib
+import hmac
+import logging
+import os
+import urllib
+
+from twisted.python import log
+
+from twisted.web.http_headers import Headers
+
+from lumberyard.http_util import current_timestamp, \
+        compute_authentication_string
+
+_max_unquoted_paths = int(
+    os.environ.get("NIMBUSIO_UNQUOTED_PATH_CACHE_SIZE", "10000"))
+
+class _Signer(object):
+    """
+    sign requests for one identity with a pre-keyed HMAC
+    """
+    def __init__(self, identity):
+        self._identity = identity
+        self._hmac = hmac.new(str(identity.auth_key),
+                              digestmod=hashlib.sha256)
+        self._message_prefix = "%s\n" % (identity.user_name, )
+        self._signature_prefix = "NIMBUS.IO %s:" % (identity.auth_key_id, )
+        self._verified = False
+        self._use_lumberyard = False
+
+    def sign(self, method, timestamp, unquoted_path):
+        if self._use_lumberyard:
+            return self._lumberyard_sign(method, timestamp, unquoted_path)
+
+        signature_hmac = self._hmac.copy()
+        signature_hmac.update("".join([self._message_prefix,
+                                       method, "\n",
+                                       str(timestamp), "\n",
+                                       unquoted_path]))
+        signature = self._signature_prefix + signature_hmac.hexdigest()
+
+        if not self._verified:
+            expected = self._lumberyard_sign(method, timestamp, unquoted_path)
+            if signature != expected:
+                log.msg("header builder signature differs from lumberyard "
+                        "for %s, using lumberyard" % (
+                        self._identity.user_name, ),
+                        logLevel=logging.WARN)
+                self._use_lumberyard = True
+                signature = expected
+            self._verified = True
+
+        return signature
+
+    def _lumberyard_sign(self, method, timestamp, unquoted_path):
+        return compute_authentication_string(self._identity.auth_key_id,
+                                             self._identity.auth_key,
+                                             self._identity.user_name,
+                                             method,
+                                             timestamp,
+                                             unquoted_path)
+
+class HeaderBuilder(object):
+    """
+    build request headers, signed for an identity (or unsigned for None)
+    """
+    def __init__(self, agent_name):
+        self._agent_values = [agent_name, ]
+        self._signers = dict()
+        self._unquoted_paths = dict()
+
+    def build(self, identity, method, path):
+        """
+        return a new Headers for a request
+        """
+        timestamp = current_timestamp()
+
+        raw_headers = {"x-nimbus-io-timestamp"  : [str(timestamp), ],
+                       "agent"                  : list(self._agent_values)}
+        if identity is not None:
+            raw_headers["authorization"] = \
+                [self._signature(identity, method, path, timestamp), ]
+
+        return Headers(raw_headers)
+
+    def _signature(self, identity, method, path, timestamp):
+        try:
+            signer = self._signers[identity]
+        except KeyError:
+            signer = _Signer(identity)
+            self._signers[identity] = signer
+        return signer.sign(method, timestamp, self._unquote(path))
+
+    def _unquote(self, path):
+        try:
+            return self._unquoted_paths[path]
+        except KeyError:
+            if len(self._unquoted_paths) >= _max_unquoted_paths:
+                self._unquoted_paths.clear()
+            unquoted_path = urllib.unquote_plus(path)
+            self._unquoted_paths[path] = unquoted_path
+            return unquoted_path
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+lazy_log.py
+
+level-gated logging for the hot paths: the message is only formatted,
+and only passed to twisted.python.log, if its level is enabled.
+
+By default every message is logged. To leave out the
+messages below a level, set NIMBUSIO_LOG_LEVEL (a number or a name such
+as INFO), or call set_log_level.
+
+Per-chunk events use trace(), which is off unless a sample rate is set
+(NIMBUSIO_TRACE_SAMPLE_RATE or set_trace_sample_rate): with rate N,
+one chunk event in N is logged at DEBUG.
+"""
+import logging
+import os
+
+from twisted.python import log
+
+def _parse_level(value):
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return logging.getLevelName(value.upper())
+
+_log_level = _parse_level(os.environ.get("NIMBUSIO_LOG_LEVEL"))
+_trace_sample_rate = int(os.environ.get("NIMBUSIO_TRACE_SAMPLE_RATE", "0"))
+_trace_count = 0
+
+def set_log_level(level):
+    """
+    log messages at level and above. None logs every message
+    """
+    global _log_level
+    _log_level = level
+
+def set_trace_sample_rate(rate):
+    """
+    log one chunk event in rate at DEBUG. 0 turns tracing off
+    """
+    global _trace_sample_rate, _trace_count
+    _trace_sample_rate = rate
+    _trace_count = 0
+
+def is_enabled(level):
+    return _log_level is None or level >= _log_level
+
+def log_debug(format_string, *args):
+    if is_enabled(logging.DEBUG):
+        log.msg(format_string % args, logLevel=logging.DEBUG)
+
+def trace(format_string, *args):
+    """
+    log a sample of per-chunk events
+    """
+    global _trace_count
+    if _trace_sample_rate == 0:
+        return
+    _trace_count += 1
+    if _trace_count % _trace_sample_rate == 0:
+        log_debug(format_string, *args)
@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+"""
+listing.py
+
+page through list keys and list versions, so a caller can start work on
+the first keys of a large collection while the rest are still listed.
+
+    listing = list_keys(identity, collection_name, prefix="a")
+    deferred = listing.for_each(process_key_entry)
+
+or, with inlineCallbacks
+
+    while True:
+        entries = yield listing.next_page()
+        if entries is None:
+            break
+        ...
+
+Each page is requested with max_keys and a marker after the last entry of
+the page before, and parsed as it arrives by ListingConsumer. The next
+page is requested as soon as a page arrives, while the caller works
+through it.
+
+ShardedListing splits a large listing into shards, listed several at a
+time, and delivers the entries in order through the same interface.
+"""
+from collections import deque
+import os
+
+from twisted.python import failure
+from twisted.internet import defer
+
+from twisted_client_for_nimbusio.rest_api import compute_list_keys_path, \
+    compute_list_versions_path
+from twisted_client_for_nimbusio.scheduler import \
+    collection_request_function
+from twisted_client_for_nimbusio.listing_consumer import ListingConsumer
+from twisted_client_for_nimbusio.lazy_log import log_debug
+
+_default_page_size = int(os.environ.get("NIMBUSIO_LIST_PAGE_SIZE", "1000"))
+_default_shard_count = int(os.environ.get("NIMBUSIO_LIST_SHARDS", "16"))
+_default_shard_concurrency = int(
+    os.environ.get("NIMBUSIO_LIST_CONCURRENCY", "8"))
+_default_max_buffered_pages = 4
+
+# the characters keys usually start with, in sort order
+_default_alphabet = "-.0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+
+def _entry_key(entry):
+    return entry.get("key", entry.get("prefix"))
+
+@defer.inlineCallbacks
+def _for_each_entry(listing, function):
+    while True:
+        entries = yield listing.next_page()
+        if entries is None:
+            break
+        for entry in entries:
+            yield function(entry)
+    defer.returnValue(listing.entry_count)
+
+class Listing(object):
+    """
+    a listing of the keys, or versions, of a collection, one page at a time
+
+    Entries are the dicts of key_data (or version_data) from the listing.
+    With a delimiter, the common prefixes are entries too: {"prefix" : p}
+
+    page_size
+        the max_keys of each request
+
+    prefetch
+        request the next page as soon as a page arrives
+
+    scheduler
+        a RequestScheduler to queue the requests through. If None, requests
+        start immediately
+
+    Extra keyword arguments are passed to the requests.
+    """
+    def __init__(self,
+                 identity,
+                 collection_name,
+                 prefix="",
+                 versions=False,
+                 page_size=_default_page_size,
+                 delimiter=None,
+                 marker=None,
+                 version_id_marker=None,
+                 prefetch=True,
+                 scheduler=None,
+                 **kwargs):
+        self._identity = identity
+        self._collection_name = collection_name
+        self._prefix = prefix
+        self._versions = versions
+        self._page_size = page_size
+        self._delimiter = delimiter
+        self._marker = marker
+        self._version_id_marker = version_id_marker
+        self._prefetch = prefetch
+        self._request_kwargs = kwargs
+        self._start_collection_request = \
+            collection_request_function(scheduler)
+
+        self._truncated = True
+        self._pending = None
+        self._page_count = 0
+        self._entry_count = 0
+
+    @property
+    def page_count(self):
+        return self._page_count
+
+    @property
+    def entry_count(self):
+        return self._entry_count
+
+    @property
+    def is_finished(self):
+        """
+        True when the last page has been requested
+        """
+        return not self._truncated
+
+    def next_page(self):
+        """
+        return a deferred that fires with the list of entries of the next
+        page, or with None when there are no more. Wait for it to fire
+        before asking for the page after.
+        """
+        if self._pending is not None:
+            deferred, self._pending = self._pending, None
+        elif self._truncated:
+            deferred = self._request_page()
+        else:
+            return defer.succeed(None)
+
+        if self._prefetch:
+            deferred.addCallback(self._start_prefetch)
+        return deferred
+
+    def for_each(self, function):
+        """
+        call function with every entry, in order. If function returns a
+        deferred, the next entry waits for it.
+        return a deferred that fires with the number of entries
+        """
+        return _for_each_entry(self, function)
+
+    def _start_prefetch(self, entries):
+        if entries is not None and self._truncated and self._pending is None:
+            # a failed prefetch is reported by the next call to next_page
+            self._pending = self._request_page()
+        return entries
+
+    def _compute_path(self):
+        if self._versions:
+            return compute_list_versions_path(
+                prefix=self._prefix,
+                max_keys=self._page_size,
+                delimiter=self._delimiter,
+                key_marker=self._marker,
+                version_id_marker=self._version_id_marker)
+        return compute_list_keys_path(prefix=self._prefix,
+                                      max_keys=self._page_size,
+                                      delimiter=self._delimiter,
+                                      marker=self._marker)
+
+    def _request_page(self):
+        path = self._compute_path()
+        log_debug("listing %s page %s %r", self._collection_name,
+                  self._page_count + 1, path)
+        # assume this is the last page until the response says otherwise,
+        # and move the marker on when the response arrives
+        self._truncated = False
+        entries = list()
+        consumer = ListingConsumer(entries.append)
+        deferred = self._start_collection_request(self._identity,
+                                                  "GET",
+                                                  self._collection_name,
+                                                  path,
+                                                  response_consumer=consumer,
+                                                  **self._request_kwargs)
+        deferred.addCallback(self._page_result, consumer, entries)
+        return deferred
+
+    def _page_result(self, _result, consumer, entries):
+        result = consumer.result
+        self._page_count += 1
+        self._entry_count += len(entries)
+        # an empty page cannot move the marker on
+        self._truncated = bool(result.get("truncated")) and len(entries) > 0
+        if self._truncated:
+            self._advance_marker(entries)
+        return entries
+
+    def _advance_marker(self, entries):
+        last_key = None
+        last_version_id = None
+        for entry in entries:
+            entry_key = _entry_key(entry)
+            if last_key is None or entry_key >= last_key:
+                last_key = entry_key
+                last_version_id = entry.get("version_identifier")
+        self._marker = last_key
+        if self._versions:
+            self._version_id_marker = last_version_id
+
+def compute_shard_boundaries(shard_count, alphabet=_default_alphabet):
+    """
+    split the characters of alphabet into shard_count ranges
+    return the shard_count - 1 characters between the ranges
+    """
+    shard_count = max(1, min(shard_count, len(alphabet)))
+    return [alphabet[(index * len(alphabet)) // shard_count]
+            for index in range(1, shard_count)]
+
+class ShardedListing(object):
+    """
+    a listing of the keys, or versions, of a collection, split into shards
+    that are listed at the same time. The entries come out in order,
+    through next_page and for_each, as from Listing.
+
+    Without a separator, the keys after prefix are split by character
+    range (compute_shard_boundaries): each shard lists from the marker
+    prefix + boundary up to the next boundary, so every key is in exactly
+    one shard.
+
+    With a separator, the top level below prefix is listed first, with the
+    separator as delimiter. Each common prefix found is then a shard.
+
+    concurrency
+        the number of shards listed at once
+
+    max_buffered_pages
+        the number of pages a shard lists ahead of the caller
+
+    A shard asks for its next page as soon as there is room to buffer it,
+    so the Listings of the shards do not prefetch: a prefetch past the
+    upper bound of a shard would be a wasted request.
+
+    Other keyword arguments are passed to Listing.
+    """
+    def __init__(self,
+                 identity,
+                 collection_name,
+                 prefix="",
+                 versions=False,
+                 shard_count=_default_shard_count,
+                 separator=None,
+                 concurrency=_default_shard_concurrency,
+                 max_buffered_pages=_default_max_buffered_pages,
+                 **kwargs):
+        self._identity = identity
+        self._collection_name = collection_name
+        self._prefix = (prefix or "")
+        self._versions = versions
+        self._shard_count = shard_count
+        self._separator = separator
+        self._semaphore = defer.DeferredSemaphore(concurrency)
+        self._max_buffered_pages = max_buffered_pages
+        kwargs.pop("prefetch", None)
+        self._listing_kwargs = kwargs
+
+        self._shards = None
+        self._head = 0
+        self._reader = None
+        self._page_count = 0
+        self._entry_count = 0
+
+    @property
+    def page_count(self):
+        return self._page_count
+
+    @property
+    def entry_count(self):
+        return self._entry_count
+
+    @property
+    def shard_count(self):
+        """
+        the number of shards, once the listing has started
+        """
+        return (None if self._shards is None else len(self._shards))
+
+    def next_page(self):
+        """
+        return a deferred that fires with the next list of entries, in
+        order, or with None when there are no more. Wait for it to fire
+        before asking for the page after.
+        """
+        if self._shards is None:
+            deferred = self._create_shards()
+            deferred.addCallback(self._start_shards)
+            deferred.addCallback(lambda _: self.next_page())
+            return deferred
+
+        while self._head < len(self._shards):
+            shard = self._shards[self._head]
+            if len(shard["pages"]) > 0:
+                entries = shard["pages"].popleft()
+                self._make_room(shard)
+                self._page_count += 1
+                self._entry_count += len(entries)
+                return defer.succeed(entries)
+            if shard["failure"] is not None:
+                return defer.fail(shard["failure"])
+            if not shard["done"]:
+                self._reader = defer.Deferred()
+                self._reader.addCallback(lambda _: self.next_page())
+                return self._reader
+            self._head += 1
+
+        return defer.succeed(None)
+
+    def for_each(self, function):
+        """
+        call function with every entry, in order. If function returns a
+        deferred, the next entry waits for it.
+        return a deferred that fires with the number of entries
+        """
+        return _for_each_entry(self, function)
+
+    def _new_shard(self, listing, upper_bound):
+        return {"listing"       : listing,
+                "upper-bound"   : upper_bound,
+                "pages"         : deque(),
+                "room"          : None,
+                "done"          : False,
+                "failure"       : None}
+
+    def _new_listing(self, prefix, marker=None, delimiter=None,
+                     prefetch=False):
+        return Listing(self._identity,
+                       self._collection_name,
+                       prefix=prefix,
+                       versions=self._versions,
+                       marker=marker,
+                       delimiter=delimiter,
+                       prefetch=prefetch,
+                       **self._listing_kwargs)
+
+    def _create_shards(self):
+        if self._separator is None:
+            return defer.succeed(self._create_range_shards())
+        return self._create_separator_shards()
+
+    def _create_range_shards(self):
+        bounds = [self._prefix + boundary for boundary in
+                  compute_shard_boundaries(self._shard_count)]
+        lower_bounds = [None, ] + bounds
+        upper_bounds = bounds + [None, ]
+        return [self._new_shard(self._new_listing(self._prefix, marker=lower),
+                                upper)
+                for lower, upper in zip(lower_bounds, upper_bounds)]
+
+    def _create_separator_shards(self):
+        top_entries = list()
+        top_listing = self._new_listing(self._prefix,
+                                        delimiter=self._separator,
+                                        prefetch=True)
+        deferred = top_listing.for_each(top_entries.append)
+
+        def _split(_result):
+            top_entries.sort(key=_entry_key)
+            shards = list()
+            keys = list()
+            for entry in top_entries:
+                if "prefix" not in entry:
+                    keys.append(entry)
+                    continue
+                if len(keys) > 0:
+                    shards.append(self._listed_shard(keys))
+                    keys = list()
+                shards.append(self._new_shard(
+                              self._new_listing(entry["prefix"]), None))
+            if len(keys) > 0:
+                shards.append(self._listed_shard(keys))
+            return shards
+
+        deferred.addCallback(_split)
+        return deferred
+
+    def _listed_shard(self, entries):
+        shard = self._new_shard(None, None)
+        shard["pages"].append(entries)
+        shard["done"] = True
+        return shard
+
+    def _start_shards(self, shards):
+        log_debug("sharded listing %s %r %s shards",
+                  self._collection_name, self._prefix, len(shards))
+        self._shards = shards
+        for shard in shards:
+            if not shard["done"]:
+                self._semaphore.run(self._list_shard, shard)
+
+    @defer.inlineCallbacks
+    def _list_shard(self, shard):
+        listing = shard["listing"]
+        upper_bound = shard["upper-bound"]
+        try:
+            while True:
+                while len(shard["pages"]) >= self._max_buffered_pages:
+                    shard["room"] = defer.Deferred()
+                    yield shard["room"]
+                entries = yield listing.next_page()
+                if entries is None:
+                    break
+                if upper_bound is not None and len(entries) > 0 and \
+                    _entry_key(entries[-1]) > upper_bound:
+                    entries = [entry for entry in entries
+                               if _entry_key(entry) <= upper_bound]
+                    if len(entries) > 0:
+                        shard["pages"].append(entries)
+                    break
+                if len(entries) > 0:
+                    shard["pages"].append(entries)
+                    self._wake_reader()
+        except Exception:
+            shard["failure"] = failure.Failure()
+        shard["done"] = True
+        self._wake_reader()
+
+    def _make_room(self, shard):
+        if shard["room"] is not None:
+            room, shard["room"] = shard["room"], None
+            room.callback(None)
+
+    def _wake_reader(self):
+        if self._reader is not None:
+            reader, self._reader = self._reader, None
+            reader.callback(None)
+
+def list_keys(identity, collection_name, prefix="", **kwargs):
+    """
+    return a Listing of the keys of a collection
+    """
+    return Listing(identity, collection_name, prefix=prefix, **kwargs)
+
+def list_versions(identity, collection_name, prefix="", **kwargs):
+    """
+    return a Listing of the versions of all the keys of a collection
+    """
+    return Listing(identity, collection_name, prefix=prefix, versions=True,
+                   **kwargs)
+
+def list_keys_sharded(identity, collection_name, prefix="", **kwargs):
+    """
+    return a ShardedListing of the keys of a collection
+    """
+    return ShardedListing(identity, collection_name, prefix=prefix, **kwargs)
+
+def list_versions_sharded(identity, collection_name, prefix="", **kwargs):
+    """
+    return a ShardedListing of the versions of all the keys of a collection
+    """
+    return ShardedListing(identity, collection_name, prefix=prefix,
+                          versions=True, **kwargs)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+listing_consumer.py
+
+An IConsumer that parses a list keys or list versions response as it
+arrives, passing each entry on as soon as it is complete, instead of
+buffering the whole document for json.loads.
+"""
+import json
+import re
+
+from zope.interface import implements
+from twisted.internet.interfaces import IConsumer
+
+_entry_array_names = frozenset(["key_data", "version_data", "prefixes", ])
+_structural_re = re.compile(r'["{}\[\]]')
+_string_special_re = re.compile(r'["\\]')
+
+class ListingConsumer(object):
+    """
+    An IConsumer that parses nimbus.io listing JSON incrementally
+
+    entry_callback is called with each dict of key_data or version_data,
+    and with {"prefix" : p} for each of the common prefixes, in the order
+    they appear. (The put method of a DeferredQueue will do.)
+
+    Only the entry being parsed is held in memory. The rest of the
+    document (truncated, for instance) is available from the result
+    property when the response is complete.
+    """
+    implements(IConsumer)
+
+    def __init__(self, entry_callback):
+        self._entry_callback = entry_callback
+        self._producer = None
+        self._entry_count = 0
+
+        self._text = ""
+        self._position = 0
+        self._depth = 0
+        self._in_string = False
+        self._string_start = None
+        self._member_name = None
+        self._array_name = None
+        self._entry_start = None
+        self._skeleton = list()
+        self._skeleton_start = 0
+
+    @property
+    def entry_count(self):
+        return self._entry_count
+
+    @property
+    def result(self):
+        """
+        the top level of the document, with the entry lists empty
+        """
+        if self._depth != 0 or self._in_string:
+            raise ValueError("incomplete listing: %s entries" % (
+                             self._entry_count, ))
+        return json.loads("".join(self._skeleton) +
+                          self._text[self._skeleton_start:])
+
+    def registerProducer(self, producer, _streaming):
+        self._producer = producer
+        producer.addConsumer(self)
+
+    def unregisterProducer(self):
+        self._producer = None
+
+    def write(self, data):
+        self._text += data
+        self._scan()
+        self._trim()
+
+    def _scan(self):
+        text = self._text
+        position = self._position
+        while True:
+            if self._in_string:
+                match = _string_special_re.search(text, position)
+                if match is None:
+                    position = len(text)
+                    break
+                if match.group() == "\\":
+                    if match.end() == len(text):
+                        # the escaped character has not arrived yet
+                        position = match.start()
+                        break
+                    position = match.end() + 1
+                    continue
+                position = match.end()
+                self._in_string = False
+                self._string_ended(text, position)
+                continue
+
+            match = _structural_re.search(text, position)
+            if match is None:
+                position = len(text)
+                break
+            char = match.group()
+            position = match.end()
+            if char == '"':
+                self._in_string = True
+                self._string_start = match.start()
+            elif char == "{" or char == "[":
+                self._depth += 1
+                if self._depth == 2 and char == "[" and \
+                    self._member_name in _entry_array_names:
+                    self._array_name = self._member_name
+                    self._skeleton.append(text[self._skeleton_start:position])
+                elif self._depth == 3 and self._array_name is not None:
+                    self._entry_start = match.start()
+            else:
+                if self._depth == 3 and self._entry_start is not None:
+                    self._emit(text[self._entry_start:position])
+                    self._entry_start = None
+                elif self._depth == 2 and self._array_name is not None:
+                    self._array_name = None
+                    self._skeleton_start = match.start()
+                self._depth -= 1
+        self._position = position
+
+    def _string_ended(self, text, position):
+        if self._depth == 1:
+            self._member_name = text[self._string_start + 1:position - 1]
+        elif self._depth == 2 and self._array_name is not None:
+            self._emit(text[self._string_start:position])
+
+    def _emit(self, entry_text):
+        entry = json.loads(entry_text)
+        if not isinstance(entry, dict):
+            entry = {"prefix" : entry}
+        self._entry_count += 1
+        self._entry_callback(entry)
+
+    def _trim(self):
+        """
+        discard the text we no longer need: everything scanned, except the
+        entry or string in progress and the document outside the entries
+        """
+        cut = self._position
+        if self._in_string:
+            cut = min(cut, self._string_start)
+        if self._entry_start is not None:
+            cut = min(cut, self._entry_start)
+        if self._array_name is None:
+            self._skeleton.append(self._text[self._skeleton_start:cut])
+            self._skeleton_start = 0
+        if cut == 0:
+            return
+
+        self._text = self._text[cut:]
+        self._position -= cut
+        if self._string_start is not None:
+            self._string_start -= cut
+        if self._entry_start is not None:
+            self._entry_start -= cut
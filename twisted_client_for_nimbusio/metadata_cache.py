@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+metadata_cache.py
+
+an in-process cache of the headers returned by HEAD, keyed by
+(collection, key, version), so repeated checks of size, MD5 and version
+do not go to the network.
+
+Entries expire after ttl seconds, and the least recently used entries
+are evicted when there are more than max_entries. The cache fills itself
+from HEAD responses made through MetadataCache.head, and from archive
+results passed to record_archive. Archiving, deleting or finishing a
+conjoined archive of a key drops every cached version of it.
+"""
+import base64
+import binascii
+from collections import OrderedDict
+import os
+
+from twisted.internet import reactor, defer
+
+from twisted_client_for_nimbusio import metrics
+from twisted_client_for_nimbusio.rest_api import compute_head_path
+from twisted_client_for_nimbusio.scheduler import \
+    collection_request_function
+from twisted_client_for_nimbusio.lazy_log import log_debug
+
+_default_max_entries = int(
+    os.environ.get("NIMBUSIO_METADATA_CACHE_SIZE", "10000"))
+_default_ttl = float(
+    os.environ.get("NIMBUSIO_METADATA_CACHE_TTL", "60.0"))
+
+def md5_digest_from_headers(headers):
+    """
+    return the binary MD5 digest from the Content-MD5 header of a HEAD
+    result, which may be base64 or hex encoded, or None if there is none
+    """
+    for name, values in headers.items():
+        if name.lower() == "content-md5":
+            value = values[0].strip()
+            break
+    else:
+        return None
+
+    if len(value) == 32:
+        try:
+            return binascii.unhexlify(value)
+        except TypeError:
+            pass
+    try:
+        return base64.b64decode(value)
+    except TypeError:
+        return None
+
+def content_length_from_headers(headers):
+    """
+    return the Content-Length of a HEAD result as an int, or None if there
+    is none
+    """
+    for name, values in headers.items():
+        if name.lower() == "content-length":
+            return int(values[0])
+    return None
+
+class MetadataCache(object):
+    """
+    cache HEAD results
+
+    max_entries
+        the number of (collection, key, version) entries kept. The least
+        recently used entry is evicted to make room for a new one
+
+    ttl
+        seconds an entry stays valid. None keeps entries until they are
+        evicted or invalidated
+    """
+    def __init__(self, max_entries=_default_max_entries, ttl=_default_ttl):
+        assert max_entries > 0
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._versions_by_key = dict()
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, collection_name, key, version_id=None):
+        """
+        return a copy of the cached headers, or None if there are none
+        or they have expired
+        """
+        cache_key = (collection_name, key, version_id, )
+        try:
+            expires_at, headers = self._entries.pop(cache_key)
+        except KeyError:
+            self._misses += 1
+            metrics.increment("metadata_cache.miss")
+            return None
+
+        if expires_at is not None and reactor.seconds() >= expires_at:
+            self._forget_version(cache_key)
+            self._misses += 1
+            metrics.increment("metadata_cache.miss")
+            return None
+
+        # re-inserting moves the entry to the most recently used end
+        self._entries[cache_key] = (expires_at, headers, )
+        self._hits += 1
+        metrics.increment("metadata_cache.hit")
+        return dict(headers)
+
+    def put(self, collection_name, key, headers, version_id=None):
+        """
+        cache headers (a dict of lists of values, as returned by HEAD)
+        """
+        cache_key = (collection_name, key, version_id, )
+        self._entries.pop(cache_key, None)
+        expires_at = (None if self._ttl is None
+                      else reactor.seconds() + self._ttl)
+        self._entries[cache_key] = (expires_at, dict(headers), )
+        self._versions_by_key.setdefault(
+            (collection_name, key, ), set()).add(version_id)
+
+        while len(self._entries) > self._max_entries:
+            evicted_key, _ = self._entries.popitem(last=False)
+            self._forget_version(evicted_key)
+
+    def invalidate(self, collection_name, key):
+        """
+        drop every cached version of key. Call this after deleting a key
+        """
+        versions = self._versions_by_key.pop((collection_name, key, ), ())
+        for version_id in versions:
+            self._entries.pop((collection_name, key, version_id, ), None)
+        if versions:
+            log_debug("metadata cache invalidated %r in %s",
+                      key, collection_name)
+
+    def clear(self):
+        self._entries.clear()
+        self._versions_by_key.clear()
+
+    def record_archive(self, collection_name, key, result,
+                       length=None, md5_digest=None, latest=False):
+        """
+        record a successful archive of key, with result the parsed archive
+        result. Cached versions of key are dropped; if the length (and
+        binary md5_digest) of the data is known, the new version is cached,
+        and with latest, cached as the current version of key too
+        """
+        self.invalidate(collection_name, key)
+        version_id = result.get("version_identifier")
+        if version_id is None or length is None:
+            return
+        headers = {"Content-Length" : [str(length), ]}
+        if md5_digest is not None:
+            headers["Content-MD5"] = [base64.b64encode(md5_digest), ]
+        self.put(collection_name, key, headers, version_id=version_id)
+        if latest:
+            self.put(collection_name, key, headers)
+
+    def head(self, identity, collection_name, key, version_id=None,
+             scheduler=None, **kwargs):
+        """
+        return a deferred that fires with the headers of key, from the
+        cache if they are there, otherwise from a HEAD request whose result
+        is cached. Extra keyword arguments are passed to the request
+        """
+        headers = self.get(collection_name, key, version_id)
+        if headers is not None:
+            return defer.succeed(headers)
+
+        request = collection_request_function(scheduler)
+        path = compute_head_path(key, version_identifier=version_id)
+        deferred = request(identity, "HEAD", collection_name, path, **kwargs)
+
+        def _cache_result(result):
+            self.put(collection_name, key, result, version_id=version_id)
+            return dict(result)
+
+        deferred.addCallback(_cache_result)
+        return deferred
+
+    def _forget_version(self, cache_key):
+        collection_name, key, version_id = cache_key
+        versions = self._versions_by_key.get((collection_name, key, ))
+        if versions is None:
+            return
+        versions.discard(version_id)
+        if not versions:
+            del self._versions_by_key[(collection_name, key, )]
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+metrics.py
+
+counters, gauges and timings from the hot paths of the client, sent to a
+pluggable sink:
+
+ * NullSink (the default) discards everything
+ * InMemoryRegistry keeps totals and recent samples for inspection
+ * StatsdSink sends StatsD lines over UDP
+ * CallbackSink passes every measurement to a function
+
+Install a sink with set_metrics_sink. Metric names:
+
+ * requests                 counter, tags method, status
+ * requests_in_flight       gauge
+ * request.connect          timing of new connections
+ * request.first_byte       timing from starting a request to its response
+ * request.total            timing of the whole request, including retries
+ * bytes_sent               counter, bytes written by body producers
+ * bytes_received           counter, bytes of response bodies
+ * consumer_writes          counter, writes to response consumers
+ * producer.bytes_buffered  gauge, PassThruProducer buffered bytes
+ * metadata_cache.hit       counter, MetadataCache lookups answered
+ * metadata_cache.miss      counter, MetadataCache lookups not answered
+ * disk_cache.hit           counter, DiskObjectCache retrieves from disk
+ * disk_cache.miss          counter, DiskObjectCache retrieves from nimbus.io
+ * dns_cache.hit            counter, CachingResolver lookups answered
+ * dns_cache.miss           counter, CachingResolver lookups not answered
+ * verifying_consumer.mismatch  counter, retrieves that failed verification
+"""
+from collections import deque
+import socket
+
+class NullSink(object):
+    """
+    discard all measurements
+    """
+    def increment(self, name, value=1, tags=None):
+        pass
+
+    def gauge(self, name, value, tags=None):
+        pass
+
+    def timing(self, name, seconds, tags=None):
+        pass
+
+def _registry_key(name, tags):
+    if not tags:
+        return name
+    return (name, tuple(sorted(tags.items())), )
+
+class InMemoryRegistry(object):
+    """
+    keep counter totals, the latest gauge values, and timing
+    statistics with the most recent max_samples values for percentiles
+    """
+    def __init__(self, max_samples=1000):
+        self._max_samples = max_samples
+        self._counters = dict()
+        self._gauges = dict()
+        self._timings = dict()
+
+    def increment(self, name, value=1, tags=None):
+        key = _registry_key(name, tags)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name, value, tags=None):
+        self._gauges[_registry_key(name, tags)] = value
+
+    def timing(self, name, seconds, tags=None):
+        key = _registry_key(name, tags)
+        try:
+            entry = self._timings[key]
+        except KeyError:
+            entry = {"count"    : 0,
+                     "total"    : 0.0,
+                     "min"      : seconds,
+                     "max"      : seconds,
+                     "samples"  : deque(maxlen=self._max_samples)}
+            self._timings[key] = entry
+        entry["count"] += 1
+        entry["total"] += seconds
+        entry["min"] = min(entry["min"], seconds)
+        entry["max"] = max(entry["max"], seconds)
+        entry["samples"].append(seconds)
+
+    def counter(self, name, tags=None):
+        return self._counters.get(_registry_key(name, tags), 0)
+
+    def gauge_value(self, name, tags=None):
+        return self._gauges.get(_registry_key(name, tags))
+
+    def percentile(self, name, percent, tags=None):
+        """
+        return the percent (0 - 100) percentile of the recent samples
+        of a timing, or None if there are none
+        """
+        entry = self._timings.get(_registry_key(name, tags))
+        if entry is None or len(entry["samples"]) == 0:
+            return None
+        return self._percentile_of(entry, percent)
+
+    def snapshot(self):
+        """
+        return a dict of everything measured so far
+        """
+        timings = dict()
+        for key, entry in self._timings.items():
+            timings[key] = {"count" : entry["count"],
+                            "total" : entry["total"],
+                            "min"   : entry["min"],
+                            "max"   : entry["max"],
+                            "mean"  : entry["total"] / entry["count"],
+                            "p50"   : self._percentile_of(entry, 50),
+                            "p99"   : self._percentile_of(entry, 99)}
+        return {"counters"  : dict(self._counters),
+                "gauges"    : dict(self._gauges),
+                "timings"   : timings}
+
+    def _percentile_of(self, entry, percent):
+        samples = sorted(entry["samples"])
+        return samples[int(round((percent / 100.0) * (len(samples) - 1)))]
+
+    def clear(self):
+        self._counters.clear()
+        self._gauges.clear()
+        self._timings.clear()
+
+class StatsdSink(object):
+    """
+    send measurements to a StatsD server over UDP. Tag values are
+    appended to the metric name: requests.GET.200
+    Send errors are ignored, metrics must never break a request.
+    """
+    def __init__(self, host="127.0.0.1", port=8125, prefix="nimbusio"):
+        self._address = (host, port, )
+        self._prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def _name(self, name, tags):
+        parts = [self._prefix, name, ] if self._prefix else [name, ]
+        if tags:
+            parts.extend([str(tags[key]) for key in sorted(tags.keys())])
+        return ".".join(parts)
+
+    def _send(self, line):
+        try:
+            self._socket.sendto(line, self._address)
+        except socket.error:
+            pass
+
+    def increment(self, name, value=1, tags=None):
+        self._send("%s:%s|c" % (self._name(name, tags), value, ))
+
+    def gauge(self, name, value, tags=None):
+        self._send("%s:%s|g" % (self._name(name, tags), value, ))
+
+    def timing(self, name, seconds, tags=None):
+        self._send("%s:%.3f|ms" % (self._name(name, tags), seconds * 1000.0, ))
+
+    def close(self):
+        self._socket.close()
+
+class CallbackSink(object):
+    """
+    call callback(kind, name, value, tags) for every measurement,
+    where kind is "counter", "gauge" or "timing" (value in seconds)
+    """
+    def __init__(self, callback):
+        self._callback = callback
+
+    def increment(self, name, value=1, tags=None):
+        self._callback("counter", name, value, tags)
+
+    def gauge(self, name, value, tags=None):
+        self._callback("gauge", name, value, tags)
+
+    def timing(self, name, seconds, tags=None):
+        self._callback("timing", name, seconds, tags)
+
+_sink = NullSink()
+
+def set_metrics_sink(sink):
+    """
+    send measurements to sink. None restores the NullSink
+    """
+    global _sink
+    _sink = (NullSink() if sink is None else sink)
+
+def get_metrics_sink():
+    return _sink
+
+def increment(name, value=1, tags=None):
+    _sink.increment(name, value, tags)
+
+def gauge(name, value, tags=None):
+    _sink.gauge(name, value, tags)
+
+def timing(name, seconds, tags=None):
+    _sink.timing(name, seconds, tags)
@@ -1,12 +1,22 @@
 # -*- coding: utf-8 -*-
 """
-pass_thru_producer.py 
+pass_thru_producer.py
 
 an IBodyProducer that passes data through to the consumer
 with bufferring to handle the consumer not being ready
+
+The buffer is bounded by watermarks: when the buffered data grows past the
+high watermark, the feeder is asked to stop feeding; when it drains down to
+the low watermark, the feeder is asked to resume.
+
+With hash_in_thread, the MD5 digest is updated in a worker thread
+(threaded_digest.ThreadedDigest) instead of the reactor thread; use
+wait_for_digest to get it once the hashing has caught up.
 """
+from collections import deque
 from hashlib import md5
 import logging
+import os
 
 from zope.interface import implements
 
@@ -15,85 +25,217 @@ from twisted.python import log
 from twisted.internet import defer
 from twisted.web.iweb import IBodyProducer
 
+from twisted_client_for_nimbusio import metrics
+from twisted_client_for_nimbusio.lazy_log import log_debug, trace
+from twisted_client_for_nimbusio.threaded_digest import ThreadedDigest, \
+    default_hash_in_thread
+
+_default_high_watermark = int(
+    os.environ.get("NIMBUSIO_PRODUCER_HIGH_WATERMARK", str(4 * 1024 * 1024)))
+_default_low_watermark = int(
+    os.environ.get("NIMBUSIO_PRODUCER_LOW_WATERMARK", str(1024 * 1024)))
+
 class PassThruProducer(object):
     implements(IBodyProducer)
 
-    def __init__(self, name, length):
+    def __init__(self,
+                 name,
+                 length,
+                 high_watermark=_default_high_watermark,
+                 low_watermark=_default_low_watermark,
+                 hash_in_thread=default_hash_in_thread):
+        assert low_watermark <= high_watermark
         self._name = name
         self._length = length
+        self._high_watermark = high_watermark
+        self._low_watermark = low_watermark
         self._finished_deferred = defer.Deferred()
-        self._buffer = ""
+        self._buffer = deque()
+        self._bytes_buffered = 0
+        self._peak_buffered = 0
         self._bytes_written = 0
-        self._md5 = md5()
+        self._md5 = (ThreadedDigest() if hash_in_thread else md5())
+        self._digest_deferreds = list()
 
         self._consumer = None
         self._paused = False
 
-    @property 
+        self._feeder = None
+        self._feeder_paused = False
+        self._resume_deferreds = list()
+
+    @property
     def name(self):
         return self._name
 
-    @property 
+    @property
     def length(self):
         return self._length
 
-    @property 
+    @property
     def bytes_remaining_to_write(self):
-        count = self._length - (len(self._buffer) + self._bytes_written)
+        count = self._length - (self._bytes_buffered + self._bytes_written)
         assert count >= 0
         return count
 
+    @property
+    def bytes_buffered(self):
+        """
+        the number of bytes fed but not yet written to the consumer
+        """
+        return self._bytes_buffered
+
+    @property
+    def peak_buffered(self):
+        """
+        the largest value bytes_buffered has reached
+        """
+        return self._peak_buffered
+
+    @property
+    def feeder_paused(self):
+        """
+        True if the feeder should stop feeding until told to resume
+        """
+        return self._feeder_paused
+
     @property
     def is_finished(self):
         return self._finished_deferred.called
 
-    @property 
+    @property
     def md5_digest(self):
+        """
+        the MD5 digest of the data. If it is hashed in a thread, this raises
+        DigestPendingError until the hashing has caught up: use
+        wait_for_digest
+        """
         assert self.is_finished
         return self._md5.digest()
 
+    def wait_for_digest(self):
+        """
+        return a deferred that fires with the MD5 digest of the data,
+        once it has all been written to the consumer and hashed
+        """
+        deferred = defer.Deferred()
+        if self.is_finished:
+            self._fire_digest(deferred)
+        else:
+            self._digest_deferreds.append(deferred)
+        return deferred
+
+    def _fire_digest(self, deferred):
+        if isinstance(self._md5, ThreadedDigest):
+            self._md5.wait_for_digest().chainDeferred(deferred)
+        else:
+            deferred.callback(self._md5.digest())
+
+    def register_feeder(self, feeder):
+        """
+        register the source of data for feed()
+
+        feeder must have pauseProducing and resumeProducing methods
+        (an IPushProducer will do). They are called when the buffer passes
+        the high watermark and when it drains back to the low watermark.
+        """
+        assert self._feeder is None
+        self._feeder = feeder
+        if self._feeder_paused:
+            self._feeder.pauseProducing()
+
+    def wait_for_resume(self):
+        """
+        return a deferred that fires when the feeder may feed again:
+        immediately if the buffer is below the high watermark, otherwise
+        when it has drained to the low watermark
+        """
+        if not self._feeder_paused:
+            return defer.succeed(None)
+        deferred = defer.Deferred()
+        self._resume_deferreds.append(deferred)
+        return deferred
+
     def feed(self, data):
         """
         feed data to the consumer
         """
-        if self._consumer is None or self._paused:
-            self._buffer = "".join([self._buffer, data, ])
+        if self._consumer is None or self._paused or len(self._buffer) > 0:
+            self._buffer.append(data)
+            self._bytes_buffered += len(data)
+            if self._bytes_buffered > self._peak_buffered:
+                self._peak_buffered = self._bytes_buffered
+            metrics.gauge("producer.bytes_buffered", self._bytes_buffered)
+            if self._bytes_buffered >= self._high_watermark:
+                self._pause_feeder()
         else:
             self._write_to_consumer(data)
 
+    def _pause_feeder(self):
+        if self._feeder_paused:
+            return
+        log_debug("%s pausing feeder at %s bytes buffered",
+                  self._name, self._bytes_buffered)
+        self._feeder_paused = True
+        if self._feeder is not None:
+            self._feeder.pauseProducing()
+
+    def _resume_feeder(self):
+        if not self._feeder_paused:
+            return
+        log_debug("%s resuming feeder at %s bytes buffered",
+                  self._name, self._bytes_buffered)
+        self._feeder_paused = False
+        if self._feeder is not None:
+            self._feeder.resumeProducing()
+        resume_deferreds = self._resume_deferreds
+        self._resume_deferreds = list()
+        for deferred in resume_deferreds:
+            deferred.callback(None)
+
+    def _drain_buffer(self):
+        # the consumer may pause us from inside write()
+        while len(self._buffer) > 0 and not self._paused:
+            data = self._buffer.popleft()
+            self._bytes_buffered -= len(data)
+            self._write_to_consumer(data)
+        metrics.gauge("producer.bytes_buffered", self._bytes_buffered)
+
+        if self._bytes_buffered <= self._low_watermark:
+            self._resume_feeder()
+
     def _write_to_consumer(self, data):
-        log.msg("%s writing %s bytes to consumer" % (
-                self._name, len(data), ), 
-                logLevel=logging.DEBUG)
+        trace("%s writing %s bytes to consumer", self._name, len(data))
         self._consumer.write(data)
         self._bytes_written += len(data)
         self._md5.update(data)
+        metrics.increment("bytes_sent", len(data))
 
         if self._bytes_written >= self._length:
-            log.msg("%s finished" % (self._name, ), logLevel=logging.DEBUG)
-            self._finished_deferred.callback(None) 
+            log_debug("%s finished", self._name)
+            self._finished_deferred.callback(None)
+            digest_deferreds, self._digest_deferreds = \
+                self._digest_deferreds, list()
+            for deferred in digest_deferreds:
+                self._fire_digest(deferred)
 
     def startProducing(self, consumer):
-        log.msg("%s startProducing" % (self._name, ), logLevel=logging.DEBUG)
+        log_debug("%s startProducing", self._name)
         assert self._consumer is None
         self._consumer = consumer
 
-        if len(self._buffer) > 0:
-            self._write_to_consumer(self._buffer)
-            self._buffer = ""
+        self._drain_buffer()
 
         return self._finished_deferred
 
     def pauseProducing(self):
-        log.msg("%s pauseProducing" % (self._name, ), logLevel=logging.DEBUG)
+        log_debug("%s pauseProducing", self._name)
         self._paused = True
 
     def resumeProducing(self):
-        log.msg("%s resumeProducing" % (self._name, ), logLevel=logging.DEBUG)
+        log_debug("%s resumeProducing", self._name)
         self._paused = False
-        if len(self._buffer) > 0:
-            self._write_to_consumer(self._buffer)
-            self._buffer = ""
+        self._drain_buffer()
 
     def stopProducing(self):
         log.msg("%s stopProducing" % (self._name, ), logLevel=logging.WARN)
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+range_downloader.py
+
+retrieve a large key into a local file by fetching byte ranges of it
+over several connections at once. Each range is written straight to its
+offset in the (preallocated) file, and a failed range is retried on its
+own from the first byte it did not receive.
+"""
+import httplib
+import logging
+import mmap
+import os
+
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from twisted.internet import reactor, defer
+
+from zope.interface import implements
+from twisted.internet.interfaces import IConsumer
+
+from twisted_client_for_nimbusio.rest_api import compute_head_path, \
+    compute_retrieve_path, \
+    compute_range_header_tuple
+
+from twisted_client_for_nimbusio.scheduler import \
+    collection_request_function
+from twisted_client_for_nimbusio.lazy_log import log_debug
+
+_min_segment_size = 1024 * 1024
+_max_segment_size = 64 * 1024 * 1024
+_segments_per_connection = 4
+_default_concurrency = int(
+    os.environ.get("NIMBUSIO_RANGE_DOWNLOAD_CONCURRENCY", "4"))
+_default_max_range_retries = 3
+_range_retry_delay = 1.0
+
+class RangeDownloadError(Exception):
+    pass
+
+class RangeOverrunError(RangeDownloadError):
+    """
+    the server sent more data than a range asked for
+    """
+    pass
+
+def compute_segment_size(total_size, concurrency):
+    """
+    choose a range size for downloading total_size bytes over concurrency
+    connections: a few ranges per connection, rounded up to a whole MiB,
+    between _min_segment_size and _max_segment_size
+    """
+    segment_count = concurrency * _segments_per_connection
+    segment_size = -(-total_size // segment_count)
+    segment_size = -(-segment_size // _min_segment_size) * _min_segment_size
+    return max(_min_segment_size, min(_max_segment_size, segment_size))
+
+class _OffsetConsumer(object):
+    """
+    An IConsumer that writes data to a file (or mmap) at an offset
+    """
+    implements(IConsumer)
+
+    def __init__(self, destination, offset, size):
+        self._destination = destination
+        self._position = offset
+        self._bytes_remaining = size
+        self._bytes_written = 0
+        self._overrun = 0
+        self._producer = None
+
+    @property
+    def bytes_written(self):
+        return self._bytes_written
+
+    @property
+    def overrun(self):
+        """
+        the number of bytes received beyond the range
+        """
+        return self._overrun
+
+    def registerProducer(self, producer, _streaming):
+        self._producer = producer
+        producer.addConsumer(self)
+
+    def unregisterProducer(self):
+        self._producer = None
+
+    def write(self, data):
+        if self._overrun > 0:
+            self._overrun += len(data)
+            return
+        if len(data) > self._bytes_remaining:
+            # the server is not keeping to the range: write none of this,
+            # and stop the response. The range fails with RangeOverrunError
+            self._overrun = len(data) - self._bytes_remaining
+            if self._producer is not None:
+                self._producer.stopProducing()
+            return
+        self._destination.seek(self._position)
+        self._destination.write(data)
+        self._position += len(data)
+        self._bytes_remaining -= len(data)
+        self._bytes_written += len(data)
+
+class RangeDownloader(object):
+    """
+    download a key to a local file
+
+    destination
+        path of the local file. It is created, or truncated, and
+        preallocated to the size of the key
+
+    segment_size
+        the size of each range. Computed from the size of the key by
+        compute_segment_size if not given
+
+    concurrency
+        the number of ranges downloading at once
+
+    max_range_retries
+        the number of times a failed range is retried before the whole
+        download fails
+
+    use_mmap
+        write the ranges into an mmap of the destination file instead of
+        seeking and writing the file
+
+    scheduler
+        a RequestScheduler to queue the requests through. If None, requests
+        start immediately
+
+    metadata_cache
+        a MetadataCache to take the size of the key from, instead of
+        making a HEAD request when it is cached
+    """
+    def __init__(self,
+                 identity,
+                 collection_name,
+                 key,
+                 destination,
+                 version_id=None,
+                 segment_size=None,
+                 concurrency=_default_concurrency,
+                 max_range_retries=_default_max_range_retries,
+                 use_mmap=False,
+                 scheduler=None,
+                 metadata_cache=None):
+        self._identity = identity
+        self._collection_name = collection_name
+        self._key = key
+        self._destination_path = destination
+        self._version_id = version_id
+        self._segment_size = segment_size
+        self._concurrency = concurrency
+        self._semaphore = defer.DeferredSemaphore(concurrency)
+        self._max_range_retries = max_range_retries
+        self._use_mmap = use_mmap
+        self._scheduler = scheduler
+        self._metadata_cache = metadata_cache
+        self._start_collection_request = \
+            collection_request_function(scheduler)
+
+        self._length = None
+        self._file = None
+        self._map = None
+        self._failed = False
+        self._first_failure = None
+
+    @property
+    def key(self):
+        return self._key
+
+    @property
+    def length(self):
+        return self._length
+
+    @property
+    def segment_size(self):
+        return self._segment_size
+
+    def start(self):
+        """
+        start the download
+        return a deferred that fires with the headers of the HEAD request
+        when every range has been written to the destination file
+        """
+        if self._metadata_cache is not None:
+            deferred = self._metadata_cache.head(self._identity,
+                                                 self._collection_name,
+                                                 self._key,
+                                                 version_id=self._version_id,
+                                                 scheduler=self._scheduler)
+        else:
+            path = compute_head_path(self._key,
+                                     version_identifier=self._version_id)
+            deferred = self._start_collection_request(self._identity,
+                                                      "HEAD",
+                                                      self._collection_name,
+                                                      path)
+        deferred.addCallback(self._head_result)
+        deferred.addBoth(self._close)
+        return deferred
+
+    def _head_result(self, headers):
+        self._length = int(headers["Content-Length"][0])
+        if self._segment_size is None:
+            self._segment_size = compute_segment_size(self._length,
+                                                      self._concurrency)
+
+        log_debug("range download %r %s bytes in ranges of %s",
+                  self._key, self._length, self._segment_size)
+
+        self._file = open(self._destination_path, "w+b")
+        self._file.truncate(self._length)
+        if self._use_mmap and self._length > 0:
+            self._map = mmap.mmap(self._file.fileno(), self._length)
+            destination = self._map
+        else:
+            destination = self._file
+
+        deferreds = list()
+        for offset in range(0, self._length, self._segment_size):
+            size = min(self._segment_size, self._length - offset)
+            deferreds.append(self._semaphore.run(self._fetch_range,
+                                                 destination,
+                                                 offset,
+                                                 size,
+                                                 1))
+
+        # wait for every range to settle before the file is closed,
+        # ranges not yet started are skipped once one has failed
+        deferred_list = defer.DeferredList(deferreds, consumeErrors=True)
+
+        def _complete(_results):
+            if self._first_failure is not None:
+                return self._first_failure
+            return headers
+
+        deferred_list.addCallback(_complete)
+        return deferred_list
+
+    def _fetch_range(self, destination, offset, size, attempt):
+        if self._failed:
+            raise RangeDownloadError("%r range %s+%s: download failed" % (
+                                     self._key, offset, size, ))
+
+        consumer = _OffsetConsumer(destination, offset, size)
+        path = compute_retrieve_path(self._key, self._version_id)
+        range_header = compute_range_header_tuple(offset, size)
+        deferred = self._start_collection_request(
+            self._identity,
+            "GET",
+            self._collection_name,
+            path,
+            response_consumer=consumer,
+            additional_headers=dict([range_header, ]),
+            valid_http_status=frozenset([httplib.PARTIAL_CONTENT, ]))
+        deferred.addCallback(self._range_result, consumer, offset, size)
+        deferred.addErrback(self._range_error,
+                            destination,
+                            consumer,
+                            offset,
+                            size,
+                            attempt)
+        return deferred
+
+    def _range_result(self, _result, consumer, offset, size):
+        if consumer.overrun > 0:
+            raise self._overrun_error(consumer, offset, size)
+        if consumer.bytes_written != size:
+            raise RangeDownloadError("%r range %s+%s: %s bytes short" % (
+                                     self._key, offset, size,
+                                     size - consumer.bytes_written, ))
+        log_debug("range download %r range %s+%s complete",
+                  self._key, offset, size)
+
+    def _range_error(self, failure, destination, consumer, offset, size,
+                     attempt):
+        log.msg("range download %r range %s+%s attempt %s failed: %s" % (
+                self._key, offset, size, attempt,
+                failure.getErrorMessage(), ),
+                logLevel=logging.WARN)
+
+        retryable = attempt <= self._max_range_retries
+        if consumer.overrun > 0:
+            # retrying a server that ignores the range would not help
+            if not failure.check(RangeOverrunError):
+                failure = Failure(self._overrun_error(consumer, offset, size))
+            retryable = False
+
+        if self._failed:
+            return failure
+
+        if not retryable:
+            self._failed = True
+            self._first_failure = failure
+            return failure
+
+        # resume from the first byte we did not receive
+        bytes_written = consumer.bytes_written
+        if bytes_written == size:
+            return None
+        deferred = defer.Deferred()
+        deferred.addCallback(self._retry_range,
+                             destination,
+                             offset + bytes_written,
+                             size - bytes_written,
+                             attempt + 1)
+        reactor.callLater(_range_retry_delay * attempt,
+                          deferred.callback,
+                          None)
+        return deferred
+
+    def _overrun_error(self, consumer, offset, size):
+        return RangeOverrunError("%r range %s+%s: %s bytes beyond range" % (
+                                 self._key, offset, size, consumer.overrun, ))
+
+    def _retry_range(self, _result, destination, offset, size, attempt):
+        return self._fetch_range(destination, offset, size, attempt)
+
+    def _close(self, result):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return result
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+rate_limit.py
+
+token bucket limits on the bytes per second sent (UPLOAD) and received
+(DOWNLOAD): for everything, for each collection, and for single requests
+(the rate_limit argument of requester.start_request).
+
+A transfer that gets ahead of its limits is paused, through the usual
+pauseProducing / resumeProducing of its producer, for as long as it takes
+the buckets to refill. Nothing spins, and the data waits where it would
+wait for a slow connection: in the socket for downloads, in the producer
+(which pauses its feeder at its high watermark) for uploads.
+
+Limits can be changed at any time with set_rate_limit, and apply at once
+to the transfers already limited.
+"""
+import os
+
+from twisted.internet import reactor
+
+from zope.interface import implements
+from twisted.web.iweb import IBodyProducer
+
+UPLOAD = "upload"
+DOWNLOAD = "download"
+
+def _rate_from_environment(name):
+    value = os.environ.get(name)
+    return (float(value) if value else None)
+
+class TokenBucket(object):
+    """
+    allow rate bytes per second on average, and bursts of up to burst bytes
+    (one second's worth by default). A rate of None is no limit.
+    """
+    def __init__(self, rate=None, burst=None):
+        self._rate = None
+        self._burst = None
+        self._tokens = 0.0
+        self._updated_at = reactor.seconds()
+        self.set_rate(rate, burst)
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def set_rate(self, rate, burst=None):
+        self._refill()
+        was_limited = self._rate is not None
+        self._rate = rate or None
+        self._burst = burst
+        if self._rate is None:
+            return
+        if was_limited:
+            self._tokens = min(self._tokens, self._capacity())
+        else:
+            # a new limit starts with a full bucket
+            self._tokens = self._capacity()
+
+    def _capacity(self):
+        return float(self._burst or self._rate)
+
+    def _refill(self):
+        now = reactor.seconds()
+        if self._rate is not None:
+            self._tokens = min(self._capacity(),
+                               self._tokens +
+                               (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+    def consume(self, byte_count):
+        """
+        take byte_count tokens
+        return the seconds to wait before sending any more, 0 if none
+        """
+        if self._rate is None:
+            return 0.0
+        self._refill()
+        self._tokens -= byte_count
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self._rate
+
+_global_buckets = {
+    UPLOAD      : TokenBucket(
+        _rate_from_environment("NIMBUSIO_UPLOAD_BYTES_PER_SECOND")),
+    DOWNLOAD    : TokenBucket(
+        _rate_from_environment("NIMBUSIO_DOWNLOAD_BYTES_PER_SECOND")),
+}
+# (direction, hostname) -> TokenBucket
+_host_buckets = dict()
+
+def set_rate_limit(direction, bytes_per_second, collection_name=None,
+                   burst=None):
+    """
+    limit direction (UPLOAD or DOWNLOAD) to bytes_per_second, for one
+    collection, or for everything if collection_name is None.
+    None removes the limit.
+    """
+    assert direction in _global_buckets, direction
+    if collection_name is None:
+        _global_buckets[direction].set_rate(bytes_per_second, burst)
+        return
+
+    # imported here, requester uses this module
+    from twisted_client_for_nimbusio.requester import collection_hostname
+    bucket_key = (direction, collection_hostname(collection_name), )
+    try:
+        _host_buckets[bucket_key].set_rate(bytes_per_second, burst)
+    except KeyError:
+        if bytes_per_second:
+            _host_buckets[bucket_key] = TokenBucket(bytes_per_second, burst)
+
+def get_rate_limit(direction, collection_name=None):
+    """
+    return the bytes per second limit, or None
+    """
+    if collection_name is None:
+        return _global_buckets[direction].rate
+    from twisted_client_for_nimbusio.requester import collection_hostname
+    bucket = _host_buckets.get((direction,
+                                collection_hostname(collection_name), ))
+    return (None if bucket is None else bucket.rate)
+
+class Throttle(object):
+    """
+    the buckets that apply to one transfer
+    """
+    def __init__(self, buckets):
+        self._buckets = buckets
+
+    def consume(self, byte_count):
+        """
+        return the seconds to wait before sending or receiving any more
+        """
+        return max([bucket.consume(byte_count) for bucket in self._buckets])
+
+def get_throttle(direction, hostname, bytes_per_second=None):
+    """
+    return a Throttle for a transfer in direction to or from hostname,
+    limited to bytes_per_second as well as the global and per-collection
+    limits, or None if there are no limits on it
+    """
+    buckets = list()
+    if bytes_per_second:
+        buckets.append(TokenBucket(bytes_per_second))
+    host_bucket = _host_buckets.get((direction, hostname, ))
+    if host_bucket is not None and host_bucket.rate is not None:
+        buckets.append(host_bucket)
+    if _global_buckets[direction].rate is not None:
+        buckets.append(_global_buckets[direction])
+    if len(buckets) == 0:
+        return None
+    return Throttle(buckets)
+
+class ThrottledBodyProducer(object):
+    """
+    wrap a body producer to pause it when it gets ahead of a Throttle.
+    The producer is paused while it is throttled or the connection has
+    paused it, and resumed when neither is true.
+    """
+    implements(IBodyProducer)
+
+    def __init__(self, body_producer, throttle):
+        self._body_producer = body_producer
+        self._throttle = throttle
+        self._consumer = None
+        self._paused = False
+        self._throttled_call = None
+        self.length = body_producer.length
+
+    def startProducing(self, consumer):
+        self._consumer = consumer
+        deferred = self._body_producer.startProducing(self)
+        deferred.addBoth(self._finished)
+        return deferred
+
+    def _finished(self, result):
+        self._cancel_throttle()
+        return result
+
+    def write(self, data):
+        self._consumer.write(data)
+        delay = self._throttle.consume(len(data))
+        if delay > 0 and self._throttled_call is None:
+            self._throttled_call = reactor.callLater(delay, self._unthrottle)
+            if not self._paused:
+                self._body_producer.pauseProducing()
+
+    def registerProducer(self, producer, streaming):
+        self._consumer.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self._consumer.unregisterProducer()
+
+    def _unthrottle(self):
+        self._throttled_call = None
+        if not self._paused:
+            self._body_producer.resumeProducing()
+
+    def _cancel_throttle(self):
+        if self._throttled_call is not None and self._throttled_call.active():
+            self._throttled_call.cancel()
+        self._throttled_call = None
+
+    def pauseProducing(self):
+        self._paused = True
+        if self._throttled_call is None:
+            self._body_producer.pauseProducing()
+
+    def resumeProducing(self):
+        self._paused = False
+        if self._throttled_call is None:
+            self._body_producer.resumeProducing()
+
+    def stopProducing(self):
+        self._cancel_throttle()
+        self._body_producer.stopProducing()
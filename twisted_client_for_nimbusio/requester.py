@@ -7,52 +7,182 @@ start an HTTP(S) request to nimbus.io
 import httplib
 import logging
 import os
-import urllib
 
 from twisted.python import log
+from twisted.python.failure import Failure
 
-from twisted.internet import reactor, defer
+from zope.interface import implements
 
-from twisted.web.client import Agent
-from twisted.web.http_headers import Headers
+from twisted.internet import reactor, defer, error
+from twisted.internet.protocol import Protocol
 
-from lumberyard.http_util import compute_collection_hostname, \
-        current_timestamp, \
-        compute_authentication_string
+from twisted.web.iweb import IBodyProducer
+
+from lumberyard.http_util import compute_collection_hostname
 
 from twisted_client_for_nimbusio.response_producer_protocol import \
     ResponseProducerProtocol 
+from twisted_client_for_nimbusio.connection_pool import get_agent, \
+    get_connection_semaphore
+from twisted_client_for_nimbusio.header_builder import HeaderBuilder
+from twisted_client_for_nimbusio.rate_limit import UPLOAD, DOWNLOAD, \
+    get_throttle, \
+    ThrottledBodyProducer
+from twisted_client_for_nimbusio import metrics
+from twisted_client_for_nimbusio.lazy_log import log_debug
 
 _connection_timeout = float(os.environ.get("NIMBUSIO_CONNECTION_TIMEOUT", 
                                            "360.0"))
+_first_byte_timeout = float(os.environ.get("NIMBUSIO_FIRST_BYTE_TIMEOUT",
+                                           "360.0"))
+_idle_timeout = float(os.environ.get("NIMBUSIO_IDLE_TIMEOUT", "360.0"))
 _service_ssl = os.environ.get("NIMBUS_IO_SERVICE_SSL", "0") != "0"
 _agent_name = "Twisted Client for Nimbus.io"
+_header_builder = HeaderBuilder(_agent_name)
+_requests_in_flight = 0
+_collection_hostnames = dict()
 
 class NimbusioError(Exception):
     pass
 
+class NimbusioHTTPStatusError(NimbusioError):
+    """
+    the server replied with an HTTP status not valid for the request
+    """
+    def __init__(self, message, status):
+        NimbusioError.__init__(self, message)
+        self.status = status
+
+class _DiscardProtocol(Protocol):
+    """
+    read and discard a response body we have no consumer for, so that
+    a persistent connection can go back to its pool
+    """
+    def dataReceived(self, _data_bytes):
+        pass
+
+    def connectionLost(self, _reason):
+        pass
+
+class _TimedBodyProducer(object):
+    """
+    wrap a body producer to start the first byte timer when the whole
+    body has been sent
+    """
+    implements(IBodyProducer)
+
+    def __init__(self, body_producer, first_byte_timer):
+        self._body_producer = body_producer
+        self._first_byte_timer = first_byte_timer
+        self.length = body_producer.length
+
+    def startProducing(self, consumer):
+        deferred = self._body_producer.startProducing(consumer)
+        deferred.addCallback(self._first_byte_timer.start)
+        return deferred
+
+    def pauseProducing(self):
+        self._body_producer.pauseProducing()
+
+    def resumeProducing(self):
+        self._body_producer.resumeProducing()
+
+    def stopProducing(self):
+        self._body_producer.stopProducing()
+
+class _FirstByteTimer(object):
+    """
+    cancel a request if the response does not start within timeout seconds
+    of the request being sent
+    """
+    def __init__(self, timeout):
+        self._timeout = timeout
+        self._delayed_call = None
+        self._timed_out = False
+        self._finished = False
+        self.request_deferred = None
+
+    def start(self, result=None):
+        if self._timeout and not self._finished:
+            self._delayed_call = reactor.callLater(self._timeout,
+                                                   self._timed_out_request)
+        return result
+
+    def _timed_out_request(self):
+        log.msg("no response in %ss, cancelling request" % (self._timeout, ),
+                logLevel=logging.WARN)
+        self._delayed_call = None
+        self._timed_out = True
+        self.request_deferred.cancel()
+
+    def finish(self, result):
+        """
+        the response has started (or the request has failed)
+        """
+        self._finished = True
+        if self._delayed_call is not None and self._delayed_call.active():
+            self._delayed_call.cancel()
+        self._delayed_call = None
+        if self._timed_out:
+            raise error.TimeoutError("no response in %ss" % (self._timeout, ))
+        return result
+
+def configure_timeouts(connect_timeout=None,
+                       first_byte_timeout=None,
+                       idle_timeout=None):
+    """
+    change the default timeouts (in seconds) for requests.
+    None leaves a timeout unchanged, 0 disables it.
+
+    connect_timeout
+        waiting for a new connection to open
+
+    first_byte_timeout
+        waiting for the response to start, after the request is sent
+
+    idle_timeout
+        waiting for more of the response body to arrive
+    """
+    global _connection_timeout, _first_byte_timeout, _idle_timeout
+
+    if connect_timeout is not None:
+        _connection_timeout = connect_timeout
+    if first_byte_timeout is not None:
+        _first_byte_timeout = first_byte_timeout
+    if idle_timeout is not None:
+        _idle_timeout = idle_timeout
+
+def _default(value, default_value):
+    return (default_value if value is None else value)
+
 def _compute_uri(hostname, path):
     scheme = ("HTTPS" if _service_ssl else "HTTP")
     return "".join([scheme, "://", hostname, path])
 
-def _compute_headers(identity, method, path):
-    timestamp = current_timestamp()
-
-    headers = Headers()
-    headers.addRawHeader("x-nimbus-io-timestamp", str(timestamp))
-    headers.addRawHeader("agent", _agent_name)
+def collection_hostname(collection_name):
+    """
+    return the hostname of a collection, computed once by
+    compute_collection_hostname, or as registered
+    """
+    try:
+        return _collection_hostnames[collection_name]
+    except KeyError:
+        hostname = compute_collection_hostname(collection_name)
+        _collection_hostnames[collection_name] = hostname
+        return hostname
 
-    if identity is not None:
-        authentication_string = \
-            compute_authentication_string(identity.auth_key_id,
-                                          identity.auth_key,
-                                          identity.user_name, 
-                                          method, 
-                                          timestamp,
-                                          urllib.unquote_plus(path))
-        headers.addRawHeader("Authorization", authentication_string)
+def register_collection_hostname(collection_name, hostname):
+    """
+    send requests for collection_name to hostname (which may include a
+    port). None goes back to compute_collection_hostname
+    """
+    if hostname is None:
+        _collection_hostnames.pop(collection_name, None)
+    else:
+        _collection_hostnames[collection_name] = hostname
 
-    return headers
+def _compute_headers(identity, method, path):
+    return _header_builder.build(identity, method, path)
 
 def _request_callback(response, 
                       valid_http_status, 
@@ -71,11 +201,13 @@ def _request_callback(response,
                         valid_http_status)
         log.msg("_request_callback %s" % (error_message, ), 
                 logLevel=logging.ERROR)
-        raise NimbusioError(error_message)
+        response.deliverBody(_DiscardProtocol())
+        raise NimbusioHTTPStatusError(error_message, response.code)
 
     if response_protocol is not None:
         response.deliverBody(response_protocol)
     else:
+        response.deliverBody(_DiscardProtocol())
         headers = dict(response.headers.getAllRawHeaders())
         final_deferred.callback(headers)
 
@@ -84,6 +216,218 @@ def _request_errback(failure, final_deferred):
             logLevel=logging.ERROR)
     final_deferred.errback(failure)
 
+def _response_started(response, request, started_at):
+    """
+    record the status and the time to the response of an attempt
+    """
+    request["status"] = response.code
+    metrics.timing("request.first_byte", reactor.seconds() - started_at)
+    return response
+
+def _request_finished(result, request):
+    """
+    record the outcome of the request, after any retries
+    """
+    global _requests_in_flight
+    _requests_in_flight -= 1
+    metrics.gauge("requests_in_flight", _requests_in_flight)
+    metrics.timing("request.total", reactor.seconds() - request["started-at"])
+
+    if isinstance(result, Failure) and request["status"] is None:
+        status = "error"
+    else:
+        status = request["status"]
+    metrics.increment("requests", tags={"method" : request["method"],
+                                        "status" : status})
+    return result
+
+def _can_reset(instance):
+    """
+    return True if instance has a reset method, and does not say (with
+    a false can_reset attribute) that it cannot start over
+    """
+    return hasattr(instance, "reset") and getattr(instance, "can_reset", True)
+
+def _is_replayable(request, response_protocol):
+    """
+    return True if the request can be sent again: the body producer
+    (if any) and the response consumer (if it has seen any data) can
+    be reset to start over
+    """
+    body_producer = request["body-producer"]
+    if body_producer is not None and not _can_reset(body_producer):
+        return False
+
+    if response_protocol is not None and \
+        response_protocol.bytes_received > 0 and \
+        not _can_reset(request["response-consumer"]):
+        return False
+
+    return True
+
+def _attempt_errback(failure, request, attempt, response_protocol):
+    """
+    a request attempt failed: retry it if the retry policy allows,
+    otherwise fail the request
+    """
+    if request["cancelled"]:
+        # cancelling the final deferred has failed it already
+        return
+
+    retry_policy = request["retry-policy"]
+    if retry_policy is None or \
+        not retry_policy.is_retryable(request["method"], failure, attempt) or \
+        not _is_replayable(request, response_protocol):
+        request["final-deferred"].errback(failure)
+        return
+
+    delay = retry_policy.compute_delay(attempt)
+    log.msg("retrying %s %r in %.3fs after attempt %s failed: %s" % (
+            request["method"],
+            request["uri"],
+            delay,
+            attempt,
+            failure.getErrorMessage(), ),
+            logLevel=logging.WARN)
+
+    if request["body-producer"] is not None:
+        request["body-producer"].reset()
+    if response_protocol is not None and response_protocol.bytes_received > 0:
+        request["response-consumer"].reset()
+
+    delayed_call = reactor.callLater(delay, _start_attempt,
+                                     request, attempt + 1)
+    request["cancel-attempt"] = delayed_call.cancel
+
+def _attempt_succeeded(result, request):
+    if not request["cancelled"]:
+        request["final-deferred"].callback(result)
+
+def _cancel_attempt(request_deferred, response_protocol):
+    """
+    abandon an attempt: cancel the request if there is no response yet,
+    otherwise stop reading the response body
+    """
+    if not request_deferred.called:
+        request_deferred.cancel()
+    elif response_protocol is not None:
+        response_protocol.stopProducing()
+
+def _cancel_request(request):
+    """
+    the caller cancelled the final deferred: abandon the attempt in
+    progress, or the retry waiting to start
+    """
+    request["cancelled"] = True
+    cancel_attempt = request["cancel-attempt"]
+    request["cancel-attempt"] = None
+    if cancel_attempt is not None:
+        cancel_attempt()
+
+def _start_attempt(request, attempt):
+    """
+    send the request, as soon as the limit on requests in progress to its
+    host allows
+    """
+    semaphore = get_connection_semaphore(request["hostname"])
+    if semaphore is None:
+        _send_attempt(None, request, attempt)
+        return
+
+    deferred = semaphore.acquire()
+    request["cancel-attempt"] = deferred.cancel
+    deferred.addCallbacks(_send_attempt, _acquire_cancelled,
+                          callbackArgs=(request, attempt, ))
+    deferred.addErrback(_send_failed, request, semaphore)
+
+def _acquire_cancelled(failure):
+    # the request was cancelled while waiting for the semaphore
+    failure.trap(defer.CancelledError)
+
+def _send_failed(failure, request, semaphore):
+    semaphore.release()
+    if not request["cancelled"]:
+        request["final-deferred"].errback(failure)
+
+def _release_semaphore(result, semaphore):
+    semaphore.release()
+    return result
+
+def _send_attempt(semaphore, request, attempt):
+    """
+    send the request, holding semaphore (if not None) until the response
+    has been read or the attempt has failed
+    """
+    attempt_deferred = defer.Deferred()
+    headers = _compute_headers(request["identity"],
+                               request["method"],
+                               request["path"])
+    if request["additional-headers"] is not None:
+        for key, value in request["additional-headers"].items():
+            headers.addRawHeader(key, value)
+
+    agent = get_agent(request["hostname"],
+                      request["persistent"],
+                      request["connect-timeout"])
+    log_debug("requesting %s '%r, connection_timeout = %s persistent = %s "
+              "attempt = %s",
+              request["method"],
+              request["uri"],
+              request["connect-timeout"],
+              request["persistent"],
+              attempt)
+
+    request["status"] = None
+    first_byte_timer = _FirstByteTimer(request["first-byte-timeout"])
+    if request["body-producer"] is None:
+        body_producer = None
+    else:
+        body_producer = request["body-producer"]
+        throttle = get_throttle(UPLOAD,
+                                request["hostname"],
+                                request["rate-limit"])
+        if throttle is not None:
+            body_producer = ThrottledBodyProducer(body_producer, throttle)
+        body_producer = _TimedBodyProducer(body_producer, first_byte_timer)
+
+    request_deferred = agent.request(request["method"],
+                                     request["uri"],
+                                     headers,
+                                     body_producer)
+    first_byte_timer.request_deferred = request_deferred
+    if body_producer is None:
+        first_byte_timer.start()
+
+    if request["response-consumer"] is None:
+        response_protocol = None
+    else:
+        response_protocol = ResponseProducerProtocol(
+            attempt_deferred, 
+            idle_timeout=request["idle-timeout"],
+            throttle=get_throttle(DOWNLOAD, 
+                                  request["hostname"],
+                                  request["rate-limit"]))
+        request["response-consumer"].registerProducer(response_protocol, True)
+
+    request_deferred.addBoth(first_byte_timer.finish)
+    request_deferred.addCallback(_response_started, request, reactor.seconds())
+    request_deferred.addCallback(_request_callback, 
+                                 request["valid-http-status"], 
+                                 response_protocol,
+                                 attempt_deferred)
+    request_deferred.addErrback(_request_errback, attempt_deferred)
+    request["cancel-attempt"] = \
+        lambda: _cancel_attempt(request_deferred, response_protocol)
+
+    if semaphore is not None:
+        attempt_deferred.addBoth(_release_semaphore, semaphore)
+    attempt_deferred.addCallbacks(_attempt_succeeded,
+                                  _attempt_errback,
+                                  callbackArgs=(request, ),
+                                  errbackArgs=(request,
+                                               attempt,
+                                               response_protocol, ))
+
 def start_request(identity, 
                   method, 
                   hostname, 
@@ -91,10 +435,18 @@ def start_request(identity,
                   response_consumer=None, 
                   body_producer=None,
                   additional_headers=None,
-                  valid_http_status=frozenset([httplib.OK, ])):
+                  valid_http_status=frozenset([httplib.OK, ]),
+                  persistent=True,
+                  retry_policy=None,
+                  connect_timeout=None,
+                  first_byte_timeout=None,
+                  idle_timeout=None,
+                  rate_limit=None):
     """
     start an HTTP(S) request
-    return a deferred that fires with the response
+    return a deferred that fires with the response. Cancelling it abandons
+    the request, closing its connection if it has been sent, and fails it
+    with CancelledError
 
     identity
         nimbus.io identity object
@@ -123,37 +475,62 @@ def start_request(identity,
     valid_http_status
         A set of HTTP status code(s) that are valid for this request
         defaults to 200 (OK) 
+
+    persistent
+        if True (the default) use the shared keep-alive connection pool
+        for hostname. If False, open a new connection for this request.
+
+    retry_policy
+        A RetryPolicy (twisted_client_for_nimbusio.retry_policy) deciding
+        whether to retry the request if it fails. None means no retries.
+        A request is only retried if body_producer is None or has a
+        reset method, and response_consumer has not been written to or
+        has a reset method. An object with a false can_reset attribute
+        is treated as having no reset method.
+
+    connect_timeout, first_byte_timeout, idle_timeout
+        seconds to wait for a new connection, for the response to start
+        after the request is sent, and between parts of the response body.
+        None uses the default set by configure_timeouts, 0 disables it.
+        A timeout closes the connection and fails the request with
+        twisted.internet.error.TimeoutError.
+
+    rate_limit
+        bytes per second for the body of this request (and the response),
+        within the limits set by rate_limit.set_rate_limit
     """
-    final_deferred = defer.Deferred()
-    uri = _compute_uri(hostname, path)
-    headers = _compute_headers(identity, method, path)
-    if additional_headers is not None:
-        for key, value in additional_headers.items():
-            headers.addRawHeader(key, value)
+    request = {"identity"           : identity,
+               "method"             : method,
+               "hostname"           : hostname,
+               "path"               : path,
+               "uri"                : _compute_uri(hostname, path),
+               "response-consumer"  : response_consumer,
+               "body-producer"      : body_producer,
+               "additional-headers" : additional_headers,
+               "valid-http-status"  : valid_http_status,
+               "persistent"         : persistent,
+               "retry-policy"       : retry_policy,
+               "connect-timeout"    : _default(connect_timeout,
+                                               _connection_timeout),
+               "first-byte-timeout" : _default(first_byte_timeout,
+                                               _first_byte_timeout),
+               "idle-timeout"       : _default(idle_timeout, _idle_timeout),
+               "rate-limit"         : rate_limit,
+               "started-at"         : reactor.seconds(),
+               "status"             : None,
+               "cancelled"          : False,
+               "cancel-attempt"     : None}
+    request["final-deferred"] = \
+        defer.Deferred(lambda _deferred: _cancel_request(request))
 
-#    our version of twisted is too old to have connectTimeouot :(
-#    agent = Agent(reactor, connectTimeout=_connection_timeout)
-    agent = Agent(reactor)
-    log.msg("requesting %s '%r, connection_timeout = %s" % (
-            method, 
-            uri, 
-            _connection_timeout), 
-            logLevel=logging.DEBUG)
-
-    request_deferred = agent.request(method, uri, headers, body_producer)
-    if response_consumer is None:
-        response_protocol = None
-    else:
-        response_protocol = ResponseProducerProtocol(final_deferred)
-        response_consumer.registerProducer(response_protocol, True)
+    global _requests_in_flight
+    _requests_in_flight += 1
+    metrics.gauge("requests_in_flight", _requests_in_flight)
+    request["final-deferred"].addBoth(_request_finished, request)
 
-    request_deferred.addCallback(_request_callback, 
-                                 valid_http_status, 
-                                 response_protocol,
-                                 final_deferred)
-    request_deferred.addErrback(_request_errback, final_deferred)
+    _start_attempt(request, 1)
 
-    return final_deferred
+    return request["final-deferred"]
 
 def start_collection_request(identity, 
                              method, 
@@ -162,12 +539,18 @@ def start_collection_request(identity,
                              response_consumer=None, 
                              body_producer=None,
                              additional_headers=None,
-                             valid_http_status=frozenset([httplib.OK, ])):
+                             valid_http_status=frozenset([httplib.OK, ]),
+                             persistent=True,
+                             retry_policy=None,
+                             connect_timeout=None,
+                             first_byte_timeout=None,
+                             idle_timeout=None,
+                             rate_limit=None):
     """
     start an HTTP(S) request for a specific collection
     return a deferred that fires with the response
     """
-    hostname = compute_collection_hostname(collection_name)
+    hostname = collection_hostname(collection_name)
     return start_request(identity, 
                          method, 
                          hostname, 
@@ -175,5 +558,11 @@ def start_collection_request(identity,
                          response_consumer, 
                          body_producer,
                          additional_headers,
-                         valid_http_status)
+                         valid_http_status,
+                         persistent,
+                         retry_policy,
+                         connect_timeout,
+                         first_byte_timeout,
+                         idle_timeout,
+                         rate_limit)
   
\ No newline at end of file
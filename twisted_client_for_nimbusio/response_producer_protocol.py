@@ -10,55 +10,151 @@ import logging
 
 from twisted.python import log
 
+from twisted.internet import reactor, error
 from twisted.internet.protocol import Protocol
 from zope.interface import implements
 from twisted.internet.interfaces import IPushProducer
 
 from twisted.web.client import ResponseDone
 
+from twisted_client_for_nimbusio import metrics
+from twisted_client_for_nimbusio.lazy_log import log_debug
+
 class ResponseProducerProtocol(Protocol):
     """
     A protocol for handling the HTTP response from the twisted web client
     It implments the IProducer protocol to pass the respo9nse data on to
     whoever is interested.
+
+    Pausing this producer pauses the underlying transport, so TCP flow
+    control throttles the server while the consumer catches up.
+
+    If idle_timeout is given, and no data arrives for that many seconds
+    (while not paused), the connection is closed and the deferred fails
+    with TimeoutError.
+
+    If throttle (a rate_limit.Throttle) is given, reading from the socket
+    is paused whenever the data gets ahead of its limits.
     """
     implements(IPushProducer)
-    def __init__(self, deferred):
+    def __init__(self, deferred, idle_timeout=None, throttle=None):
         self._deferred = deferred
+        self._idle_timeout = idle_timeout
+        self._throttle = throttle
+        self._throttled_call = None
+        self._idle_call = None
+        self._timed_out = False
         self._transport = None
         self._consumer = None
+        self._paused = False
+        self._stopped = False
+        self._bytes_received = 0
+
+    @property
+    def bytes_received(self):
+        """
+        the number of bytes passed on to the consumer
+        """
+        return self._bytes_received
 
     def makeConnection(self, transport):
         """
         overload Protocol.makeConnection in order to get a reference to the
         transport
         """
-        log.msg("ResponseProducerProtocol makeConnection", 
-                logLevel=logging.DEBUG)
+        log_debug("ResponseProducerProtocol makeConnection")
         Protocol.makeConnection(self, transport)
 
     def connectionMade(self):
         """
         overload Protocol.connectionMade to verify that we have a connection
         """
-        log.msg("ResponseProducerProtocol connectionMade", 
-                logLevel=logging.DEBUG)
+        log_debug("ResponseProducerProtocol connectionMade")
         Protocol.connectionMade(self)
 
+        # the consumer may have asked us to pause, or stop, before the
+        # response body arrived
+        if self._stopped:
+            self.transport.stopProducing()
+        elif self._paused:
+            self.transport.pauseProducing()
+        else:
+            self._start_idle_timer()
+
+    def _start_idle_timer(self):
+        if not self._idle_timeout:
+            return
+        if self._idle_call is not None and self._idle_call.active():
+            self._idle_call.reset(self._idle_timeout)
+        else:
+            self._idle_call = reactor.callLater(self._idle_timeout,
+                                                self._idle_timed_out)
+
+    def _cancel_idle_timer(self):
+        if self._idle_call is not None and self._idle_call.active():
+            self._idle_call.cancel()
+        self._idle_call = None
+
+    def _idle_timed_out(self):
+        log.msg("ResponseProducerProtocol no data for %ss" % (
+                self._idle_timeout, ),
+                logLevel=logging.WARN)
+        self._idle_call = None
+        self._timed_out = True
+        self._stopped = True
+        self.transport.stopProducing()
+
     def dataReceived(self, data_bytes):
         """
         overload Protocol.dataReceived in order to get the data
         """
         assert self._consumer is not None
+        if self._stopped:
+            return
+        self._bytes_received += len(data_bytes)
+        if self._idle_call is not None:
+            self._start_idle_timer()
+        metrics.increment("bytes_received", len(data_bytes))
+        metrics.increment("consumer_writes")
         self._consumer.write(data_bytes)
+        if self._throttle is not None:
+            delay = self._throttle.consume(len(data_bytes))
+            if delay > 0 and self._throttled_call is None and \
+                not self._stopped:
+                self._throttled_call = reactor.callLater(delay,
+                                                         self._unthrottle)
+                self._cancel_idle_timer()
+                if not self._paused:
+                    self.transport.pauseProducing()
+
+    def _unthrottle(self):
+        self._throttled_call = None
+        if not (self._paused or self._stopped):
+            self.transport.resumeProducing()
+            self._start_idle_timer()
+
+    def _cancel_throttle(self):
+        if self._throttled_call is not None and self._throttled_call.active():
+            self._throttled_call.cancel()
+        self._throttled_call = None
 
     def connectionLost(self, reason=ResponseDone):
         """
         overload Protocol.connectionLost to handle disconnect
         """
         Protocol.connectionLost(self, reason)
+        self._cancel_idle_timer()
+        self._cancel_throttle()
         if reason.check(ResponseDone):
             self._deferred.callback(True)
+        elif self._timed_out:
+            self._deferred.errback(error.TimeoutError(
+                "no response data for %ss" % (self._idle_timeout, )))
+        elif self._stopped:
+            log.msg("ResponseProducerProtocol stopped by consumer %s" % (
+                    reason.getErrorMessage(), ),
+                    logLevel=logging.INFO)
+            self._deferred.errback(reason)
         else:
             log.err("ResponseProducerProtocol connection lost %s" % (reason, ),
                     logLevel=logging.ERROR)
@@ -68,4 +164,38 @@ class ResponseProducerProtocol(Protocol):
         assert self._consumer is None
         self._consumer = consumer
 
-        
+    def pauseProducing(self):
+        """
+        IPushProducer: stop reading from the socket until resumeProducing
+        """
+        log_debug("ResponseProducerProtocol pauseProducing")
+        self._paused = True
+        self._cancel_idle_timer()
+        if self.transport is not None:
+            self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        """
+        IPushProducer: start reading from the socket again
+        """
+        log_debug("ResponseProducerProtocol resumeProducing")
+        self._paused = False
+        if self.transport is not None and not self._stopped and \
+            self._throttled_call is None:
+            self.transport.resumeProducing()
+            self._start_idle_timer()
+
+    def stopProducing(self):
+        """
+        IPushProducer: abandon the response, closing the connection.
+        The request deferred fails with the reason the connection was lost.
+        """
+        log.msg("ResponseProducerProtocol stopProducing",
+                logLevel=logging.INFO)
+        if self._stopped:
+            return
+        self._stopped = True
+        self._cancel_idle_timer()
+        self._cancel_throttle()
+        if self.transport is not None:
+            self.transport.stopProducing()
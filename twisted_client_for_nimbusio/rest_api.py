@@ -18,24 +18,51 @@ def compute_head_path(key, *args, **kwargs):
     """
     return compute_uri_path("data", key, *args, **kwargs)
  
-def compute_list_keys_path(prefix=""):
+def compute_list_keys_path(prefix="", 
+                           max_keys=None, 
+                           delimiter=None, 
+                           marker=None):
     """
     list all keys, or all keys beginning with prefix
+
+    max_keys limits the number of keys in the response, marker starts the
+    listing after that key, so a large listing can be fetched in pages
     """ 
     kwargs = dict()
     if prefix != "" and prefix is not None:
         kwargs["prefix"] = prefix
+    if max_keys is not None:
+        kwargs["max_keys"] = max_keys
+    if delimiter is not None:
+        kwargs["delimiter"] = delimiter
+    if marker is not None:
+        kwargs["marker"] = marker
 
     return compute_uri_path("data/", **kwargs)
 
-def compute_list_versions_path(prefix=""):
+def compute_list_versions_path(prefix="", 
+                               max_keys=None, 
+                               delimiter=None, 
+                               key_marker=None, 
+                               version_id_marker=None):
     """
     list all versions of all keys, 
     or all versions of all keys beginning with prefix
+
+    max_keys limits the number of versions in the response, key_marker
+    and version_id_marker start the listing after that version
     """ 
     kwargs = dict()
     if prefix != "" and prefix is not None:
         kwargs["prefix"] = prefix
+    if max_keys is not None:
+        kwargs["max_keys"] = max_keys
+    if delimiter is not None:
+        kwargs["delimiter"] = delimiter
+    if key_marker is not None:
+        kwargs["key_marker"] = key_marker
+    if version_id_marker is not None:
+        kwargs["version_identifier_marker"] = version_id_marker
 
     return compute_uri_path("/?versions", **kwargs)
 
@@ -69,12 +96,12 @@ def compute_start_conjoined_path(key):
 
 def compute_abort_conjoined_path(conjoined_identifier, key):
     """
-    start a conjoined archive
+    abort a conjoined archive
     """
     kwargs = {"action"                : "abort",
               "conjoined_identifier"  : conjoined_identifier}
 
-    uri = compute_uri_path("conjoined", key, **kwargs)
+    return compute_uri_path("conjoined", key, **kwargs)
 
 def compute_finish_conjoined_path(key, conjoined_identifier):
     """
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+retry_policy.py
+
+decide whether a failed request should be retried, and how long to wait
+before retrying it: exponential backoff with jitter, a limit on retries
+per request, and an optional budget of retries shared by every request
+using the policy.
+
+Pass a RetryPolicy to requester.start_request as retry_policy.
+"""
+import httplib
+import random
+
+from twisted.internet import error
+
+from twisted.web import client
+
+from twisted_client_for_nimbusio.requester import NimbusioHTTPStatusError
+
+#: methods that can be repeated without changing the result
+idempotent_methods = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS", ])
+
+default_retryable_status = frozenset([httplib.INTERNAL_SERVER_ERROR,
+                                      httplib.BAD_GATEWAY,
+                                      httplib.SERVICE_UNAVAILABLE,
+                                      httplib.GATEWAY_TIMEOUT, ])
+
+default_retryable_exceptions = (error.ConnectError,
+                                error.ConnectionLost,
+                                error.DNSLookupError,
+                                error.TimeoutError,
+                                client.ResponseFailed,
+                                client.RequestTransmissionFailed, )
+# not in older versions of twisted
+if hasattr(client, "ResponseNeverReceived"):
+    default_retryable_exceptions += (client.ResponseNeverReceived, )
+
+class RetryPolicy(object):
+    """
+    when, and how often, to retry a failed request
+
+    max_retries
+        the number of retries for one request
+
+    initial_delay
+        seconds to wait before the first retry
+
+    multiplier
+        each retry waits multiplier times longer than the one before
+
+    max_delay
+        the longest wait before a retry
+
+    jitter
+        the fraction (0.0 - 1.0) of each delay that is randomized, so
+        that requests failing together do not retry together
+
+    retryable_status
+        HTTP status codes worth retrying
+
+    retryable_exceptions
+        a tuple of exception classes worth retrying
+
+    retry_non_idempotent
+        retry methods, such as POST, that are not idempotent. An archive
+        POST that failed may have been stored; only set this if repeating
+        it is harmless
+
+    retry_budget
+        the total number of retries allowed for every request using this
+        policy. None means no limit
+    """
+    def __init__(self,
+                 max_retries=3,
+                 initial_delay=0.5,
+                 multiplier=2.0,
+                 max_delay=30.0,
+                 jitter=1.0,
+                 retryable_status=default_retryable_status,
+                 retryable_exceptions=default_retryable_exceptions,
+                 retry_non_idempotent=False,
+                 retry_budget=None):
+        assert 0.0 <= jitter <= 1.0
+        self._max_retries = max_retries
+        self._initial_delay = initial_delay
+        self._multiplier = multiplier
+        self._max_delay = max_delay
+        self._jitter = jitter
+        self._retryable_status = retryable_status
+        self._retryable_exceptions = retryable_exceptions
+        self._retry_non_idempotent = retry_non_idempotent
+        self._retry_budget = retry_budget
+        self._retry_count = 0
+
+    @property
+    def retry_count(self):
+        """
+        the number of retries made under this policy
+        """
+        return self._retry_count
+
+    @property
+    def retry_budget_remaining(self):
+        if self._retry_budget is None:
+            return None
+        return self._retry_budget - self._retry_count
+
+    def is_retryable(self, method, failure, attempt):
+        """
+        return True if request attempt number 'attempt' (counting from 1)
+        failed in a way that is worth retrying
+        """
+        if attempt > self._max_retries:
+            return False
+        if self._retry_budget is not None and \
+            self._retry_count >= self._retry_budget:
+            return False
+        if method not in idempotent_methods and \
+            not self._retry_non_idempotent:
+            return False
+
+        if failure.check(NimbusioHTTPStatusError):
+            return failure.value.status in self._retryable_status
+
+        return failure.check(*self._retryable_exceptions) is not None
+
+    def compute_delay(self, attempt):
+        """
+        return the seconds to wait before retrying attempt number 'attempt'
+        and count the retry against the budget
+        """
+        self._retry_count += 1
+        delay = min(self._max_delay,
+                    self._initial_delay * (self._multiplier ** (attempt - 1)))
+        return delay * (1.0 - self._jitter * random.random())
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+scheduler.py
+
+queue requests to nimbus.io and start them through requester.start_request
+without exceeding a global limit, and a per-host limit, on the number of
+requests in flight. Queued requests start in priority order, so small
+metadata requests can go ahead of bulk transfers.
+"""
+import heapq
+import itertools
+import os
+
+from twisted.internet import reactor, defer
+
+from twisted_client_for_nimbusio import requester
+from twisted_client_for_nimbusio.lazy_log import log_debug
+
+#: priorities, lowest starts first
+PRIORITY_METADATA = 0
+PRIORITY_NORMAL = 10
+PRIORITY_BULK = 20
+
+_default_max_in_flight = int(
+    os.environ.get("NIMBUSIO_MAX_IN_FLIGHT", "64"))
+_default_max_in_flight_per_host = int(
+    os.environ.get("NIMBUSIO_MAX_IN_FLIGHT_PER_HOST", "8"))
+
+def default_priority(method, body_producer):
+    """
+    the priority of a request when the caller does not give one:
+    HEAD requests are metadata, uploads are bulk, the rest are normal
+    """
+    if method == "HEAD":
+        return PRIORITY_METADATA
+    if body_producer is not None:
+        return PRIORITY_BULK
+    return PRIORITY_NORMAL
+
+def collection_request_function(scheduler=None):
+    """
+    return the function to start collection requests with: the
+    start_collection_request of scheduler, or of requester (which starts
+    requests immediately) if scheduler is None
+    """
+    if scheduler is None:
+        return requester.start_collection_request
+    return scheduler.start_collection_request
+
+class RequestScheduler(object):
+    """
+    start requests with limits on the number in flight
+
+    max_in_flight
+        the maximum number of requests in flight, to all hosts
+
+    max_in_flight_per_host
+        the maximum number of requests in flight to one host
+    """
+    def __init__(self,
+                 max_in_flight=_default_max_in_flight,
+                 max_in_flight_per_host=_default_max_in_flight_per_host):
+        self._max_in_flight = max_in_flight
+        self._max_in_flight_per_host = max_in_flight_per_host
+        self._sequence = itertools.count()
+
+        # a heap of queued entries for each host
+        self._queues = dict()
+        self._queue_depth = 0
+        self._in_flight = 0
+        self._in_flight_by_host = dict()
+
+        self._started_count = 0
+        self._total_wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    @property
+    def queue_depth(self):
+        return self._queue_depth
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def in_flight_for_host(self, hostname):
+        return self._in_flight_by_host.get(hostname, 0)
+
+    def stats(self):
+        """
+        return a dict of queue depth, requests in flight, and the
+        number started with their total, mean and max time in the queue
+        """
+        if self._started_count == 0:
+            mean_wait_time = 0.0
+        else:
+            mean_wait_time = self._total_wait_time / self._started_count
+        return {"queue-depth"       : self._queue_depth,
+                "in-flight"         : self._in_flight,
+                "started"           : self._started_count,
+                "total-wait-time"   : self._total_wait_time,
+                "mean-wait-time"    : mean_wait_time,
+                "max-wait-time"     : self._max_wait_time}
+
+    def start_request(self,
+                      identity,
+                      method,
+                      hostname,
+                      path,
+                      *args,
+                      **kwargs):
+        """
+        queue a request, and start it when the limits allow
+        return a deferred that fires with the result of
+        requester.start_request. Cancelling it takes a queued request out
+        of the queue, and cancels a request already started.
+
+        priority (keyword only)
+            lower numbers start first. Defaults to default_priority()
+
+        other arguments are passed to requester.start_request, positional
+        ones in its order
+        """
+        priority = kwargs.pop("priority", None)
+        if priority is None:
+            if len(args) > 1:
+                body_producer = args[1]
+            else:
+                body_producer = kwargs.get("body_producer")
+            priority = default_priority(method, body_producer)
+
+        entry = {"identity"     : identity,
+                 "method"       : method,
+                 "hostname"     : hostname,
+                 "path"         : path,
+                 "args"         : args,
+                 "kwargs"       : kwargs,
+                 "queued-at"    : reactor.seconds(),
+                 "cancelled"    : False}
+        entry["deferred"] = defer.Deferred(canceller=self._cancel(entry))
+
+        queue = self._queues.setdefault(hostname, list())
+        heapq.heappush(queue, (priority, next(self._sequence), entry, ))
+        self._queue_depth += 1
+
+        log_debug("scheduler queued %s %r priority %s depth %s",
+                  method, path, priority, self._queue_depth)
+
+        self._dispatch()
+        return entry["deferred"]
+
+    def start_collection_request(self,
+                                 identity,
+                                 method,
+                                 collection_name,
+                                 path,
+                                 *args,
+                                 **kwargs):
+        """
+        queue a request for a specific collection
+        """
+        hostname = requester.collection_hostname(collection_name)
+        return self.start_request(identity,
+                                  method,
+                                  hostname,
+                                  path,
+                                  *args,
+                                  **kwargs)
+
+    def _cancel(self, entry):
+        def _canceller(_deferred):
+            if entry["cancelled"]:
+                return
+            if "request-deferred" in entry:
+                # started: cancel the request itself, _request_done
+                # passes on the failure
+                entry["request-deferred"].cancel()
+                return
+            entry["cancelled"] = True
+            self._queue_depth -= 1
+        return _canceller
+
+    def _next_entry(self):
+        """
+        pop the highest priority entry for a host under its limit
+        return None if there is none
+        """
+        best_host = None
+        best_head = None
+        for hostname, queue in self._queues.iteritems():
+            while len(queue) > 0 and queue[0][2]["cancelled"]:
+                heapq.heappop(queue)
+            if len(queue) == 0:
+                continue
+            if self.in_flight_for_host(hostname) >= \
+                self._max_in_flight_per_host:
+                continue
+            if best_head is None or queue[0] < best_head:
+                best_host = hostname
+                best_head = queue[0]
+
+        if best_host is None:
+            return None
+
+        queue = self._queues[best_host]
+        heapq.heappop(queue)
+        if len(queue) == 0:
+            del self._queues[best_host]
+        return best_head[2]
+
+    def _dispatch(self):
+        while self._in_flight < self._max_in_flight:
+            entry = self._next_entry()
+            if entry is None:
+                break
+            self._start_entry(entry)
+
+    def _start_entry(self, entry):
+        hostname = entry["hostname"]
+        self._queue_depth -= 1
+        self._in_flight += 1
+        self._in_flight_by_host[hostname] = \
+            self.in_flight_for_host(hostname) + 1
+
+        entry["started-at"] = reactor.seconds()
+        wait_time = entry["started-at"] - entry["queued-at"]
+        self._started_count += 1
+        self._total_wait_time += wait_time
+        self._max_wait_time = max(self._max_wait_time, wait_time)
+
+        try:
+            request_deferred = requester.start_request(entry["identity"],
+                                                       entry["method"],
+                                                       hostname,
+                                                       entry["path"],
+                                                       *entry["args"],
+                                                       **entry["kwargs"])
+        except Exception:
+            request_deferred = defer.fail()
+
+        entry["request-deferred"] = request_deferred
+        request_deferred.addBoth(self._request_done, entry)
+
+    def _request_done(self, result, entry):
+        hostname = entry["hostname"]
+        self._in_flight -= 1
+        self._in_flight_by_host[hostname] -= 1
+        if self._in_flight_by_host[hostname] == 0:
+            del self._in_flight_by_host[hostname]
+
+        self._dispatch()
+
+        # the caller may have given up on a request already started
+        if not entry["deferred"].called:
+            entry["deferred"].callback(result)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+threaded_digest.py
+
+an MD5 digest updated in the reactor's thread pool, so hashing a large
+upload does not hold up the reactor. hashlib releases the GIL while it
+hashes large buffers, so the hashing overlaps with the I/O of every
+connection.
+
+Data is hashed in the order it is given. Chunks that arrive while the
+worker is busy are hashed together on its next trip, so there is at most
+one thread at work per digest, and a chunk is kept only until it has
+been hashed.
+
+The digest is exact once every chunk has been hashed: wait_for_digest
+returns a deferred that fires with it. digest raises DigestPendingError
+until then. If hashing fails, the digest is lost: every later call to
+digest, or wait_for_digest, fails with the same error.
+"""
+from collections import deque
+from hashlib import md5
+import logging
+import os
+
+from twisted.python import log
+
+from twisted.internet import defer
+from twisted.internet.threads import deferToThread
+
+default_hash_in_thread = \
+    os.environ.get("NIMBUSIO_HASH_IN_THREAD", "0") == "1"
+
+class DigestPendingError(Exception):
+    pass
+
+def _update_hash(hash_object, chunks):
+    for data in chunks:
+        hash_object.update(data)
+
+class ThreadedDigest(object):
+    """
+    an MD5 that hashes its updates in a worker thread
+    """
+    def __init__(self):
+        self._md5 = md5()
+        self._chunks = deque()
+        self._worker = None
+        self._waiting = list()
+        self._failure = None
+
+    @property
+    def is_idle(self):
+        """
+        True if everything given to update has been hashed
+        """
+        return self._worker is None
+
+    def update(self, data):
+        if self._failure is not None:
+            # the digest is lost already, there is no point in hashing
+            return
+        self._chunks.append(data)
+        if self._worker is None:
+            self._start_worker()
+
+    def _start_worker(self):
+        chunks = list(self._chunks)
+        self._chunks.clear()
+        self._worker = deferToThread(_update_hash, self._md5, chunks)
+        self._worker.addCallbacks(self._hashed, self._hash_failed)
+
+    def _hashed(self, _result):
+        self._worker = None
+        if len(self._chunks) > 0:
+            self._start_worker()
+            return
+        waiting, self._waiting = self._waiting, list()
+        for deferred in waiting:
+            deferred.callback(self._md5.digest())
+
+    def _hash_failed(self, failure):
+        log.msg("ThreadedDigest hashing failed: %s" % (
+                failure.getErrorMessage(), ),
+                logLevel=logging.ERROR)
+        self._worker = None
+        self._chunks.clear()
+        self._failure = failure
+        waiting, self._waiting = self._waiting, list()
+        for deferred in waiting:
+            deferred.errback(failure)
+
+    def _check_digest(self):
+        if self._failure is not None:
+            self._failure.raiseException()
+        if not self.is_idle:
+            raise DigestPendingError("digest requested while still hashing")
+
+    def digest(self):
+        self._check_digest()
+        return self._md5.digest()
+
+    def hexdigest(self):
+        self._check_digest()
+        return self._md5.hexdigest()
+
+    def wait_for_digest(self):
+        """
+        return a deferred that fires with the binary digest when
+        everything given to update so far has been hashed
+        """
+        if self._failure is not None:
+            return defer.fail(self._failure)
+        if self.is_idle:
+            return defer.succeed(self._md5.digest())
+        deferred = defer.Deferred()
+        self._waiting.append(deferred)
+        return deferred
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+verifying_consumer.py
+
+check retrieved data against what nimbus.io says it should be, as it
+streams, without keeping it.
+
+VerifyingConsumer wraps another consumer (or none, to only check),
+hashing and counting the data on its way through. verify() compares the
+MD5 digest and length with the expected values, taken from a HEAD of the
+key (set_expected_from_headers) or from the archive (the md5_digest and
+length of the PassThruProducer that uploaded it).
+
+retrieve_verified does all of it: HEAD, GET, and verify, failing the
+deferred with VerificationError on a mismatch.
+"""
+from hashlib import md5
+import logging
+
+from twisted.python import log
+
+from zope.interface import implements
+from twisted.internet.interfaces import IConsumer, IPushProducer
+
+from twisted_client_for_nimbusio import metrics
+from twisted_client_for_nimbusio.rest_api import compute_head_path, \
+    compute_retrieve_path
+from twisted_client_for_nimbusio.scheduler import \
+    collection_request_function
+from twisted_client_for_nimbusio.metadata_cache import \
+    md5_digest_from_headers, \
+    content_length_from_headers
+
+class VerificationError(Exception):
+    pass
+
+class VerifyingConsumer(object):
+    """
+    An IConsumer that hashes and counts the data it passes on to consumer
+
+    expected_length, expected_md5
+        the length and the binary MD5 digest the data must have. Either
+        may be None (or set later), and is then not checked.
+
+    It registers itself with consumer as the producer, passing pause,
+    resume and stop on to the real producer. The request can be retried
+    if consumer can be reset (see can_reset).
+    """
+    implements(IConsumer, IPushProducer)
+
+    def __init__(self, consumer=None, expected_length=None,
+                 expected_md5=None):
+        self._consumer = consumer
+        self._producer = None
+        self._expected_length = expected_length
+        self._expected_md5 = expected_md5
+        self._md5 = md5()
+        self._bytes_written = 0
+
+    @property
+    def bytes_written(self):
+        return self._bytes_written
+
+    @property
+    def md5_digest(self):
+        return self._md5.digest()
+
+    @property
+    def expected_length(self):
+        return self._expected_length
+
+    @property
+    def expected_md5(self):
+        return self._expected_md5
+
+    def set_expected(self, length=None, md5_digest=None):
+        self._expected_length = length
+        self._expected_md5 = md5_digest
+
+    def set_expected_from_headers(self, headers):
+        """
+        expect the Content-Length and Content-MD5 of a HEAD result
+        """
+        self.set_expected(content_length_from_headers(headers),
+                          md5_digest_from_headers(headers))
+
+    def verify(self, result=None):
+        """
+        raise VerificationError if the data does not match what is
+        expected, otherwise return result (so this can be a callback)
+        """
+        error_message = None
+        if self._expected_length is not None and \
+            self._bytes_written != self._expected_length:
+            error_message = "length mismatch %s != %s" % (
+                self._bytes_written, self._expected_length, )
+        elif self._expected_md5 is not None and \
+            self._md5.digest() != self._expected_md5:
+            error_message = "md5 mismatch %s != %s" % (
+                self._md5.hexdigest(), self._expected_md5.encode("hex"), )
+
+        if error_message is not None:
+            metrics.increment("verifying_consumer.mismatch")
+            log.msg("VerifyingConsumer %s" % (error_message, ),
+                    logLevel=logging.ERROR)
+            raise VerificationError(error_message)
+
+        return result
+
+    @property
+    def can_reset(self):
+        """
+        True if reset can start over: there is no wrapped consumer, or it
+        can be reset too. requester only retries a request whose consumer
+        has seen data if it can be reset
+        """
+        return self._consumer is None or \
+            (hasattr(self._consumer, "reset") and
+             getattr(self._consumer, "can_reset", True))
+
+    def reset(self):
+        """
+        start over, for a retry
+        """
+        if not self.can_reset:
+            raise NotImplementedError("consumer %r cannot be reset" % (
+                                      self._consumer, ))
+        self._md5 = md5()
+        self._bytes_written = 0
+        if self._consumer is not None:
+            self._consumer.reset()
+
+    def registerProducer(self, producer, streaming):
+        self._producer = producer
+        producer.addConsumer(self)
+        if self._consumer is not None:
+            self._consumer.registerProducer(self, streaming)
+
+    def unregisterProducer(self):
+        self._producer = None
+        if self._consumer is not None:
+            self._consumer.unregisterProducer()
+
+    def addConsumer(self, _consumer):
+        pass
+
+    def pauseProducing(self):
+        self._producer.pauseProducing()
+
+    def resumeProducing(self):
+        self._producer.resumeProducing()
+
+    def stopProducing(self):
+        self._producer.stopProducing()
+
+    def write(self, data):
+        self._md5.update(data)
+        self._bytes_written += len(data)
+        if self._consumer is not None:
+            self._consumer.write(data)
+
+def retrieve_verified(identity,
+                      collection_name,
+                      key,
+                      consumer=None,
+                      version_id=None,
+                      expected_length=None,
+                      expected_md5=None,
+                      metadata_cache=None,
+                      scheduler=None,
+                      **kwargs):
+    """
+    retrieve key to consumer, checking the data against expected_length
+    and expected_md5 if they are given, otherwise against a HEAD of the
+    key (through metadata_cache, if there is one)
+
+    return a deferred that fires with the VerifyingConsumer when all the
+    data has been written to consumer and checked, or fails with
+    VerificationError. Extra keyword arguments are passed to the requests
+    """
+    request = collection_request_function(scheduler)
+
+    verifying_consumer = VerifyingConsumer(consumer,
+                                           expected_length,
+                                           expected_md5)
+
+    if expected_length is not None or expected_md5 is not None:
+        deferred = None
+    elif metadata_cache is not None:
+        deferred = metadata_cache.head(identity,
+                                       collection_name,
+                                       key,
+                                       version_id=version_id,
+                                       scheduler=scheduler,
+                                       **kwargs)
+    else:
+        deferred = request(identity,
+                           "HEAD",
+                           collection_name,
+                           compute_head_path(key,
+                                             version_identifier=version_id),
+                           **kwargs)
+
+    def _retrieve(_result):
+        return request(identity,
+                       "GET",
+                       collection_name,
+                       compute_retrieve_path(key, version_id),
+                       response_consumer=verifying_consumer,
+                       **kwargs)
+
+    if deferred is None:
+        deferred = _retrieve(None)
+    else:
+        deferred.addCallback(verifying_consumer.set_expected_from_headers)
+        deferred.addCallback(_retrieve)
+    deferred.addCallback(lambda _result: verifying_consumer)
+    deferred.addCallback(verifying_consumer.verify)
+    return deferred